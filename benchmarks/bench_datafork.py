@@ -0,0 +1,284 @@
+"""
+Benchmarks for the datafork internals.
+
+Each benchmark is a function that takes its parameters as keyword arguments
+and returns a callable to time, having done any setup outside of it. Setup
+that must be repeated before every call can be attached to the callable as
+its ``setup`` attribute. The results are written as JSON so that they can be
+compared across releases:
+
+.. code-block:: sh
+
+    python benchmarks/bench_datafork.py --output results.json
+    python benchmarks/bench_datafork.py --filter merge --repeat 10
+
+Every result records the benchmark name, its parameters and the timings of
+each repeat in seconds per operation.
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import timeit
+
+import datafork
+
+
+BENCHMARKS = []
+
+
+def benchmark(**params):
+    """
+    Register a benchmark, with each keyword argument giving the list of
+    values to try for that parameter. Every combination is run.
+    """
+    def decorator(func):
+        BENCHMARKS.append((func, params))
+        return func
+    return decorator
+
+
+def nested_states(root, depth):
+    # Open `depth` nested forks below the root, returning the deepest
+    # state and the context managers needed to unwind them.
+    contexts = []
+    state = root
+    for i in range(depth):
+        context = state.fork()
+        state = context.__enter__()
+        contexts.append(context)
+    return state, contexts
+
+
+@benchmark(depth=[0, 1, 4, 16, 64])
+def read_depth(depth):
+    """Read a slot set in the root from the deepest of `depth` forks."""
+    root = datafork.Root()
+    slot = root.slot(initial_value=1)
+    state, contexts = nested_states(root, depth)
+
+    def run():
+        state.get_slot_value(slot)
+    return run
+
+
+@benchmark(children=[1, 4, 16], slots=[10, 100, 1000])
+def merge_children(children, slots):
+    """Merge `children` states that each wrote every one of `slots`."""
+    root = datafork.Root()
+    all_slots = [root.slot(initial_value=0) for i in range(slots)]
+    states = []
+    for i in range(children):
+        with root.fork() as child:
+            for slot in all_slots:
+                slot.value = 1
+        states.append(child)
+
+    def run():
+        root.merge_children(states)
+    return run
+
+
+def sum_merge(cases):
+    return sum(case.value for case in cases)
+
+
+def sum_batch(batch):
+    values = batch.values
+    offsets = batch.offsets
+    return [
+        sum(values[offsets[i]:offsets[i + 1]])
+        for i in range(len(batch.slots))
+    ]
+
+
+@benchmark(batch=[False, True], slots=[1000, 10000])
+def custom_merge(batch, slots):
+    """Merge 4 children writing `slots` slots with a summing merge."""
+    root = datafork.Root()
+    merge = datafork.BatchMerge(sum_batch) if batch else sum_merge
+    all_slots = [
+        root.slot(initial_value=0, merge=merge) for i in range(slots)
+    ]
+    states = []
+    for i in range(4):
+        with root.fork() as child:
+            for slot in all_slots:
+                slot.value = i
+        states.append(child)
+
+    def run():
+        root.merge_children(states)
+    return run
+
+
+@benchmark(lazy=[False, True], reads=[1, 100])
+def merge_then_read(lazy, reads):
+    """Merge 16 children that each wrote 1000 slots, then read `reads`."""
+    root = datafork.Root()
+    all_slots = [root.slot(initial_value=0) for i in range(1000)]
+    read_slots = all_slots[:reads]
+    parents = []
+
+    def setup():
+        with root.fork() as parent:
+            states = []
+            for i in range(16):
+                with parent.fork() as child:
+                    for slot in all_slots:
+                        slot.value = 1
+                states.append(child)
+        parents.append((parent, states))
+
+    def run():
+        parent, states = parents.pop()
+        parent.merge_children(states, lazy=lazy)
+        for slot in read_slots:
+            parent.get_slot_value(slot)
+    run.setup = setup
+    return run
+
+
+@benchmark(size=[10, 1000, 100000])
+def fork_on_read(size):
+    """First read of a list slot of `size` items in a fresh child."""
+    root = datafork.Root()
+    slot = root.slot(initial_value=list(range(size)), fork=list)
+
+    def run():
+        with root.fork() as child:
+            child.get_slot_value(slot)
+    return run
+
+
+@benchmark(size=[10, 1000, 100000])
+def copy_on_write_read(size):
+    """Like fork_on_read, but with the fork made copy-on-write."""
+    root = datafork.Root()
+    slot = root.slot(
+        initial_value=list(range(size)), fork=datafork.CopyOnWrite(list),
+    )
+
+    def run():
+        with root.fork() as child:
+            len(child.get_slot_value(slot))
+    return run
+
+
+@benchmark(writes=[1, 10, 100])
+def transaction(writes):
+    """A successful transaction that writes `writes` slots."""
+    root = datafork.Root()
+    slots = [root.slot(initial_value=0) for i in range(writes)]
+
+    def run():
+        with root.transaction():
+            for slot in slots:
+                slot.value = 1
+    return run
+
+
+@benchmark(slots=[100, 1000, 10000])
+def finalize(slots):
+    """Finalize a root holding `slots` slots."""
+    roots = []
+
+    def setup():
+        root = datafork.Root()
+        for i in range(slots):
+            root.slot(initial_value=i)
+        roots.append(root)
+
+    def run():
+        roots.pop().finalize_data()
+    run.setup = setup
+    return run
+
+
+def time_loop(run, number):
+    # Like timeit.timeit, but calls run.setup (if present) outside the
+    # timed region before each call.
+    setup = getattr(run, "setup", None)
+    if setup is None:
+        return timeit.timeit(run, number=number)
+    total = 0.0
+    for i in range(number):
+        setup()
+        start = timeit.default_timer()
+        run()
+        total += timeit.default_timer() - start
+    return total
+
+
+def run_benchmark(func, params, repeat, min_time):
+    run = func(**params)
+
+    # Pick a loop count that takes at least min_time per repeat.
+    number = 1
+    while True:
+        elapsed = time_loop(run, number)
+        if elapsed >= min_time:
+            break
+        number *= 10
+
+    timings = [
+        time_loop(run, number) / number
+        for i in range(repeat)
+    ]
+    return {
+        "name": func.__name__,
+        "params": params,
+        "number": number,
+        "timings": timings,
+        "min": min(timings),
+        "mean": sum(timings) / len(timings),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "--output",
+        help="file to write JSON results to, instead of stdout",
+    )
+    parser.add_argument(
+        "--filter",
+        default="",
+        help="only run benchmarks whose name contains this string",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.05)
+    args = parser.parse_args(argv)
+
+    results = []
+    for func, param_values in BENCHMARKS:
+        if args.filter not in func.__name__:
+            continue
+        names = sorted(param_values)
+        for values in itertools.product(*[param_values[n] for n in names]):
+            params = dict(zip(names, values))
+            result = run_benchmark(func, params, args.repeat, args.min_time)
+            sys.stderr.write(
+                "%s %r: %.3gs\n" % (result["name"], params, result["min"])
+            )
+            results.append(result)
+
+    report = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "time": time.time(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
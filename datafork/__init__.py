@@ -1,14 +1,77 @@
 
+import array
+import bisect
 import collections
+import itertools
+import math
+import sys
+import threading
+import timeit
+import weakref
 
 __all__ = [
     "MergeConflict",
     "ValueNotKnownError",
     "ValueAmbiguousError",
+    "TransactionConflictError",
     "root",
+    "multi_transaction",
 ]
 
 
+# Every write to a slot in any state is stamped with a version from this
+# counter. Versions are only ever compared for equality, so one counter
+# shared by all roots is enough to make them unique.
+_versions = itertools.count(1)
+
+# Passed to Root._create_slot to create a slot without writing any value
+# into the current state.
+_DEFERRED = object()
+
+# Stands in for a value a state doesn't have in MergeBatch.from_states.
+_MISSING = object()
+
+# Tags the index keys of slot owners that can't be hashed, which are
+# indexed by identity instead.
+_UNHASHABLE_OWNER = object()
+
+
+def _owner_key(owner):
+    try:
+        hash(owner)
+    except TypeError:
+        return (_UNHASHABLE_OWNER, id(owner))
+    return owner
+
+
+# Types whose equal values are interchangeable, so that interning can't
+# change what a program sees. Floats are handled separately because of
+# the signed zero.
+_INTERNABLE_TYPES = frozenset([
+    type(None), bool, int, long, str, unicode,
+])
+
+
+def _intern_key(value):
+    # The key under which Root.intern_value keeps a value, which only
+    # matches values that are interchangeable with it, or None if the value
+    # can't be interned safely.
+    value_type = type(value)
+    if value_type in _INTERNABLE_TYPES:
+        return (value_type, value)
+    if value_type is float:
+        return (float, value, math.copysign(1.0, value))
+    if value_type is tuple:
+        items = []
+        for item in value:
+            key = _intern_key(item)
+            if key is None:
+                return None
+            items.append(key)
+        return (tuple, tuple(items))
+    return None
+
+
 class State(object):
     """
     A set of values for slots under a given root.
@@ -19,14 +82,34 @@ class State(object):
     :py:meth:`fork` method, or its smarter cousin :py:meth:`transaction`.
     """
 
+    #: ``True`` once :py:meth:`discard` has been called.
+    discarded = False
+    # True once this state has been merged into its parent, or thrown away
+    # without being merged.
+    _finished = False
+
     def __init__(self, root, parent=None, owner=None):
         self.root = root
         self.parent = parent
+        # Optional instrumentation is shared by every state under a root.
+        self._hooks = parent._hooks if parent is not None else _Hooks()
+        if self._hooks.stats is not None:
+            self._hooks.stats.states_created += 1
+        if self._hooks.leaks is not None:
+            self._hooks.leaks.track(self)
         self.slot_values = {}
         self.slot_positions = collections.defaultdict(lambda: set())
+        self.slot_versions = {}
+        # The slots whose value in this state is a MergeConflict.
+        self.conflicted_slots = set()
         self.owner = owner
+        # True when a snapshot shares our storage, in which case it must
+        # be copied before our next write.
+        self._pinned = False
+        # Lazy merges whose slots have not all been read yet, oldest first.
+        self._pending = []
 
-    def merge_children(self, children, or_none=False):
+    def merge_children(self, children, or_none=False, lazy=False):
         """
         Given an iterable of one or more child states, merge the values
         of slots in these child states back into this state.
@@ -40,10 +123,50 @@ class State(object):
         If the `or_none` parameter is set to `True`, the merge will
         consider the value of each slot in *this* state in addition to the
         provided children.
+
+        Every slot is merged before any is written, so if a slot's `merge`
+        function raises an exception this state is left unchanged. Use
+        :py:meth:`plan_merge` to find out what a merge would do without
+        making it.
+
+        If `lazy` is set, the children are only recorded as a pending
+        merge, and each slot is merged the first time it is read from or
+        written to this state or one of its descendants. The result is the
+        same as an eager merge as long as the children are not modified
+        afterwards, but only the slots that are actually used are ever
+        merged. Operations that need every slot, such as
+        :py:meth:`snapshot` and :py:meth:`conflicts`, complete the pending
+        merges first. Merges into a root with subscribers, history or a
+        write-ahead log are always eager, since those must see each change
+        as it is made.
         """
         if len(children) == 0:
             return
 
+        slots, states = self._merge_sources(children, or_none)
+
+        # Only merges into the root are reported to change subscribers.
+        changes = self._hooks.changes if self.parent is None else None
+        history = self._hooks.history if self.parent is None else None
+        wal = self._hooks.wal if self.parent is None else None
+        if lazy and changes is None and history is None and wal is None:
+            if slots:
+                self._pending.append(_PendingMerge(states, slots))
+            if self._hooks.stats is not None:
+                # The slots are counted as they are materialized.
+                self._hooks.stats.merges += 1
+            return
+
+        self._merge_slots(
+            slots,
+            lambda slot: self._possibilities(slot, states),
+            states,
+        )
+
+    def _merge_sources(self, children, or_none):
+        # Return the set of slots to merge from the given children and the
+        # list of states to take their values from.
+
         # Make sure all of the provided children are actually children,
         # or else crazy things will happen.
         for child in children:
@@ -56,51 +179,424 @@ class State(object):
         # Add to the slot set only those keys where at least one of the
         # children has its own value.
         for child in children:
+            child._finished = True
             for slot in child.slot_values.iterkeys():
                 slots.add(slot)
+            for merge in child._pending:
+                slots.update(merge.slots)
 
         states = [state for state in children]
         if or_none:
             states.append(self)
+        return slots, states
+
+    def merge_stream(self, or_none=False):
+        """
+        Return a :py:class:`MergeStream` for merging children into this
+        state one at a time.
+
+        The result of committing the stream is the same as passing all of
+        the added children to :py:meth:`merge_children`, with the same
+        meaning of `or_none`, but each child can be dropped as soon as it
+        has been added. This allows merging more children than would fit
+        in memory at once.
+        """
+        return MergeStream(self, or_none)
+
+    def plan_merge(self, children, or_none=False, fail_fast=False):
+        """
+        Work out the result of merging the given children into this state,
+        as :py:meth:`merge_children` would, without changing this state.
+
+        Returns a :py:class:`MergePlan` giving the merged value of each
+        slot and any conflicts, whose :py:meth:`MergePlan.apply` method
+        writes the whole result into this state at once. If `fail_fast` is
+        set, planning stops at the first conflict, which is enough to
+        reject a merge cheaply, and the resulting plan cannot be applied.
+        """
+        slots, states = self._merge_sources(children, or_none)
+        plan = self._plan_slots(
+            slots,
+            lambda slot: self._possibilities(slot, states),
+            states,
+            fail_fast,
+        )
+        # Remember what the merge was based on, so that applying a plan
+        # that has gone stale can be refused.
+        plan._base_versions = [
+            self.get_slot_version(slot) for slot, merged, positions
+            in plan._results
+        ]
+        return plan
+
+    def _merge_slots(self, slots, possibilities, states=None):
+        # Merge each of the given slots into this state, calling
+        # possibilities(slot) to get the list of MergePossibility objects
+        # to pass to its merge function. If the states being merged are
+        # given, slots sharing a BatchMerge are merged a group at a time
+        # and merge policies are applied.
+        profiler = self._hooks.profiler
+        if profiler is None:
+            self._apply_plan(self._plan_slots(slots, possibilities, states))
+        else:
+            with profiler.span("merge_children", self.owner):
+                self._apply_plan(
+                    self._plan_slots(slots, possibilities, states),
+                )
+
+    def _plan_slots(self, slots, possibilities, states, fail_fast=False):
+        # Compute the merged value and positions of each slot without
+        # writing anything, returning a MergePlan.
+        stats = self._hooks.stats
+        profiler = self._hooks.profiler
+        if stats is not None or profiler is not None:
+            start = timeit.default_timer()
+        if self._pending:
+            for slot in slots:
+                self._materialize(slot)
+
+        batched = {}
+        if states is not None:
+            groups = {}
+            for slot in slots:
+                if isinstance(slot.merge, BatchMerge):
+                    groups.setdefault(slot.merge, []).append(slot)
+            for merge, group in groups.iteritems():
+                batch = MergeBatch.from_states(group, states, self)
+                batched.update(
+                    zip(group, self._merge_batch(merge, batch, profiler))
+                )
 
+        policies = self._hooks.merge_policies
+        results = []
+        conflicts = 0
+        complete = True
         for slot in slots:
-            possibles = []
-            for state in states:
-                slot_value = state.get_slot_value(slot)
-                if isinstance(slot_value, MergeConflict):
-                    # Flatten existing merge conflicts so we don't end up
-                    # with them nested inside each other.
-                    possibles.extend(slot_value.possibilities)
+            policy = None
+            if policies is not None and states is not None:
+                policy = self._policy_for(slot)
+            if batched and slot in batched:
+                merged, all_positions = batched[slot]
+            elif policy is not None:
+                merged, all_positions = self._merge_policy(
+                    slot, policy, states, profiler,
+                )
+            else:
+                merged, all_positions = self._merge_possibilities(
+                    slot, possibilities(slot), profiler,
+                )
+            results.append((slot, merged, all_positions))
+            if type(merged) is MergeConflict:
+                conflicts += 1
+                if fail_fast:
+                    complete = False
+                    break
+
+        plan = MergePlan(self, results, conflicts, complete)
+        if stats is not None or profiler is not None:
+            plan._elapsed = timeit.default_timer() - start
+        return plan
+
+    def _check_plan(self, plan):
+        # Raise if a MergePlan can't be applied to this state.
+        if plan.applied:
+            raise Exception("Can't apply %r: already applied" % plan)
+        if not plan.complete:
+            raise Exception(
+                "Can't apply %r: planning stopped at a conflict" % plan
+            )
+        results = plan._results
+        if self._pending:
+            for slot, merged, all_positions in results:
+                self._materialize(slot)
+        if plan._base_versions is not None:
+            for (slot, merged, positions), version in zip(
+                results, plan._base_versions,
+            ):
+                if self.get_slot_version(slot) != version:
+                    raise Exception(
+                        "Can't apply %r: %r has changed since it was planned"
+                        % (plan, slot)
+                    )
+
+    def _apply_plan(self, plan, deferred=None):
+        # Write a complete MergePlan into this state in one go. If a
+        # deferred list is given, change notifications are added to it
+        # as (dispatcher, changes) rather than dispatched.
+        self._check_plan(plan)
+        results = plan._results
+
+        # Only merges into the root are reported to change subscribers.
+        changes = self._hooks.changes if self.parent is None else None
+        history = self._hooks.history if self.parent is None else None
+        stats = self._hooks.stats
+        profiler = self._hooks.profiler
+        if stats is not None or profiler is not None:
+            start = timeit.default_timer()
+        if changes is not None:
+            old_values = [
+                (
+                    slot,
+                    self._find_slot_value(slot),
+                    self.get_slot_positions(slot),
+                )
+                for slot, merged, all_positions in results
+            ]
+
+        # The merge is logged before it is written, so that anything
+        # visible in the root can be recovered.
+        wal = self._hooks.wal if self.parent is None else None
+        if wal is not None:
+            record = plan._wal_record
+            if record is None:
+                record = wal.prepare(self, results)
+            wal.write_prepared(record)
+
+        # Nothing below calls out to user code, so the merge is written
+        # in one go.
+        if self._pinned:
+            self._unpin()
+        values = self.slot_values
+        positions = self.slot_positions
+        conflicted = self.conflicted_slots
+        for slot, merged, all_positions in results:
+            positions[slot] = all_positions
+            values[slot] = merged
+            if type(merged) is MergeConflict:
+                conflicted.add(slot)
+            elif conflicted:
+                conflicted.discard(slot)
+        # The version must be bumped only after the values are in place,
+        # so that optimistic readers racing with this merge can never
+        # pair the new version with an old value. The whole merge shares
+        # one version.
+        version = next(_versions)
+        versions = self.slot_versions
+        for slot, merged, all_positions in results:
+            versions[slot] = version
+        plan.applied = True
+
+        if history is not None:
+            for slot, merged, all_positions in results:
+                history.record(slot, merged, all_positions, version)
+        if stats is not None or profiler is not None:
+            elapsed = plan._elapsed + timeit.default_timer() - start
+        if stats is not None:
+            stats.record_merge(len(results), plan.conflict_count, elapsed)
+        if profiler is not None:
+            profiler.record("merge", self.owner, elapsed, len(results))
+
+        if changes is not None:
+            changed = []
+            for slot, old_value, old_positions in old_values:
+                new_value = self.slot_values[slot]
+                if old_value is new_value or old_value == new_value:
+                    continue
+                changed.append(
+                    SlotChange(
+                        slot,
+                        old_value,
+                        new_value,
+                        old_positions,
+                        self.slot_positions[slot],
+                    )
+                )
+            if changed:
+                if deferred is None:
+                    changes.dispatch(changed)
                 else:
-                    possibles.append(
-                        MergePossibility(
-                            slot_value,
-                            state.get_slot_positions(slot),
-                        )
+                    deferred.append((changes, changed))
+
+    def _possibilities(self, slot, states):
+        # The merge possibilities for one slot across the given states.
+        possibles = []
+        for state in states:
+            slot_value = self._merge_input(state, slot)
+            if isinstance(slot_value, MergeConflict):
+                # Flatten existing merge conflicts so we don't end up
+                # with them nested inside each other.
+                possibles.extend(slot_value.possibilities)
+            else:
+                possibles.append(
+                    MergePossibility(
+                        slot_value,
+                        state.get_slot_positions(slot),
                     )
+                )
+        return possibles
+
+    def _merge_input(self, state, slot):
+        # The value of a slot in one of the states being merged into this
+        # one. A state that has only read a copy-on-write slot hands out a
+        # proxy bound to itself, which must never become a merged value.
+        # It is replaced by the value underneath when this state holds that
+        # value itself, and otherwise by a copy, so that this state never
+        # shares an object with its ancestors.
+        value = state.get_slot_value(slot)
+        if isinstance(value, _CopyOnWriteProxy):
+            if self.slot_values.get(slot) is value._original:
+                return value._original
+            return value._writable()
+        return value
 
-            all_positions = set()
-            for possible in possibles:
-                all_positions.update(possible.positions)
-            self.slot_positions[slot] = all_positions
+    def _merge_possibilities(self, slot, possibles, profiler):
+        # Merge one slot's possibilities, returning the merged value and
+        # positions.
+        if isinstance(slot.merge, BatchMerge):
+            batch = MergeBatch.from_possibilities([slot], [possibles])
+            return self._merge_batch(slot.merge, batch, profiler)[0]
+
+        all_positions = set()
+        for possible in possibles:
+            all_positions.update(possible.positions)
+
+        if profiler is None:
+            merged = slot.merge(possibles)
+        else:
+            merge_start = timeit.default_timer()
+            merged = slot.merge(possibles)
+            profiler.record(
+                "slot_merge",
+                slot.owner,
+                timeit.default_timer() - merge_start,
+                len(possibles),
+            )
+        return merged, all_positions
+
+    def _policy_for(self, slot):
+        # The MergePolicy that applies to a slot, if any. Slots with their
+        # own merge function already have their own policy.
+        hooks = self._hooks
+        if hooks.merge_policies is None or slot.merge is not equality_merge:
+            return None
+        return hooks.merge_policies.get(
+            _owner_key(slot.owner), hooks.merge_policy,
+        )
+
+    def _merge_policy(self, slot, policy, states, profiler):
+        # Merge one slot from the given states using a MergePolicy, only
+        # building possibilities if the policy can't choose a winner.
+        first = self._merge_input(states[0], slot)
+        agreed = type(first) is not MergeConflict
+        all_positions = set()
+        for state in states:
+            all_positions.update(state.get_slot_positions(slot))
+            if agreed:
+                value = self._merge_input(state, slot)
+                agreed = value is first or value == first
+        if agreed:
+            return first, all_positions
+
+        winner = policy.choose(self, slot, states)
+        if winner is None:
+            return self._merge_possibilities(
+                slot, self._possibilities(slot, states), profiler,
+            )
+        return self._merge_input(winner, slot), all_positions
 
-            self.slot_values[slot] = slot.merge(possibles)
+    def _merge_batch(self, merge, batch, profiler):
+        # Merge a batch of slots sharing a BatchMerge, returning a list of
+        # merged values and positions.
+        if profiler is None:
+            results = merge.func(batch)
+        else:
+            merge_start = timeit.default_timer()
+            results = merge.func(batch)
+            elapsed = timeit.default_timer() - merge_start
+            # Share the cost of the call between the slots' owners.
+            owners = collections.Counter(slot.owner for slot in batch.slots)
+            for owner, count in owners.iteritems():
+                profiler.record(
+                    "slot_merge",
+                    owner,
+                    elapsed * count / len(batch.slots),
+                )
+        if len(results) != len(batch.slots):
+            raise Exception(
+                "Can't merge %r: batch merge returned %i values for %i slots"
+                % (batch, len(results), len(batch.slots))
+            )
+
+        merged_values = []
+        offsets = batch.offsets
+        positions = batch.positions
+        empty = set()
+        for i, merged in enumerate(results):
+            if merged is MergeBatch.CONFLICT:
+                merged = MergeConflict(batch.cases(i))
+            merged_values.append((
+                merged,
+                empty.union(*positions[offsets[i]:offsets[i + 1]]),
+            ))
+        return merged_values
+
+    def _write_merged(self, slot, merged, all_positions):
+        # Write a single merged slot, as done by lazy merges.
+        self.slot_positions[slot] = all_positions
+        self.slot_values[slot] = merged
+        if type(merged) is MergeConflict:
+            self.conflicted_slots.add(slot)
+        elif self.conflicted_slots:
+            self.conflicted_slots.discard(slot)
+        self.slot_versions[slot] = next(_versions)
+
+    def _materialize(self, slot):
+        # Run any lazy merges still pending for the given slot, oldest
+        # first. The slot is taken out of every pending merge before any
+        # of them run, so that children falling back to our value see the
+        # result of the merges before theirs rather than triggering the
+        # later ones.
+        # Readers in other threads may need the same slot at once, so the
+        # merges are claimed and run under the root's commit lock.
+        with self.root.commit_lock:
+            merges = [
+                merge for merge in self._pending if slot in merge.slots
+            ]
+            if not merges:
+                return
+            for merge in merges:
+                merge.slots.discard(slot)
+            if self._pinned:
+                self._unpin()
+            stats = self._hooks.stats
+            profiler = self._hooks.profiler
+            policy = self._policy_for(slot)
+            for merge in merges:
+                if stats is not None:
+                    start = timeit.default_timer()
+                if policy is not None:
+                    merged, all_positions = self._merge_policy(
+                        slot, policy, merge.states, profiler,
+                    )
+                else:
+                    merged, all_positions = self._merge_possibilities(
+                        slot, self._possibilities(slot, merge.states),
+                        profiler,
+                    )
+                self._write_merged(slot, merged, all_positions)
+                if stats is not None:
+                    stats.record_materialize(
+                        1 if type(merged) is MergeConflict else 0,
+                        timeit.default_timer() - start,
+                    )
+            # Release the children of merges that are now complete.
+            self._pending = [merge for merge in self._pending if merge.slots]
+
+    def _materialize_all(self):
+        # Complete every pending lazy merge in this state and its
+        # ancestors, for operations that look at whole layers at once.
+        current = self
+        while current is not None:
+            while current._pending:
+                for slot in list(current._pending[0].slots):
+                    current._materialize(slot)
+            current = current.parent
 
     def _create_child(self, owner=None):
         return State(self.root, self, owner)
 
     def _child_context(self, owner, auto_merge):
-        previous = self.root.current_state
-        new = self._create_child(owner)
-        class Context(object):
-            def __enter__(context):
-                self.root.current_state = new
-                return new
-            def __exit__(context, exc_type, exc_value, traceback):
-                if auto_merge and exc_type is None:
-                    self.merge_children([new])
-                self.root.current_state = previous
-        return Context()
+        return _ChildContext(self, owner, auto_merge)
 
     def fork(self, owner=None):
         """
@@ -135,25 +631,110 @@ class State(object):
         """
         return self._child_context(owner, auto_merge=True)
 
+    def atomically(self, func, owner=None, retries=None):
+        """
+        Run `func` in an optimistic transaction and commit it into this
+        state, retrying the whole call if another thread got there first.
+
+        `func` is called with no arguments while a fresh
+        :py:class:`OptimisticState` is active for the *calling thread only*,
+        so several threads may run :py:meth:`atomically` against the same
+        state at once. Each transaction remembers the version of every slot
+        it read from this state; on completion those versions are checked
+        under the root's commit lock and, if none of them have changed, the
+        transaction is merged. Otherwise its changes are thrown away and
+        `func` is called again.
+
+        If `retries` is given, at most that many retries are attempted before
+        :py:class:`TransactionConflictError` is raised. If `func` raises, its
+        changes are discarded and the exception propagates without a retry.
+        Returns whatever the successful call to `func` returned.
+
+        Threads that touch disjoint slots never invalidate each other. The
+        root's :py:attr:`Root.contention` statistics can be used to find the
+        slots that cause retries.
+        """
+        root = self.root
+        attempts = 0
+        while True:
+            txn = OptimisticState(root, self, owner)
+            try:
+                with root.thread_state(txn):
+                    result = func()
+            except:
+                txn._abandon()
+                raise
+            with root.commit_lock:
+                conflict = self._commit_optimistic(txn)
+                if conflict is None:
+                    root.contention.record_commit(attempts)
+                    return result
+                root.contention.record_conflict(conflict)
+            txn._abandon()
+            attempts += 1
+            if retries is not None and attempts > retries:
+                raise TransactionConflictError(conflict)
+
+    def _commit_optimistic(self, txn):
+        # Merge an optimistic transaction into this state if its reads are
+        # still current, returning None, or else the first slot found to
+        # have changed. Called with the root's commit lock held.
+        conflict = txn.validate()
+        if conflict is None:
+            self.merge_children([txn])
+        return conflict
+
     def set_slot(self, slot, value, position=None):
+        profiler = self._hooks.profiler
+        if profiler is not None:
+            start = timeit.default_timer()
+        if self._pending:
+            self._materialize(slot)
+        positions = set([position] if position is not None else [])
+        if self.parent is None and self._hooks.wal is not None:
+            if _slot_creation.initial is slot:
+                self._hooks.wal.log_initial(self, slot, value, positions)
+            else:
+                self._hooks.wal.log(self, [(slot, value, positions)])
+        if self._pinned:
+            self._unpin()
         self.slot_values[slot] = value
-        self.slot_positions[slot] = set(
-            [position] if position is not None else []
-        )
+        self.slot_positions[slot] = positions
+        self.slot_versions[slot] = next(_versions)
+        if type(value) is MergeConflict:
+            self.conflicted_slots.add(slot)
+        elif self.conflicted_slots:
+            self.conflicted_slots.discard(slot)
+        if self._hooks.history is not None and self.parent is None:
+            self._hooks.history.record(
+                slot,
+                value,
+                self.slot_positions[slot],
+                self.slot_versions[slot],
+            )
+        if profiler is not None:
+            elapsed = timeit.default_timer() - start
+            profiler.record("write", slot.owner, elapsed, 1)
 
     def get_slot_value(self, slot):
-        # fast path: we already have a local version of this
-        if slot in self.slot_values:
-            return self.slot_values[slot]
-
-        current = self
-        value = Slot.NOT_KNOWN
-        while current is not None:
-            try:
-                value = current.slot_values[slot]
-                break
-            except KeyError:
-                current = current.parent
+        if self._pending:
+            self._materialize(slot)
+        profiler = self._hooks.profiler
+        if profiler is None:
+            # fast path: we already have a local version of this
+            if slot in self.slot_values:
+                return self.slot_values[slot]
+            return self._inherit_slot_value(slot)
+        return profiler.profile_read(self, slot)
+
+    def _inherit_slot_value(self, slot):
+        # Slow path of get_slot_value, for slots this state has no value
+        # for itself.
+        stats = self._hooks.stats
+        if stats is None:
+            value = self._find_slot_value(slot)
+        else:
+            value = stats.record_walk(self, slot)
 
         # If the slot has a fork function defined, fork the value before
         # we return it. This is important if e.g. the value is some sort
@@ -161,236 +742,2073 @@ class State(object):
         # state "sees" a different collection object rather than them
         # all modifying the same one.
         if value is not Slot.NOT_KNOWN and slot.fork is not None:
-            value = slot.fork(value)
+            if isinstance(slot.fork, CopyOnWrite):
+                proxy = slot.fork.proxy(self, slot, value)
+                if proxy is not None:
+                    return proxy
+            profiler = self._hooks.profiler
+            if stats is None and profiler is None:
+                value = slot.fork(value)
+            else:
+                start = timeit.default_timer()
+                value = slot.fork(value)
+                elapsed = timeit.default_timer() - start
+                if stats is not None:
+                    stats.record_fork(elapsed)
+                if profiler is not None:
+                    profiler.record("slot_fork", slot.owner, elapsed, 1)
+            if self._pinned:
+                self._unpin()
             self.slot_values[slot] = value
 
         return value
 
-    def get_slot_positions(self, slot):
+    def _find_slot_value(self, slot):
+        # Walk up the chain without forking, for callers that only
+        # inspect values rather than handing them out.
         current = self
         while current is not None:
+            if current._pending:
+                current._materialize(slot)
             try:
-                return current.slot_positions[slot]
+                return current.slot_values[slot]
             except KeyError:
-                current = self.parent
-            return set()
-
-
-def equality_merge(cases):
-    """
-    If all of the provided :py:class:`MergeCase` objects are equal, returns
-    the common value. Otherwise, returns a merge conflict describing all
-    of the different values.
-
-    This is the default implementation of `merge` on :py:class:`Slot`.
-    """
-    all_agreed = all(
-        cases[0].value == case.value
-        for case in cases
-    )
-    if all_agreed:
-        return cases[0].value
-    else:
-        # create a merge conflict so the caller can see all of
-        # the possibilities and either fail or choose one via
-        # an application-specific means.
-        return MergeConflict(cases)
-
-
-class Slot(object):
-    """
-    A container for a single value that can be changed transactionally.
+                current = current.parent
+        defaults = self.root._defaults
+        if defaults and slot in defaults:
+            return defaults.get(slot)
+        return Slot.NOT_KNOWN
 
-    During the lifetime of a slot's root its value depends on the
-    currently-active state. Once the root block terminates, the value
-    is baked into the object so that it can be used independently of the
-    root and its child states.
+    def get_slot_positions(self, slot):
+        # slot_positions is a defaultdict, so we must not index it directly
+        # or we'd insert an empty set that hides the parent's positions.
+        current = self
+        while current is not None:
+            if current._pending:
+                current._materialize(slot)
+            positions = current.slot_positions.get(slot)
+            if positions is not None:
+                return positions
+            current = current.parent
+        return set()
+
+    def get_slot_version(self, slot):
+        """
+        Return the version of the write that produced this state's view of
+        the given slot, or ``0`` if no state in the chain has written it.
 
-    A slot also has a set of "positions" associated with it. The `datafork`
-    module itself does not care what is in this set, but callers could use
-    this to keep track of where values are set in order to better understand
-    the possibilities in case of a merge conflict.
+        Any write to the slot in this state or one of its ancestors, whether
+        by :py:meth:`set_slot` or :py:meth:`merge_children`, changes the
+        result.
+        """
+        current = self
+        while current is not None:
+            if current._pending:
+                current._materialize(slot)
+            try:
+                return current.slot_versions[slot]
+            except KeyError:
+                current = current.parent
+        return 0
 
-    By default slot values compare and merge by equality, leading to a
-    merge conflict if the value of a slot differs between two states. The
-    parameter `merge` can be used to provide a different implementation of
-    performing the merge (takes a set of values and returns the merged
-    version, or a :py:class:`MergeConflict` if no resolution is possible.)
-    """
+    def diff(self, other):
+        """
+        Return a list of :py:class:`SlotChange` objects describing each slot
+        whose value differs between this state and `other`, which must
+        belong to the same root.
+
+        Each change gives this state's value and positions as the "old"
+        side and `other`'s as the "new" side. Only slots written in the
+        states between each of the two and their lowest common ancestor are
+        compared, so the cost is proportional to what has been written
+        since the two states diverged rather than to the size of the root.
+        """
+        if other.root is not self.root:
+            raise Exception(
+                "Can't diff %r with %r: different roots" % (self, other)
+            )
 
-    # we will compare by reference to this thing to detect the "don't know"
-    # case.
-    NOT_KNOWN = type("not_known", (object,), {
-        "__repr__": lambda self: "datafork.Slot.NOT_KNOWN"
-    })()
+        def depth(state):
+            result = 0
+            while state.parent is not None:
+                state = state.parent
+                result += 1
+            return result
 
-    def __init__(
-        self,
-        root,
-        owner=None,
-        initial_value=NOT_KNOWN,
-        merge=equality_merge,
-        fork=None,
-    ):
-        self.owner = owner
-        self.root = root
-        self.merge = merge
-        self.fork = fork
-        self.set_value(
-            initial_value,
-        )
+        self._materialize_all()
+        other._materialize_all()
+        slots = set()
+        mine, theirs = self, other
+        my_depth, their_depth = depth(mine), depth(theirs)
+        while my_depth > their_depth:
+            slots.update(mine.slot_values)
+            mine = mine.parent
+            my_depth -= 1
+        while their_depth > my_depth:
+            slots.update(theirs.slot_values)
+            theirs = theirs.parent
+            their_depth -= 1
+        while mine is not theirs:
+            slots.update(mine.slot_values)
+            slots.update(theirs.slot_values)
+            mine = mine.parent
+            theirs = theirs.parent
+
+        changes = []
+        for slot in slots:
+            old_value = self._find_slot_value(slot)
+            new_value = other._find_slot_value(slot)
+            if old_value is new_value or old_value == new_value:
+                continue
+            changes.append(
+                SlotChange(
+                    slot,
+                    old_value,
+                    new_value,
+                    self.get_slot_positions(slot),
+                    other.get_slot_positions(slot),
+                )
+            )
+        return changes
 
-    @property
-    def value(self):
+    def conflicts(self, owner=None):
         """
-        The slot's current value.
-
-        This can be assigned as long as the slot's root is still alive, in
-        which case the new value applies to the currently-active state.
-        Once the root scope exits, the value is baked into the slot and
-        becomes unchangable.
+        Return a dictionary mapping each slot that is in the merge conflict
+        state, as seen from this state, to its :py:class:`MergeConflict`.
 
-        If this attribute is accessed when the value is not known, the
-        :py:class:`ValueNotKnownError` exception will be raised. If the
-        value is not known because this slot is currently in a merge conflict
-        state, the more-specific :py:class:`ValueAmbiguousError` will be
-        raised.
+        If `owner` is given, only slots with that :py:attr:`Slot.owner` are
+        included. Each state keeps an index of its own conflicted slots, so
+        this costs time proportional to the number of conflicts rather than
+        the number of slots.
         """
-        try:
-            return Slot.prepare_return_value(
-                self,
-                self.final_value,
-            )
-        except AttributeError:
-            return Slot.prepare_return_value(
+        self._materialize_all()
+        candidates = set()
+        current = self
+        while current is not None:
+            candidates.update(current.conflicted_slots)
+            current = current.parent
+
+        result = {}
+        for slot in candidates:
+            if owner is not None and slot.owner != owner:
+                continue
+            # A conflict in an ancestor may be hidden by a closer value.
+            value = self._find_slot_value(slot)
+            if type(value) is MergeConflict:
+                result[slot] = value
+        return result
+
+    def resolve_conflicts(self, resolver, owner=None):
+        """
+        Resolve merge conflicts in bulk, writing the results into this
+        state.
+
+        `resolver` is called as ``resolver(slot, conflict)`` for each slot
+        returned by :py:meth:`conflicts` (limited to `owner`, if given) and
+        returns the value to use, or the conflict itself to leave the slot
+        unresolved. Each resolved slot takes the positions of all of the
+        conflict's possibilities. Returns the dictionary of resolved values.
+        """
+        resolved = {}
+        for slot, conflict in self.conflicts(owner).iteritems():
+            value = resolver(slot, conflict)
+            if value is not conflict:
+                positions = set()
+                for possible in conflict.possibilities:
+                    positions.update(possible.positions)
+                resolved[slot] = (value, positions)
+
+        if resolved and self.parent is None and self._hooks.wal is not None:
+            self._hooks.wal.log(
                 self,
-                self.root.current_state.get_slot_value(self),
+                [
+                    (slot, value, positions)
+                    for slot, (value, positions) in resolved.iteritems()
+                ],
             )
+        if resolved and self._pinned:
+            self._unpin()
+        for slot, (value, positions) in resolved.iteritems():
+            self.slot_values[slot] = value
+            self.slot_positions[slot] = positions
+            self.slot_versions[slot] = next(_versions)
+            if type(value) is MergeConflict:
+                self.conflicted_slots.add(slot)
+            else:
+                self.conflicted_slots.discard(slot)
+            if self._hooks.history is not None and self.parent is None:
+                self._hooks.history.record(
+                    slot, value, positions, self.slot_versions[slot],
+                )
+        return {
+            slot: value for slot, (value, positions) in resolved.iteritems()
+        }
 
-    @property
-    def positions(self):
+    def spill(self, path):
         """
-        The current :py:class:`set` of positions for this slot. There will
-        most be zero or one members of this set, but there can be more
-        after data states have been merged.
+        Move this state's own slot values and positions out of memory into
+        the append-only spill file at `path`, shared by all states of the
+        root that spill to the same path.
+
+        Afterwards the state keeps only an index of record offsets keyed by
+        :py:attr:`Slot.slot_id`, and values are read back lazily from a
+        memory map of the file when first accessed, with the same type
+        they had when spilled. Read-only views such as
+        :py:class:`memoryview` are returned as zero-copy read-only views of
+        the file, while byte strings, :py:class:`bytearray`,
+        :py:class:`array.array` and NumPy array values are copied out of
+        it. The state can
+        still be written and merged into as normal, with new values held in
+        memory until the state is spilled again.
+
+        Only slots created by :py:meth:`Root.slot` have stable ids, so only
+        those can be spilled.
         """
-        try:
-            return self.final_positions
-        except AttributeError:
-            return self.root.current_state.get_slot_positions(self)
+        from datafork.storage import spill_state
+        self._materialize_all()
+        spill_state(self, self.root._spill_file(path))
 
-    @value.setter
-    def value(self, value):
-        self.set_value(value)
+    def publish(self, directory=None):
+        """
+        Publish the slot values visible from this state for reading by
+        other processes, returning a
+        :py:class:`datafork.storage.SharedLayer`.
+
+        The values are written in the :py:meth:`spill` format to a file in
+        `directory`, defaulting to a RAM-backed filesystem where available,
+        so attaching processes map the same pages rather than each
+        receiving a pickled copy of the whole state. Workers call
+        :py:func:`datafork.storage.attach` with the layer's ``path`` to get
+        a read-only view, and can send their writes back as the result of
+        :py:meth:`export_changes` to be applied with
+        :py:meth:`apply_changes`.
+
+        A worker only decodes the values it reads. Byte strings,
+        :py:class:`bytearray`, :py:class:`array.array` and read-only views
+        such as :py:class:`memoryview` are handed back as read-only views
+        of the shared pages, and NumPy arrays as read-only arrays over
+        them, without copying; other values are unpickled when first read.
+        Publishing reads this state's layers in place, without pinning
+        them as :py:meth:`snapshot` does, so they must not be written
+        until it returns.
+
+        Only slots created by :py:meth:`Root.slot` can be published.
+        """
+        from datafork.storage import publish_state
+        return publish_state(self, directory)
 
-    def set_value(self, value, position=None):
+    def export_changes(self):
         """
-        Set the slot's value and provide an optional position.
+        Return this state's own slot values and positions as a dictionary
+        mapping each slot's :py:attr:`Slot.slot_id` to a
+        ``(value, positions)`` pair, suitable for pickling and passing to
+        :py:meth:`apply_changes` in another process.
 
-        This is equivalent to assigning to :py:attr:`value` but provides
-        the extra optional parameter for setting the position for the new
-        value.
+        Buffer views read from a published or spilled layer are converted
+        to byte strings so that they can be pickled.
         """
-        if hasattr(self, "final_value"):
-            # should never happen
-            raise Exception(
-                "Can't set value on slot %r: it has been finalized" % self,
-            )
-        else:
-            self.root.current_state.set_slot(
-                self,
-                value,
-                position=position,
+        from datafork.storage import VIEW_TYPES
+        self._materialize_all()
+        changes = {}
+        for slot in self.slot_values:
+            value = self.slot_values[slot]
+            if isinstance(value, VIEW_TYPES):
+                value = bytes(value)
+            changes[slot.slot_id] = (
+                value, set(self.slot_positions.get(slot, ())),
             )
+        return changes
 
-    def set_value_not_known(self, position=None):
+    def apply_changes(self, changes, owner=None):
         """
-        Mark this slot has having an unknown value.
-
-        When a slot's value is not known, attempts to read the value
-        will result in a :py:class:`ValueNotKnownError` exception.
+        Merge changes returned by :py:meth:`export_changes`, applying them
+        to a new child state that is then merged into this one as if by
+        :py:meth:`merge_children`.
         """
-        self.set_value(Slot.NOT_KNOWN, position=position)
+        child = self._create_child(owner)
+        for slot_id, (value, positions) in changes.iteritems():
+            slot = self.root.slot_by_id(slot_id)
+            child.slot_values[slot] = value
+            child.slot_positions[slot] = set(positions)
+            child.slot_versions[slot] = next(_versions)
+        self.merge_children([child])
+
+    def snapshot(self):
+        """
+        Return a :py:class:`Snapshot` of the slot values currently visible
+        from this state.
+
+        Taking a snapshot does not copy any values: it pins the storage of
+        this state and each of its ancestors, so it costs time proportional
+        to the nesting depth rather than to the number of slots. The first
+        subsequent write to a pinned state copies that state's own storage
+        before modifying it, so the snapshot never changes and can be read
+        from any thread without locking.
+        """
+        self._materialize_all()
+        layers = []
+        current = self
+        while current is not None:
+            current._pinned = True
+            layers.append((current.slot_values, current.slot_positions))
+            current = current.parent
+        return Snapshot(layers, self.root._defaults)
+
+    def _unpin(self):
+        self.slot_values = self.slot_values.copy()
+        self.slot_positions = self.slot_positions.copy()
+        self._pinned = False
+
+    def _abandon(self):
+        # Record that this state was thrown away without being merged.
+        if not self._finished:
+            self._finished = True
+            if self._hooks.stats is not None:
+                self._hooks.stats.states_discarded += 1
+
+    def discard(self):
+        """
+        Release this state's values and positions immediately, rather than
+        whenever the state is garbage collected, and make it unusable.
+
+        Any later attempt to read or write through this state, or through
+        a descendant of it, raises an exception. Storage still shared with
+        a :py:class:`Snapshot` is left for the snapshot. The root and the
+        states in the current state's chain cannot be discarded. If this
+        state is still waiting in a lazy merge into its parent, that merge
+        is completed first.
+        """
+        parent = self.parent
+        if parent is None:
+            raise Exception("Can't discard %r: it is a root" % self)
+        current = self.root.current_state
+        while current is not None:
+            if current is self:
+                raise Exception("Can't discard %r: it is active" % self)
+            current = current.parent
+        for merge in list(parent._pending):
+            if any(state is self for state in merge.states):
+                for slot in list(merge.slots):
+                    parent._materialize(slot)
+        self._abandon()
+        if not self._pinned:
+            for storage in (self.slot_values, self.slot_positions):
+                if isinstance(storage, dict):
+                    storage.clear()
+        self.slot_values = _DISCARDED
+        self.slot_positions = _DISCARDED
+        self.slot_versions = _DISCARDED
+        self.conflicted_slots = set()
+        self._pending = []
+        self.discarded = True
+
+
+class Snapshot(object):
+    """
+    An immutable view of the slot values that were visible from a state
+    at the moment :py:meth:`State.snapshot` was called.
+
+    A snapshot behaves like a read-only mapping from slots to their values.
+    Indexing it behaves like reading :py:attr:`Slot.value`, raising
+    :py:class:`ValueNotKnownError` or :py:class:`ValueAmbiguousError` as
+    appropriate, while iterating it yields each slot that has a value in
+    any layer.
+
+    Values are shared with the states they came from rather than copied,
+    so mutable values must be treated as read-only. Slots allocated by
+    :py:meth:`Root.allocate_slots` read as their defaults if no layer has a
+    value for them, but are not included when iterating.
+    """
 
-    @property
-    def value_is_known(self):
+    def __init__(self, layers, defaults=None):
+        self._layers = tuple(layers)
+        self._defaults = defaults
+
+    def get_slot_value(self, slot):
         """
-        ``True`` if this slot's value is presently known, or
-        ``False`` if not.
+        Return the raw value of the given slot, which may be
+        :py:attr:`Slot.NOT_KNOWN` or a :py:class:`MergeConflict`.
+        """
+        for values, positions in self._layers:
+            try:
+                return values[slot]
+            except KeyError:
+                pass
+        if self._defaults and slot in self._defaults:
+            return self._defaults.get(slot)
+        return Slot.NOT_KNOWN
 
-        A slot's value might be unknown if it has never been assigned, if it
-        has been explicitly declared as unknown, or if the slot is currently
-        in a merge conflict state.
+    def get_slot_positions(self, slot):
+        for values, positions in self._layers:
+            if slot in values:
+                return positions.get(slot, set())
+        return set()
+
+    def __getitem__(self, slot):
+        return Slot.prepare_return_value(slot, self.get_slot_value(slot))
+
+    def __contains__(self, slot):
+        for values, positions in self._layers:
+            if slot in values:
+                return True
+        return False
+
+    def __iter__(self):
+        seen = set()
+        for values, positions in self._layers:
+            for slot in values:
+                if slot not in seen:
+                    seen.add(slot)
+                    yield slot
+
+    def __len__(self):
+        return sum(1 for slot in self)
+
+    def iteritems(self):
         """
-        try:
-            value = self.value
-        except ValueNotKnownError:
-            return False
-        else:
-            return True
+        Iterate over ``(slot, value)`` pairs for every slot in the snapshot,
+        yielding raw values as :py:meth:`get_slot_value` does.
+        """
+        seen = set()
+        for values, positions in self._layers:
+            for slot, value in values.iteritems():
+                if slot not in seen:
+                    seen.add(slot)
+                    yield slot, value
 
-    def finalize(self):
-        if not hasattr(self, "final_value"):
-            self.final_value = self.root.current_state.get_slot_value(self)
-        if not hasattr(self, "final_positions"):
-            self.final_positions = self.root.current_state.get_slot_positions(self)
-        # sever the connection from the slot to the root so that
+    def __repr__(self):
+        return "<datafork.Snapshot of %i layers>" % len(self._layers)
+
+
+class BatchMerge(object):
+    """
+    Wraps a function that merges many slots in one call, for use as the
+    `merge` of a :py:class:`Slot`.
+
+    When :py:meth:`State.merge_children` merges slots that share the same
+    :py:class:`BatchMerge` object, `func` is called once for all of them
+    with a :py:class:`MergeBatch` holding their values in columns, rather
+    than once per slot with a list of :py:class:`MergePossibility`
+    objects. It must return a sequence with one merged value per slot of
+    the batch, in order, using :py:attr:`MergeBatch.CONFLICT` for each slot
+    that cannot be merged. A :py:class:`MergeConflict` may also be
+    returned directly.
+
+    Where slots are merged one at a time, such as by lazy and streaming
+    merges, `func` receives a batch of one slot. Calling the object
+    directly with a list of possibilities, as with any other merge
+    function, also works, with ``None`` as the batch's only slot.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, cases):
+        batch = MergeBatch.from_possibilities([None], [cases])
+        merged = self.func(batch)[0]
+        if merged is MergeBatch.CONFLICT:
+            merged = MergeConflict(batch.cases(0))
+        return merged
+
+    def __repr__(self):
+        return "<datafork.BatchMerge %r>" % (self.func,)
+
+
+class MergeBatch(object):
+    """
+    The values of a group of slots being merged, passed to the function
+    of a :py:class:`BatchMerge`.
+
+    The values for all slots are held in flat columns, with
+    :py:attr:`offsets` giving each slot's range: the values for
+    ``slots[i]`` are ``values[offsets[i]:offsets[i + 1]]``. This allows
+    the columns to be handed to e.g. :py:func:`numpy.asarray` and
+    :py:func:`numpy.add.reduceat` without any per-slot Python calls.
+    """
+
+    #: Returned by a batch merge function in place of a slot's merged
+    #: value to report a merge conflict for that slot.
+    CONFLICT = type("conflict", (object,), {
+        "__repr__": lambda self: "datafork.MergeBatch.CONFLICT"
+    })()
+
+    def __init__(self, slots):
+        #: The slots being merged.
+        self.slots = slots
+        #: Every slot's candidate values, one slot after another.
+        self.values = []
+        #: For each value, the index of the state it came from in the list
+        #: of states being merged, or where that isn't known, as in lazy
+        #: and streaming merges, the value's index within its slot.
+        self.states = array.array("l")
+        #: For each value, its set of positions.
+        self.positions = []
+        #: The start of each slot's values, followed by the total number of
+        #: values.
+        self.offsets = array.array("L", [0])
+
+    @classmethod
+    def from_states(cls, slots, states, parent):
+        batch = cls(slots)
+        values = batch.values
+        indexes = batch.states
+        positions = batch.positions
+        offsets = batch.offsets
+        # Take each state's own values and positions for all of the slots
+        # at once, noting the slots that need more than that: those the
+        # state didn't write itself, whose value must be looked up in its
+        # ancestors, and conflicts and proxies, which must be unwrapped.
+        value_columns = []
+        position_columns = []
+        slow = set()
+        for state in states:
+            if state._pending:
+                # Lazy merges into the state may still change any slot.
+                slow.update(xrange(len(slots)))
+                own_values = own_positions = {}
+            else:
+                own_values = state.slot_values
+                own_positions = state.slot_positions
+            get = own_values.get
+            column = [get(slot, _MISSING) for slot in slots]
+            value_columns.append(column)
+            slow.update(
+                i for i, value in enumerate(column)
+                if value is _MISSING or type(value) in _UNWRAPPED_TYPES
+            )
+            get = own_positions.get
+            column = [get(slot) for slot in slots]
+            position_columns.append(column)
+            slow.update(
+                i for i, value in enumerate(column) if value is None
+            )
+
+        state_indexes = array.array("l", xrange(len(states)))
+        for i, (slot, row, position_row) in enumerate(itertools.izip(
+            slots,
+            itertools.izip(*value_columns),
+            itertools.izip(*position_columns),
+        )):
+            if i not in slow:
+                values.extend(row)
+                indexes.extend(state_indexes)
+                positions.extend(position_row)
+                offsets.append(len(values))
+                continue
+            for index, state in enumerate(states):
+                value = parent._merge_input(state, slot)
+                if isinstance(value, MergeConflict):
+                    # Flattened as for merge_children.
+                    for possible in value.possibilities:
+                        values.append(possible.value)
+                        indexes.append(index)
+                        positions.append(possible.positions)
+                else:
+                    values.append(value)
+                    indexes.append(index)
+                    positions.append(state.get_slot_positions(slot))
+            offsets.append(len(values))
+        return batch
+
+    @classmethod
+    def from_possibilities(cls, slots, possibles_lists):
+        # For merges that have already built MergePossibility lists, which
+        # don't record where each came from.
+        batch = cls(slots)
+        for possibles in possibles_lists:
+            for index, possible in enumerate(possibles):
+                batch.values.append(possible.value)
+                batch.states.append(index)
+                batch.positions.append(possible.positions)
+            batch.offsets.append(len(batch.values))
+        return batch
+
+    def cases(self, i):
+        """
+        Return the values of ``slots[i]`` as a list of
+        :py:class:`MergePossibility` objects, as they would be passed to an
+        ordinary merge function.
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return [
+            MergePossibility(value, positions)
+            for value, positions in zip(
+                self.values[start:end], self.positions[start:end],
+            )
+        ]
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __repr__(self):
+        return "<datafork.MergeBatch of %i slots>" % len(self.slots)
+
+
+class MergePlan(object):
+    """
+    The result of a merge, worked out by :py:meth:`State.plan_merge`
+    without changing the state being merged into.
+    """
+
+    #: ``True`` once :py:meth:`apply` has been called.
+    applied = False
+
+    def __init__(self, state, results, conflict_count, complete):
+        #: The state that the plan merges into.
+        self.state = state
+        #: The number of slots that would be in conflict.
+        self.conflict_count = conflict_count
+        #: ``False`` if planning stopped at the first conflict, in which
+        #: case the plan only covers some of the slots and cannot be
+        #: applied.
+        self.complete = complete
+        # (slot, merged value, positions) for each slot.
+        self._results = results
+        self._base_versions = None
+        self._elapsed = 0.0
+        # The root's write-ahead log record, if it was encoded in advance.
+        self._wal_record = None
+
+    @property
+    def values(self):
+        """
+        A dictionary mapping each slot to its merged value, which may be
+        a :py:class:`MergeConflict`.
+        """
+        return {slot: merged for slot, merged, positions in self._results}
+
+    @property
+    def conflicts(self):
+        """
+        A dictionary mapping each slot that would be in conflict to its
+        :py:class:`MergeConflict`.
+        """
+        return {
+            slot: merged for slot, merged, positions in self._results
+            if type(merged) is MergeConflict
+        }
+
+    def positions(self, slot):
+        """
+        Return the set of positions that `slot` would have.
+        """
+        for result_slot, merged, positions in self._results:
+            if result_slot is slot:
+                return positions
+        raise KeyError(slot)
+
+    def changed(self):
+        """
+        Return the set of slots whose value would differ from their
+        current value in :py:attr:`state`.
+        """
+        changed = set()
+        for slot, merged, positions in self._results:
+            current = self.state._find_slot_value(slot)
+            if not (current is merged or current == merged):
+                changed.add(slot)
+        return changed
+
+    def apply(self):
+        """
+        Write the planned values into :py:attr:`state` in a single update,
+        as :py:meth:`State.merge_children` would have.
+
+        Raises an exception without changing anything if the plan is
+        incomplete or has already been applied, or if any of its slots
+        have been written in the state since it was planned.
+        """
+        self.state._apply_plan(self)
+
+    def __repr__(self):
+        return "<datafork.MergePlan of %i slots into %r>" % (
+            len(self._results), self.state,
+        )
+
+
+class MergeStream(object):
+    """
+    Folds child states into a running summary for a single merge into
+    their parent, created by :py:meth:`State.merge_stream`.
+
+    Each child passed to :py:meth:`add` contributes its values for the
+    slots it wrote and is not referenced afterwards. For slots using the
+    default :py:func:`equality_merge`, equal values from different children
+    are combined into one :py:class:`MergePossibility` holding all of their
+    positions, so the summary grows with the number of distinct values
+    rather than with the number of children. Slots with a custom `merge`
+    keep one possibility per child, as that function may depend on them.
+
+    Nothing is written to the parent until :py:meth:`commit` is called.
+    """
+
+    def __init__(self, state, or_none=False):
+        #: The state that the children will be merged into.
+        self.state = state
+        self.or_none = or_none
+        #: Number of children added so far.
+        self.count = 0
+        # Maps each slot written by any child to a list of its merge
+        # possibilities and the number of children that wrote it.
+        self._slots = {}
+
+    def add(self, child):
+        """
+        Fold the values written in `child`, which must be a child of
+        :py:attr:`state`, into the merge.
+        """
+        if self._slots is None:
+            raise Exception(
+                "Can't add %r to %r: already committed" % (child, self)
+            )
+        if child.parent is not self.state:
+            raise Exception(
+                "Can't merge %r into %r: not a child" % (child, self.state)
+            )
+        child._finished = True
+        slots = set(child.slot_values)
+        for merge in child._pending:
+            slots.update(merge.slots)
+        for slot in slots:
+            entry = self._slots.get(slot)
+            if entry is None:
+                entry = self._slots[slot] = [[], 0]
+            self._fold(
+                slot,
+                entry[0],
+                self.state._merge_input(child, slot),
+                child.get_slot_positions(slot),
+            )
+            entry[1] += 1
+        self.count += 1
+
+    @staticmethod
+    def _fold(slot, possibles, value, positions):
+        if type(value) is MergeConflict:
+            for possible in value.possibilities:
+                MergeStream._fold(
+                    slot, possibles, possible.value, possible.positions,
+                )
+            return
+        if slot.merge is equality_merge:
+            for possible in possibles:
+                if possible.value is value or possible.value == value:
+                    possible.positions.update(positions)
+                    return
+            positions = set(positions)
+        possibles.append(MergePossibility(value, positions))
+
+    def commit(self):
+        """
+        Merge everything that has been added into :py:attr:`state`.
+
+        As with :py:meth:`State.merge_children`, each child that did not
+        write a slot written by another child contributes the parent's
+        value for that slot.
+        """
+        if self._slots is None:
+            raise Exception("Can't commit %r: already committed" % self)
+        state = self.state
+        slots, self._slots = self._slots, None
+
+        def possibilities(slot):
+            possibles, written = slots[slot]
+            fallbacks = self.count - written
+            if self.or_none:
+                fallbacks += 1
+            if fallbacks:
+                value = state._merge_input(state, slot)
+                positions = state.get_slot_positions(slot)
+                if slot.merge is equality_merge:
+                    fallbacks = 1
+                for i in range(fallbacks):
+                    self._fold(slot, possibles, value, positions)
+            return possibles
+
+        state._merge_slots(list(slots), possibilities)
+
+    def __repr__(self):
+        return "<datafork.MergeStream of %i children into %r>" % (
+            self.count, self.state,
+        )
+
+
+class OptimisticState(State):
+    """
+    A child state that records the version of each slot it reads from its
+    base state, so that it can later tell whether it is still safe to
+    commit.
+
+    These are created by :py:meth:`State.atomically`; there is usually no
+    need to instantiate them directly. Any child state forked from an
+    optimistic state is itself optimistic and shares its read set, so reads
+    made in nested blocks are validated too.
+    """
+
+    def __init__(self, root, parent=None, owner=None, base=None,
+                 read_versions=None):
+        State.__init__(self, root, parent, owner)
+        #: The state that this transaction will be committed into.
+        self.base = base if base is not None else parent
+        #: Maps each slot read from :py:attr:`base` to the version that
+        #: was seen.
+        self.read_versions = (
+            read_versions if read_versions is not None else {}
+        )
+
+    def _create_child(self, owner=None):
+        return OptimisticState(
+            self.root, self, owner, self.base, self.read_versions,
+        )
+
+    def _record_read(self, slot):
+        current = self
+        while current is not self.base:
+            if slot in current.slot_values:
+                # written within the transaction, so not a read from base.
+                return
+            current = current.parent
+        if slot not in self.read_versions:
+            self.read_versions[slot] = self.base.get_slot_version(slot)
+
+    def get_slot_value(self, slot):
+        # The version is recorded before the value is fetched: if a commit
+        # sneaks in between, we hold the old version and will fail
+        # validation rather than committing a stale read.
+        if slot not in self.slot_values:
+            self._record_read(slot)
+        return State.get_slot_value(self, slot)
+
+    def get_slot_positions(self, slot):
+        self._record_read(slot)
+        return State.get_slot_positions(self, slot)
+
+    def validate(self):
+        """
+        Check the read set against the base state.
+
+        Returns ``None`` if every slot read still has the version that was
+        seen, or otherwise the first slot found to have changed.
+        """
+        base = self.base
+        for slot, version in self.read_versions.iteritems():
+            if base.get_slot_version(slot) != version:
+                return slot
+        return None
+
+
+class ContentionStats(object):
+    """
+    Counters describing how optimistic transactions on a root have fared.
+
+    Available as :py:attr:`Root.contention`. All updates happen under the
+    root's commit lock.
+    """
+
+    #: Number of transactions that committed.
+    commits = 0
+    #: Number of transaction attempts that failed validation.
+    conflicts = 0
+    #: Largest number of retries needed by any committed transaction.
+    max_retries = 0
+
+    def __init__(self):
+        #: :py:class:`collections.Counter` of the slots that caused
+        #: validation failures.
+        self.conflicts_by_slot = collections.Counter()
+
+    def record_commit(self, retries):
+        self.commits += 1
+        if retries > self.max_retries:
+            self.max_retries = retries
+
+    def record_conflict(self, slot):
+        self.conflicts += 1
+        self.conflicts_by_slot[slot] += 1
+
+    def reset(self):
+        self.commits = 0
+        self.conflicts = 0
+        self.max_retries = 0
+        self.conflicts_by_slot.clear()
+
+    def __repr__(self):
+        return "<ContentionStats commits=%r conflicts=%r max_retries=%r>" % (
+            self.commits, self.conflicts, self.max_retries,
+        )
+
+
+def equality_merge(cases):
+    """
+    If all of the provided :py:class:`MergeCase` objects are equal, returns
+    the common value. Otherwise, returns a merge conflict describing all
+    of the different values.
+
+    This is the default implementation of `merge` on :py:class:`Slot`.
+    """
+    first = cases[0].value
+    # Identity is checked first since it is cheap and, with interned
+    # values, is usually enough.
+    all_agreed = all(
+        first is case.value or first == case.value
+        for case in cases
+    )
+    if all_agreed:
+        return first
+    else:
+        # create a merge conflict so the caller can see all of
+        # the possibilities and either fail or choose one via
+        # an application-specific means.
+        return MergeConflict(cases)
+
+
+class CopyOnWrite(object):
+    """
+    Wraps a slot's `fork` function so that the copy is only made when a
+    child state first modifies the value, rather than when it first reads
+    it.
+
+    A child state that reads a value from one of its ancestors receives a
+    lightweight proxy for it. Non-modifying operations on the proxy read
+    through to the ancestor's object. The first modifying operation calls
+    `fork` to make a private copy, stores it as the slot's value in the
+    child state and applies the operation to it. A child that only reads a
+    slot therefore never copies it and leaves nothing behind to merge,
+    although merging it next to a sibling that wrote the slot copies the
+    value if the parent doesn't hold it itself, as the parent then needs
+    a value of its own.
+
+    Proxies are provided for :py:class:`list`, :py:class:`dict` and
+    :py:class:`set`, and other types can be added with :py:meth:`register`.
+    Values of any other type are forked as soon as they are read, as
+    usual. Proxies are not instances of the proxied type, and since they
+    are not stored in the state, each read returns a new proxy that walks
+    the chain of states again. A proxy always refers to the slot's value
+    in the state it was read from.
+
+    .. code-block:: python
+
+        slot = root.slot(initial_value=[], fork=datafork.CopyOnWrite(list))
+    """
+
+    # Maps each registered value type to its proxy class.
+    _proxy_types = {}
+
+    def __init__(self, fork):
+        self.fork = fork
+
+    def __call__(self, value):
+        return self.fork(value)
+
+    @classmethod
+    def register(cls, value_type, mutators, readers=()):
+        """
+        Provide copy-on-write proxies for values of `value_type`.
+
+        `mutators` names each method that may modify the value, and
+        `readers` each special method (such as ``__len__``) that the proxy
+        must forward to the value without copying it. Other attributes are
+        looked up on the value being read through to, so every method that
+        can modify the value must be listed in `mutators`.
+        """
+        # Proxies are unhashable unless told otherwise, like the built-in
+        # mutable types.
+        methods = {"__slots__": (), "__hash__": None}
+        for name in readers:
+            methods[name] = _proxy_method(name, False)
+        for name in mutators:
+            methods[name] = _proxy_method(name, True)
+        cls._proxy_types[value_type] = type(
+            "%sProxy" % value_type.__name__.title(),
+            (_CopyOnWriteProxy,),
+            methods,
+        )
+
+    def proxy(self, state, slot, value):
+        # Returns None if there is no proxy for the value's type.
+        proxy_type = self._proxy_types.get(type(value))
+        if proxy_type is None:
+            return None
+        return proxy_type(state, slot, value)
+
+    def __repr__(self):
+        return "<datafork.CopyOnWrite %r>" % (self.fork,)
+
+
+class _CopyOnWriteProxy(object):
+    __slots__ = ("_state", "_slot", "_original")
+
+    def __init__(self, state, slot, original):
+        self._state = state
+        self._slot = slot
+        self._original = original
+
+    def _target(self):
+        values = self._state.slot_values
+        if self._slot in values:
+            return values[self._slot]
+        return self._original
+
+    def _writable(self):
+        state = self._state
+        slot = self._slot
+        if slot in state.slot_values:
+            return state.slot_values[slot]
+        stats = state._hooks.stats
+        profiler = state._hooks.profiler
+        if stats is None and profiler is None:
+            value = slot.fork(self._original)
+        else:
+            start = timeit.default_timer()
+            value = slot.fork(self._original)
+            elapsed = timeit.default_timer() - start
+            if stats is not None:
+                stats.record_fork(elapsed)
+            if profiler is not None:
+                profiler.record("slot_fork", slot.owner, elapsed, 1)
+        if state._pinned:
+            state._unpin()
+        state.slot_values[slot] = value
+        return value
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __repr__(self):
+        return repr(self._target())
+
+
+def _proxy_method(name, mutates):
+    if mutates:
+        def method(self, *args, **kwargs):
+            return getattr(self._writable(), name)(*args, **kwargs)
+    else:
+        def method(self, *args, **kwargs):
+            return getattr(self._target(), name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+_COMPARISONS = ("__eq__", "__ne__", "__lt__", "__le__", "__gt__", "__ge__")
+
+CopyOnWrite.register(
+    list,
+    mutators=(
+        "__setitem__", "__delitem__", "__setslice__", "__delslice__",
+        "__iadd__", "__imul__", "append", "extend", "insert", "pop",
+        "remove", "reverse", "sort",
+    ),
+    readers=_COMPARISONS + (
+        "__len__", "__iter__", "__reversed__", "__contains__",
+        "__getitem__", "__getslice__", "__add__", "__mul__", "__rmul__",
+    ),
+)
+CopyOnWrite.register(
+    dict,
+    mutators=(
+        "__setitem__", "__delitem__", "clear", "pop", "popitem",
+        "setdefault", "update",
+    ),
+    readers=_COMPARISONS + (
+        "__len__", "__iter__", "__contains__", "__getitem__",
+    ),
+)
+CopyOnWrite.register(
+    set,
+    mutators=(
+        "add", "discard", "remove", "pop", "clear", "update",
+        "intersection_update", "difference_update",
+        "symmetric_difference_update", "__ior__", "__iand__", "__isub__",
+        "__ixor__",
+    ),
+    readers=_COMPARISONS + (
+        "__len__", "__iter__", "__contains__", "__or__", "__and__",
+        "__sub__", "__xor__",
+    ),
+)
+
+
+class MergePolicy(object):
+    """
+    Base class for policies that resolve disagreements between states
+    during a merge, set with :py:meth:`Root.set_merge_policy`.
+
+    A policy only applies to slots using the default
+    :py:func:`equality_merge`. When every state agrees on a slot's value
+    the policy is not consulted and nothing is allocated for the slot.
+    Otherwise :py:meth:`choose` picks the state whose value wins, and the
+    merged slot takes the positions of every state as usual.
+
+    Policies apply to :py:meth:`State.merge_children`, including lazy
+    merges, but not to :py:class:`MergeStream`, which does not keep the
+    states it merges.
+    """
+
+    def choose(self, parent, slot, states):
+        """
+        Return the member of `states` whose value for `slot` should be
+        merged into `parent`, or ``None`` to produce a
+        :py:class:`MergeConflict` as if there were no policy.
+
+        `states` are the children being merged, followed by `parent` itself
+        if the merge was made with `or_none`.
+        """
+        raise NotImplementedError()
+
+
+class LastWriterWins(MergePolicy):
+    """
+    Choose the value from the state that wrote the slot most recently,
+    according to :py:meth:`State.get_slot_version`.
+    """
+
+    def choose(self, parent, slot, states):
+        return max(states, key=lambda state: state.get_slot_version(slot))
+
+
+class PreferParent(MergePolicy):
+    """
+    Keep the value the parent state had before the merge.
+    """
+
+    def choose(self, parent, slot, states):
+        return parent
+
+
+class OwnerPriority(MergePolicy):
+    """
+    Choose the value from the state with the highest-priority
+    :py:attr:`State.owner` among those that wrote the slot, where `owners`
+    lists owners from highest priority to lowest and any other owner comes
+    last. A conflict results if states of the same priority disagree.
+    """
+
+    def __init__(self, owners):
+        self.owners = list(owners)
+        self._ranks = {
+            _owner_key(owner): i for i, owner in enumerate(self.owners)
+        }
+
+    def choose(self, parent, slot, states):
+        lowest = len(self.owners)
+        best = None
+        best_rank = None
+        for state in states:
+            if slot not in state.slot_values:
+                continue
+            rank = self._ranks.get(_owner_key(state.owner), lowest)
+            if best is None or rank < best_rank:
+                best, best_rank, tied = state, rank, False
+            elif rank == best_rank:
+                best_value = best.slot_values[slot]
+                value = state.slot_values[slot]
+                if not (value is best_value or value == best_value):
+                    tied = True
+        if best is None or tied:
+            return None
+        return best
+
+
+class Slot(object):
+    """
+    A container for a single value that can be changed transactionally.
+
+    During the lifetime of a slot's root its value depends on the
+    currently-active state. Once the root block terminates, the value
+    is baked into the object so that it can be used independently of the
+    root and its child states.
+
+    A slot also has a set of "positions" associated with it. The `datafork`
+    module itself does not care what is in this set, but callers could use
+    this to keep track of where values are set in order to better understand
+    the possibilities in case of a merge conflict.
+
+    By default slot values compare and merge by equality, leading to a
+    merge conflict if the value of a slot differs between two states. The
+    parameter `merge` can be used to provide a different implementation of
+    performing the merge (takes a set of values and returns the merged
+    version, or a :py:class:`MergeConflict` if no resolution is possible.)
+
+    If `intern` is set, values assigned to the slot are replaced by a
+    canonical equal value shared across the root; see
+    :py:meth:`Root.intern_value`.
+    """
+
+    #: The slot's stable id within its root, assigned by :py:meth:`Root.slot`.
+    #: Used to identify the slot in on-disk storage.
+    slot_id = None
+
+    # we will compare by reference to this thing to detect the "don't know"
+    # case.
+    NOT_KNOWN = type("not_known", (object,), {
+        "__repr__": lambda self: "datafork.Slot.NOT_KNOWN"
+    })()
+
+    def __init__(
+        self,
+        root,
+        owner=None,
+        initial_value=NOT_KNOWN,
+        merge=equality_merge,
+        fork=None,
+        intern=False,
+    ):
+        self.owner = owner
+        self.root = root
+        self.merge = merge
+        self.fork = fork
+        self.intern = intern
+        # Root._create_slot writes the initial value itself, once the slot
+        # is registered.
+        if _slot_creation.root is not root:
+            self.set_value(
+                initial_value,
+            )
+
+    @property
+    def value(self):
+        """
+        The slot's current value.
+
+        This can be assigned as long as the slot's root is still alive, in
+        which case the new value applies to the currently-active state.
+        Once the root scope exits, the value is baked into the slot and
+        becomes unchangable.
+
+        If this attribute is accessed when the value is not known, the
+        :py:class:`ValueNotKnownError` exception will be raised. If the
+        value is not known because this slot is currently in a merge conflict
+        state, the more-specific :py:class:`ValueAmbiguousError` will be
+        raised.
+        """
+        try:
+            return Slot.prepare_return_value(
+                self,
+                self.final_value,
+            )
+        except AttributeError:
+            return Slot.prepare_return_value(
+                self,
+                self.root.current_state.get_slot_value(self),
+            )
+
+    @property
+    def positions(self):
+        """
+        The current :py:class:`set` of positions for this slot. There will
+        most be zero or one members of this set, but there can be more
+        after data states have been merged.
+        """
+        try:
+            return self.final_positions
+        except AttributeError:
+            return self.root.current_state.get_slot_positions(self)
+
+    @value.setter
+    def value(self, value):
+        self.set_value(value)
+
+    def set_value(self, value, position=None):
+        """
+        Set the slot's value and provide an optional position.
+
+        This is equivalent to assigning to :py:attr:`value` but provides
+        the extra optional parameter for setting the position for the new
+        value.
+        """
+        if hasattr(self, "final_value"):
+            # should never happen
+            raise Exception(
+                "Can't set value on slot %r: it has been finalized" % self,
+            )
+        else:
+            if self.intern:
+                value = self.root.intern_value(value)
+            self.root.current_state.set_slot(
+                self,
+                value,
+                position=position,
+            )
+
+    def subscribe(self, callback):
+        """
+        Shorthand for calling :py:meth:`Root.subscribe` on this slot's root
+        with just this slot.
+        """
+        return self.root.subscribe(callback, [self])
+
+    def value_at(self, version):
+        """
+        Return the value that was committed to this slot's root state as of
+        the given version, as recorded by :py:meth:`Root.enable_history`.
+
+        Raises :py:class:`ValueNotKnownError` if the value at that version
+        is unknown or is no longer in the retained history, or
+        :py:class:`ValueAmbiguousError` if it was a merge conflict.
+        """
+        return self.root.as_of(version)[self]
+
+    def set_value_not_known(self, position=None):
+        """
+        Mark this slot has having an unknown value.
+
+        When a slot's value is not known, attempts to read the value
+        will result in a :py:class:`ValueNotKnownError` exception.
+        """
+        self.set_value(Slot.NOT_KNOWN, position=position)
+
+    @property
+    def value_is_known(self):
+        """
+        ``True`` if this slot's value is presently known, or
+        ``False`` if not.
+
+        A slot's value might be unknown if it has never been assigned, if it
+        has been explicitly declared as unknown, or if the slot is currently
+        in a merge conflict state.
+        """
+        try:
+            value = self.value
+        except ValueNotKnownError:
+            return False
+        else:
+            return True
+
+    def finalize(self):
+        if not hasattr(self, "final_value"):
+            self.final_value = self.root.current_state.get_slot_value(self)
+        if not hasattr(self, "final_positions"):
+            self.final_positions = self.root.current_state.get_slot_positions(self)
+        # sever the connection from the slot to the root so that
         # the root can be garbage collected after the with block exits.
         # The slot doesn't need the root anymore.
         if hasattr(self, "root"):
             del self.root
 
-    @classmethod
-    def prepare_return_value(cls, slot, value):
-        if type(value) is MergeConflict:
-            raise ValueAmbiguousError(slot, value)
-        elif value is cls.NOT_KNOWN:
-            raise ValueNotKnownError(slot)
-        else:
-            return value
+    @classmethod
+    def prepare_return_value(cls, slot, value):
+        if type(value) is MergeConflict:
+            raise ValueAmbiguousError(slot, value)
+        elif value is cls.NOT_KNOWN:
+            raise ValueNotKnownError(slot)
+        else:
+            return value
+
+
+class Root(State):
+    """
+    A root context that can be used to create slots.
+
+    :py:func:`root` is the public interface to create a root, and is intended
+    to be used in a ``with`` block. Once you've established a root context
+    you can create slots using the :py:meth:`slot` method.
+
+    A root is a special kind of :py:class:`State` and thus inherits the
+    state-management functions of that class.
+
+    If `intern_values` is set, every slot created by :py:meth:`slot`
+    interns its values unless told otherwise.
+    """
+    # Set by roots whose merges are committed elsewhere, which can't take
+    # part in a multi_transaction.
+    _remote = False
+
+    def __init__(self, root_owner=None, slot_type=Slot, intern_values=False):
+        State.__init__(self, self, None, root_owner)
+        self._thread = _ThreadState()
+        self._current_state = self
+        self.slot_type = slot_type
+        self.slots = set()
+        self._slots_by_owner = {}
+        self._next_slot_id = 0
+        self._slots_by_id = {}
+        # Owners of slots restored from a checkpoint whose Slot objects
+        # have not been needed yet, by slot id.
+        self._restored_owners = {}
+        self._defaults = _SlotDefaults()
+        self._spill_files = {}
+        self._checkpoint = None
+        self.intern_values = intern_values
+        self._interned = {}
+        #: Lock held while an optimistic transaction validates and commits,
+        #: and while a lazy merge is completed. It is reentrant, since
+        #: committing may complete lazy merges.
+        self.commit_lock = threading.RLock()
+        #: :py:class:`ContentionStats` for optimistic transactions.
+        self.contention = ContentionStats()
+
+    @property
+    def current_state(self):
+        """
+        The currently-active state.
+
+        This is shared by all threads, except while a thread is running an
+        optimistic transaction (see :py:meth:`State.atomically`), in which
+        case that thread sees its own transaction state.
+        """
+        state = self._thread.state
+        return self._current_state if state is None else state
+
+    @current_state.setter
+    def current_state(self, state):
+        if self._thread.state is None:
+            self._current_state = state
+        else:
+            self._thread.state = state
+
+    def thread_state(self, state):
+        """
+        Returns a context manager that makes `state` the current state for
+        the calling thread only, without affecting other threads.
+        """
+        return _ThreadStateContext(self._thread, state)
+
+    def slot(
+        self,
+        owner=None,
+        initial_value=Slot.NOT_KNOWN,
+        **kwargs
+    ):
+        """
+        Creates a new :py:class:`Slot` in this root.
+
+        The slot's value will remain mutable for the lifetime of the root
+        context, and will be frozen upon its exit.
+        """
+        if self.intern_values:
+            kwargs.setdefault("intern", True)
+        return self._create_slot(
+            self._new_slot_id(owner),
+            owner,
+            initial_value,
+            **kwargs
+        )
+
+    def _create_slot(self, slot_id, owner, initial_value=_DEFERRED, **kwargs):
+        # Create and register a slot with the given id by calling
+        # slot_type, which may be any callable. The constructor is passed
+        # the initial value but told not to write it, through
+        # _slot_creation, and the write is made once the slot is
+        # registered, so that it can be logged. Without an initial value
+        # nothing is written, for slots whose value comes from elsewhere.
+        creating = _slot_creation.root
+        _slot_creation.root = self
+        try:
+            slot = self.slot_type(
+                self,
+                owner,
+                Slot.NOT_KNOWN if initial_value is _DEFERRED
+                else initial_value,
+                **kwargs
+            )
+        finally:
+            _slot_creation.root = creating
+        slot.slot_id = slot_id
+        self._register_slot(slot)
+        if initial_value is not _DEFERRED:
+            _slot_creation.initial = slot
+            try:
+                slot.set_value(initial_value)
+            finally:
+                _slot_creation.initial = None
+        return slot
+
+    def _new_slot_id(self, owner):
+        slot_id = self._next_slot_id
+        self._next_slot_id += 1
+        return slot_id
+
+    def allocate_slots(
+        self,
+        count,
+        owner=None,
+        default=Slot.NOT_KNOWN,
+        default_factory=None,
+        **kwargs
+    ):
+        """
+        Create `count` new slots in this root at once, returning them as a
+        list.
+
+        Unlike :py:meth:`slot`, nothing is written to any state: each slot
+        reads as `default` until it is first assigned. All of the slots
+        share a single entry in the root's table of defaults, which is
+        only consulted when no state in the chain has a value for a slot.
+        If `default_factory` is given instead, it is called with no
+        arguments the first time each slot's default is needed, and the
+        result is kept as that slot's default from then on. Mutable
+        defaults should be given as a factory, since a `default` value is
+        shared by every slot.
+
+        Any other keyword arguments are passed to each slot's constructor.
+        To checkpoint the root, `default` and `default_factory` must be
+        picklable.
+        """
+        if default_factory is not None and default is not Slot.NOT_KNOWN:
+            raise Exception(
+                "Can't allocate slots with both a default and a factory"
+            )
+        if self.intern_values:
+            kwargs.setdefault("intern", True)
+        first = self._next_slot_id
+        self._next_slot_id += count
+        self._defaults.add(first, first + count, default, default_factory)
+        return [
+            self._create_slot(slot_id, owner, **kwargs)
+            for slot_id in xrange(first, first + count)
+        ]
+
+    def set_merge_policy(self, policy, owners=None):
+        """
+        Use the given :py:class:`MergePolicy` when merging into any state
+        of this root, for slots whose :py:attr:`Slot.owner` is in `owners`,
+        or for all other slots if `owners` is not given. Passing ``None``
+        as the policy removes it.
+        """
+        hooks = self._hooks
+        if hooks.merge_policies is None:
+            hooks.merge_policies = {}
+        if owners is None:
+            hooks.merge_policy = policy
+        else:
+            for owner in owners:
+                if policy is None:
+                    hooks.merge_policies.pop(_owner_key(owner), None)
+                else:
+                    hooks.merge_policies[_owner_key(owner)] = policy
+        if hooks.merge_policy is None and not hooks.merge_policies:
+            hooks.merge_policies = None
+
+    def _register_slot(self, slot):
+        self._slots_by_id[slot.slot_id] = slot
+        self.slots.add(slot)
+        self._slots_by_owner.setdefault(
+            _owner_key(slot.owner), set(),
+        ).add(slot)
+
+    def slot_by_id(self, slot_id):
+        """
+        Return the slot in this root with the given :py:attr:`Slot.slot_id`.
+
+        Raises :py:class:`KeyError` if there is no such slot.
+        """
+        try:
+            return self._slots_by_id[slot_id]
+        except KeyError:
+            owner = self._restored_owners.pop(slot_id)
+        return self._create_slot(slot_id, owner)
+
+    def _slot_owners(self, first, end):
+        owners = {}
+        for slot_id in range(first, end):
+            if slot_id in self._slots_by_id:
+                owners[slot_id] = self._slots_by_id[slot_id].owner
+            elif slot_id in self._restored_owners:
+                owners[slot_id] = self._restored_owners[slot_id]
+        return owners
+
+    def _restore_slots(self, owners, next_slot_id):
+        self._restored_owners = dict(owners)
+        self._next_slot_id = next_slot_id
+
+    def checkpoint(self, path, incremental=False, include_states=False):
+        """
+        Save the values and positions of this root's slots, along with their
+        stable ids and owners, to the file at `path`.
+
+        Values are streamed into the file one record at a time, in the same
+        format used by :py:meth:`State.spill`. A full checkpoint is written
+        to a temporary file that then replaces `path`. If `incremental` is
+        set, this root's previous checkpoint must have been written to (or
+        restored from) `path`, and only the slots written in the root state
+        since then are appended to it, along with a small index.
+
+        Only values committed to the root state are saved, unless
+        `include_states` is set, in which case the chain of states from the
+        root to the current state is saved too.
+
+        If a write-ahead log is enabled, it is truncated to start from the
+        new checkpoint.
+        """
+        from datafork.storage import write_checkpoint
+        self.current_state._materialize_all()
+        write_checkpoint(self, path, incremental, include_states)
+        if self._hooks.wal is not None:
+            self._hooks.wal.reset(self, checkpoint=path)
+
+    @classmethod
+    def restore(cls, path, **kwargs):
+        """
+        Create a new root from a checkpoint written by :py:meth:`checkpoint`.
+
+        The checkpoint file is memory-mapped and values are only decoded
+        when read, and the slot objects themselves are only created when
+        first retrieved with :py:meth:`slot_by_id` or
+        :py:meth:`slots_by_owner`, so restoring costs time proportional to
+        the size of the checkpoint's index. If the checkpoint included
+        states, the restored root's current state is the restored
+        equivalent of the state that was current.
+
+        Slots are restored with the default `merge` and `fork` behavior;
+        any extra keyword arguments are passed to the root's constructor.
+        """
+        from datafork.storage import restore_checkpoint
+        return restore_checkpoint(cls, path, **kwargs)
+
+    def _spill_file(self, path):
+        from datafork.storage import SpillFile
+        spill_file = self._spill_files.get(path)
+        if spill_file is None:
+            spill_file = self._spill_files[path] = SpillFile(path)
+        return spill_file
+
+    def spill_cold_layers(self, path, keep_hot=1):
+        """
+        :py:meth:`State.spill` every state in the chain from the current
+        state to the root, except for the `keep_hot` states nearest the
+        current state.
+        """
+        state = self.current_state
+        for i in range(keep_hot):
+            if state is None:
+                return
+            state = state.parent
+        while state is not None:
+            state.spill(path)
+            state = state.parent
+
+    def intern_value(self, value):
+        """
+        Return the canonical object for `value` within this root.
+
+        The first value seen becomes the canonical object for all later
+        values that compare equal to it and have the same type, so that
+        states setting equal values share one object and merges can detect
+        agreement by identity. Only ``None``, booleans, numbers other than
+        complex numbers, strings and tuples of these are interned, with
+        tuples matched element type by element type and ``-0.0`` kept
+        apart from ``0.0``; other values are returned unchanged.
+        Canonical objects are kept alive until the root is finalized.
+        """
+        key = _intern_key(value)
+        if key is None:
+            return value
+        return self._interned.setdefault(key, value)
+
+    def slots_by_owner(self, owner):
+        """
+        Return the set of slots in this root created with the given owner.
+
+        Owners that can't be hashed are matched by identity rather than
+        equality.
+        """
+        if self._restored_owners:
+            for slot_id, slot_owner in self._restored_owners.items():
+                if slot_owner == owner:
+                    self.slot_by_id(slot_id)
+        return set(self._slots_by_owner.get(_owner_key(owner), ()))
+
+    def search(
+        self,
+        expand,
+        score,
+        beam_width=10,
+        max_depth=None,
+        min_score=None,
+        memory_budget=None,
+        pool=None,
+        owner=None,
+    ):
+        """
+        Run a beam search over forks of the current state, merge the best
+        branch found back into it and return ``(score, state)`` for the
+        winning state.
+
+        `expand` is called with a state active and returns an iterable of
+        decisions, each a callable taking no arguments. Each decision is
+        applied in a new child of that state, after which `score` is called
+        with the child active. `score` returns a number, where higher is
+        better, or ``None`` to prune the child.
+
+        At each level only the `beam_width` best children are kept for
+        further expansion. Children scoring below `min_score` are pruned, and
+        if `memory_budget` is given the frontier is trimmed, worst first,
+        until the frontier's states hold at most that many slot values
+        between them. Each child only stores what its decision wrote, so
+        states in the frontier share their ancestors' values.
+
+        The search stops after `max_depth` levels, or when the frontier is
+        empty. The best state seen at any level wins, including the
+        starting state, in which case nothing is merged.
+
+        If `pool` is given, the frontier states are expanded through its
+        ``map`` method, e.g. that of a
+        :py:class:`multiprocessing.pool.ThreadPool`. Each worker thread
+        activates the states it works on for itself only, using
+        :py:meth:`thread_state`.
+        """
+        start = self.current_state
+
+        def expand_state(state):
+            children = []
+            with self.thread_state(state):
+                decisions = list(expand(state))
+            for decision in decisions:
+                child = state._create_child(owner)
+                with self.thread_state(child):
+                    decision()
+                    child_score = score(child)
+                if child_score is None or (
+                    min_score is not None and child_score < min_score
+                ):
+                    child.discard()
+                    continue
+                children.append((child_score, child))
+            return children
+
+        with self.thread_state(start):
+            best = (score(start), start)
+        frontier = [start]
+        depth = 0
+        while frontier and (max_depth is None or depth < max_depth):
+            if pool is not None:
+                results = pool.map(expand_state, frontier)
+            else:
+                results = [expand_state(state) for state in frontier]
+
+            candidates = []
+            for children in results:
+                candidates.extend(children)
+            candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+            dropped = candidates[beam_width:]
+            candidates = candidates[:beam_width]
+            if memory_budget is not None:
+                self._trim_to_budget(
+                    start, candidates, memory_budget, dropped,
+                )
+            # Nothing can refer to children dropped from the frontier, so
+            # their values can go now.
+            for child_score, child in dropped:
+                child.discard()
+
+            if candidates and (
+                best[0] is None or candidates[0][0] > best[0]
+            ):
+                best = candidates[0]
+            frontier = [child for child_score, child in candidates]
+            depth += 1
+
+        # Merge the winning branch back down one level at a time.
+        state = best[1]
+        while state is not start:
+            state.parent.merge_children([state])
+            state = state.parent
+
+        return best
+
+    @staticmethod
+    def _trim_to_budget(start, candidates, budget, dropped):
+        # Move the worst candidates to dropped until the states retained
+        # by the rest hold at most budget slot values. Each state is
+        # counted once, however many candidates share it as an ancestor,
+        # so the number of candidates retaining each is tracked and its
+        # size only comes off the total once nothing retains it.
+        retained = {}
+        sizes = {}
+        cost = 0
+        for candidate_score, state in candidates:
+            while state is not start:
+                if state in retained:
+                    retained[state] += 1
+                else:
+                    retained[state] = 1
+                    sizes[state] = len(state.slot_values)
+                    cost += sizes[state]
+                state = state.parent
+
+        while candidates and cost > budget:
+            candidate = candidates.pop()
+            dropped.append(candidate)
+            state = candidate[1]
+            while state is not start:
+                retained[state] -= 1
+                if not retained[state]:
+                    cost -= sizes[state]
+                state = state.parent
+
+    def enable_stats(self, exporter=None):
+        """
+        Start collecting :py:class:`Stats` for this root, discarding any
+        previously collected.
+
+        If an `exporter` callable is given, it is called with the result of
+        :py:meth:`stats` whenever :py:meth:`export_stats` is called and
+        when the root is finalized.
+
+        Collection is disabled by default, in which case the only cost is
+        a check for it on each chain walk, merge and state creation.
+        """
+        self._hooks.stats = Stats()
+        self._hooks.stats_exporter = exporter
+
+    def disable_stats(self):
+        """
+        Stop collecting :py:class:`Stats` for this root.
+        """
+        self._hooks.stats = None
+        self._hooks.stats_exporter = None
+
+    def stats(self):
+        """
+        Return the statistics collected since :py:meth:`enable_stats` as a
+        dictionary, or ``None`` if collection is not enabled.
+        """
+        if self._hooks.stats is None:
+            return None
+        return self._hooks.stats.as_dict()
+
+    def export_stats(self):
+        """
+        Pass the current :py:meth:`stats` to the exporter given to
+        :py:meth:`enable_stats`, if any.
+        """
+        if self._hooks.stats_exporter is not None:
+            self._hooks.stats_exporter(self.stats())
+
+    def enable_profiling(self, span_hook=None):
+        """
+        Start attributing the cost of operations in this root to owners,
+        returning the new :py:class:`OwnerProfiler`.
+
+        If a `span_hook` is given it is called as ``span_hook(name, owner)``
+        around each fork, transaction and merge and must return a context
+        manager, allowing these to appear as spans in an external tracer.
+        """
+        self._hooks.profiler = OwnerProfiler(span_hook)
+        return self._hooks.profiler
+
+    def disable_profiling(self):
+        """
+        Stop attributing costs to owners.
+        """
+        self._hooks.profiler = None
 
+    def profile_report(self, top=None):
+        """
+        Return :py:meth:`OwnerProfiler.report` for the profiler started by
+        :py:meth:`enable_profiling`, or ``None`` if profiling is disabled.
+        """
+        if self._hooks.profiler is None:
+            return None
+        return self._hooks.profiler.report(top)
 
-class Root(State):
-    """
-    A root context that can be used to create slots.
+    def enable_leak_detection(self, callback=None):
+        """
+        Start tracking the states of this root and reporting those that
+        outlive their blocks, returning the new :py:class:`LeakDetector`.
 
-    :py:func:`root` is the public interface to create a root, and is intended
-    to be used in a ``with`` block. Once you've established a root context
-    you can create slots using the :py:meth:`slot` method.
+        This is intended for debugging, and only states created from now
+        on are tracked. If `callback` is given it is called with each list
+        of leaks found.
+        """
+        self._hooks.leaks = LeakDetector(self, callback)
+        return self._hooks.leaks
 
-    A root is a special kind of :py:class:`State` and thus inherits the
-    state-management functions of that class.
-    """
-    def __init__(self, root_owner=None, slot_type=Slot):
-        State.__init__(self, self, None, root_owner)
-        self.current_state = self
-        self.slot_type = slot_type
-        self.slots = set()
+    def disable_leak_detection(self):
+        """
+        Stop tracking states for leaks.
+        """
+        self._hooks.leaks = None
 
-    def slot(
-        self,
-        owner=None,
-        initial_value=Slot.NOT_KNOWN,
-        **kwargs
-    ):
+    def enable_wal(self, path, sync_every=1, overwrite=False):
         """
-        Creates a new :py:class:`Slot` in this root.
+        Start logging every change committed to the root state to the
+        write-ahead log at `path`, returning the new
+        :py:class:`datafork.storage.WriteAheadLog`.
+
+        If `path` already holds a log, which may record commits that have
+        not been recovered yet, this raises rather than replacing it,
+        unless `overwrite` is set. Use :py:meth:`recover` to carry on from
+        an existing log.
+
+        The log starts with a copy of the root state's current values, and
+        each merge into the root, write to it and call to
+        :py:meth:`State.resolve_conflicts` on it then appends one record,
+        so several writes are best made in a :py:meth:`transaction`, which
+        is logged as one. The initial values of new slots are included in
+        the next record, or written when the log is synced or closed,
+        rather than each getting its own. The log is synced to disk after
+        every `sync_every` records, or only when it is closed if
+        `sync_every` is 0. After a crash, the root can
+        be rebuilt from the log with :py:meth:`recover`. Each
+        :py:meth:`checkpoint` replaces the log with a reference to the new
+        checkpoint, so the log only grows between checkpoints.
+
+        Only slots created by :py:meth:`slot` have stable ids, so only
+        those can be logged.
+        """
+        from datafork.storage import WriteAheadLog
+        self.disable_wal()
+        self.current_state._materialize_all()
+        wal = WriteAheadLog(path, sync_every)
+        if wal.records and not overwrite:
+            wal.close()
+            raise Exception(
+                "%r already holds a write-ahead log; recover it with "
+                "Root.recover() or pass overwrite=True to replace it" % path
+            )
+        wal.reset(self)
+        self._hooks.wal = wal
+        return wal
 
-        The slot's value will remain mutable for the lifetime of the root
-        context, and will be frozen upon its exit.
+    def disable_wal(self):
         """
-        slot = self.slot_type(
-            self,
-            owner,
-            initial_value,
-            **kwargs
+        Stop logging changes, closing the write-ahead log.
+        """
+        wal = self._hooks.wal
+        if wal is not None:
+            self._hooks.wal = None
+            wal.close()
+
+    @classmethod
+    def recover(cls, path, sync_every=1, **kwargs):
+        """
+        Create a new root from the write-ahead log at `path` written by
+        :py:meth:`enable_wal`, restoring the checkpoint it refers to, if
+        any, and then replaying every intact record in order. A record left
+        incomplete by a crash is discarded.
+
+        The recovered root goes on appending to the same log. Any extra
+        keyword arguments are passed to the root's constructor, as for
+        :py:meth:`restore`.
+        """
+        from datafork.storage import recover_root
+        return recover_root(cls, path, sync_every, **kwargs)
+
+    def subscribe(self, callback, slots=None):
+        """
+        Arrange for `callback` to be called after each merge into this root
+        that changes the value of a slot, returning a
+        :py:class:`Subscription` that can be used to cancel it.
+
+        The callback receives a list of :py:class:`SlotChange` objects, one
+        for each slot whose value changed in that merge. If `slots` is
+        given, only changes to those slots are delivered and the callback
+        is not called for merges that change none of them.
+
+        Only merges into the root state itself are reported: work done in
+        nested transactions is reported once it reaches the root. Use
+        :py:meth:`coalesce_changes` to combine several merges into a single
+        change list.
+        """
+        # Merges still pending would otherwise go unreported.
+        self._materialize_all()
+        if self._hooks.changes is None:
+            self._hooks.changes = _ChangeDispatcher()
+        subscription = Subscription(
+            self._hooks.changes,
+            callback,
+            set(slots) if slots is not None else None,
         )
-        self.slots.add(slot)
-        return slot
+        self._hooks.changes.add(subscription)
+        return subscription
+
+    def coalesce_changes(self):
+        """
+        Returns a context manager that holds back change notifications
+        until the end of the block, then delivers a single list of changes
+        covering every merge into the root made within it.
+
+        A slot that changed several times is reported once, with the value
+        from before the first change and the value after the last. Slots
+        that ended up back at their original value are not reported.
+        """
+        root = self
+        class Context(object):
+            def __enter__(context):
+                if root._hooks.changes is None:
+                    root._hooks.changes = _ChangeDispatcher()
+                root._hooks.changes.coalescing += 1
+            def __exit__(context, exc_type, exc_value, traceback):
+                dispatcher = root._hooks.changes
+                dispatcher.coalescing -= 1
+                if dispatcher.coalescing == 0:
+                    dispatcher.flush()
+        return Context()
+
+    def enable_history(self, size, slots=None):
+        """
+        Start keeping the last `size` values committed to the root state
+        for each of the given slots, or for every slot if `slots` is not
+        given.
+
+        Each slot's history is a fixed-size ring buffer of values,
+        positions and write versions, recorded whenever a value is set in
+        or merged into the root state. The current root values are
+        recorded immediately. Use :py:meth:`Slot.value_at` and
+        :py:meth:`as_of` to read from the history, and
+        :py:meth:`current_version` to obtain a version to read at later.
+
+        History is disabled by default, and costs nothing but a check on
+        each write to the root state while disabled.
+        """
+        self._materialize_all()
+        history = _History(size, set(slots) if slots is not None else None)
+        entries = sorted(
+            (version, slot) for slot, version in self.slot_versions.items()
+        )
+        for version, slot in entries:
+            history.record(
+                slot,
+                self.slot_values[slot],
+                self.slot_positions.get(slot, set()),
+                version,
+            )
+        self._hooks.history = history
+
+    def disable_history(self):
+        """
+        Stop recording history and discard what has been recorded.
+        """
+        self._hooks.history = None
+
+    def current_version(self):
+        """
+        Return a version number greater than that of every write made so
+        far, for passing to :py:meth:`Slot.value_at` or :py:meth:`as_of`
+        later.
+        """
+        return next(_versions)
+
+    def as_of(self, version):
+        """
+        Return a :py:class:`HistoryView` of the values committed to this
+        root as of the given version, according to the history recorded
+        since :py:meth:`enable_history`.
+        """
+        if self._hooks.history is None:
+            raise Exception("History is not enabled for %r" % self)
+        return HistoryView(self._hooks.history, version)
 
     def finalize_data(self):
+        stats = self._hooks.stats
+        if stats is not None:
+            start = timeit.default_timer()
+        self.current_state._materialize_all()
+        if self._hooks.leaks is not None:
+            self._hooks.leaks.check_after(None, include_open=True)
         for slot in self.slots:
             slot.finalize()
+        self._interned.clear()
+        # Finalized buffer values keep their own maps of the spill files
+        # alive, so the files themselves can be closed.
+        for spill_file in self._spill_files.itervalues():
+            spill_file.close()
+        self._spill_files.clear()
+        self.disable_wal()
+        if stats is not None:
+            stats.finalize_time = timeit.default_timer() - start
+            self.export_stats()
 
     def __enter__(self):
         return self
@@ -399,7 +2817,7 @@ class Root(State):
         self.finalize_data()
 
 
-def root(owner=None):
+def root(owner=None, intern_values=False):
     """
     Creates and returns a context manager that provides a :py:class:`Root`
     object. Use this in a with block like this:
@@ -409,7 +2827,7 @@ def root(owner=None):
         with datafork.root():
             # etc
     """
-    new = Root(root_owner=owner)
+    new = Root(root_owner=owner, intern_values=intern_values)
     class Context(object):
         def __enter__(self):
             return new
@@ -418,6 +2836,752 @@ def root(owner=None):
     return Context()
 
 
+def multi_transaction(*roots, **kwargs):
+    """
+    Creates and returns a context manager that runs a single transaction
+    across several roots, so that the changes made in the block are
+    committed to all of them or to none. Use this in a with block like
+    this:
+
+    .. code-block:: python
+
+        with datafork.multi_transaction(accounts, ledger):
+            balance.value -= 10
+            entry.value = "debit"
+
+    On entry a child of each root is created and activated, as if by
+    :py:meth:`State.transaction`, and the list of children is provided in
+    the same order as the roots. An `owner` keyword argument is passed on
+    to each child.
+
+    If the block succeeds, the merge of every child into its root is first
+    planned with :py:meth:`State.plan_merge`, and each root's write-ahead
+    log record is encoded. Only once all of the plans are known to apply
+    cleanly are they applied, so a merge function that raises or a value
+    that can't be logged leaves every root unchanged. Change subscribers
+    are not notified until every root has been written. Roots whose child
+    was not written to are skipped. If the block raises, nothing is
+    merged. Remote roots (see :py:mod:`datafork.server`) commit to their
+    server one at a time, so they can't be used.
+    """
+    owner = kwargs.pop("owner", None)
+    if kwargs:
+        raise TypeError(
+            "Unexpected keyword arguments: %s" % ", ".join(sorted(kwargs))
+        )
+    if len(set(id(state.root) for state in roots)) != len(roots):
+        raise Exception("Can't use the same root twice in a transaction")
+    for state in roots:
+        if state.root._remote:
+            raise Exception(
+                "Can't use %r in a multi_transaction: it is a remote root"
+                % state.root
+            )
+    return _MultiTransactionContext(roots, owner)
+
+
+class Stats(object):
+    """
+    Counters describing the work done inside a root, collected once
+    :py:meth:`Root.enable_stats` has been called.
+
+    :py:meth:`Root.stats` returns these counters as a dictionary.
+    """
+
+    def __init__(self):
+        #: :py:class:`collections.Counter` mapping the number of states
+        #: visited by each chain walk in :py:meth:`State.get_slot_value`
+        #: to the number of walks of that length.
+        self.walk_lengths = collections.Counter()
+        #: Number of calls to a slot's `fork` function.
+        self.forks = 0
+        #: Total seconds spent in slot `fork` functions.
+        self.fork_time = 0.0
+        #: Number of calls to :py:meth:`State.merge_children`.
+        self.merges = 0
+        #: Total number of slots merged.
+        self.merged_slots = 0
+        #: Number of slots merged when first needed after a lazy
+        #: :py:meth:`State.merge_children`, which are also counted in
+        #: `merged_slots`.
+        self.materialized_slots = 0
+        #: Largest number of slots merged by one eager call.
+        self.max_merged_slots = 0
+        #: Number of merge conflicts produced by merges.
+        self.merge_conflicts = 0
+        #: Total seconds spent merging.
+        self.merge_time = 0.0
+        #: Number of states created.
+        self.states_created = 0
+        #: Number of states thrown away without being merged.
+        self.states_discarded = 0
+        #: Seconds taken by the most recent :py:meth:`Root.finalize_data`.
+        self.finalize_time = None
+
+    def record_walk(self, state, slot):
+        # Equivalent to State._find_slot_value, but counting as it goes.
+        length = 0
+        current = state
+        value = Slot.NOT_KNOWN
+        while current is not None:
+            length += 1
+            if current._pending:
+                current._materialize(slot)
+            try:
+                value = current.slot_values[slot]
+                break
+            except KeyError:
+                current = current.parent
+        else:
+            defaults = state.root._defaults
+            if defaults and slot in defaults:
+                value = defaults.get(slot)
+        self.walk_lengths[length] += 1
+        return value
+
+    def record_fork(self, elapsed):
+        self.forks += 1
+        self.fork_time += elapsed
+
+    def record_merge(self, slots, conflicts, elapsed):
+        self.merges += 1
+        self.merged_slots += slots
+        if slots > self.max_merged_slots:
+            self.max_merged_slots = slots
+        self.merge_conflicts += conflicts
+        self.merge_time += elapsed
+
+    def record_materialize(self, conflicts, elapsed):
+        self.merged_slots += 1
+        self.materialized_slots += 1
+        self.merge_conflicts += conflicts
+        self.merge_time += elapsed
+
+    def as_dict(self):
+        result = dict(self.__dict__)
+        result["walk_lengths"] = dict(self.walk_lengths)
+        return result
+
+
+class OwnerProfiler(object):
+    """
+    Attributes the cost of datafork operations to the owners involved,
+    once enabled with :py:meth:`Root.enable_profiling`.
+
+    Each operation is recorded against a *kind* and an owner:
+
+    * ``read`` and ``write``: slot reads and writes, by :py:attr:`Slot.owner`.
+    * ``slot_fork`` and ``slot_merge``: calls to a slot's `fork` and `merge`
+      functions, by :py:attr:`Slot.owner`.
+    * ``fork`` and ``transaction``: the lifetime of a child state block,
+      by the owner given when creating the child.
+    * ``merge``: calls to :py:meth:`State.merge_children`, by the owner of
+      the state being merged into.
+
+    Times are inclusive, so e.g. the time of a ``merge`` includes that of
+    the ``slot_merge`` calls it made. Allocations count the objects that
+    datafork itself creates for an operation (state storage entries, forked
+    copies and merge possibilities) rather than bytes.
+    """
+
+    def __init__(self, span_hook=None):
+        #: Maps ``(kind, owner)`` to a ``[count, seconds, allocations]``
+        #: list. Owners that can't be hashed are keyed by identity, and
+        #: appear as themselves in :py:meth:`report`.
+        self.costs = {}
+        # The owner behind each key in costs.
+        self._owners = {}
+        #: Optional callable taking ``(name, owner)`` and returning a
+        #: context manager that is entered around each ``fork``,
+        #: ``transaction`` and ``merge_children``.
+        self.span_hook = span_hook
+
+    def record(self, kind, owner, elapsed, allocations=0):
+        owner_key = _owner_key(owner)
+        key = (kind, owner_key)
+        cost = self.costs.get(key)
+        if cost is None:
+            cost = self.costs[key] = [0, 0.0, 0]
+            self._owners[owner_key] = owner
+        cost[0] += 1
+        cost[1] += elapsed
+        cost[2] += allocations
+
+    def profile_read(self, state, slot):
+        start = timeit.default_timer()
+        if slot in state.slot_values:
+            value = state.slot_values[slot]
+        else:
+            value = state._inherit_slot_value(slot)
+        self.record("read", slot.owner, timeit.default_timer() - start)
+        return value
+
+    def span(self, name, owner):
+        if self.span_hook is None:
+            return _NULL_SPAN
+        return self.span_hook(name, owner)
+
+    def report(self, top=None):
+        """
+        Return a list of ``(owner, summary)`` pairs ordered by descending
+        total time, limited to the first `top` if given.
+
+        Each summary is a dictionary with the total ``count``, ``time`` and
+        ``allocations`` for that owner along with a ``kinds`` dictionary
+        giving the same breakdown for each kind of operation.
+        """
+        owners = {}
+        for (kind, owner_key), (count, elapsed, allocations) in (
+            self.costs.iteritems()
+        ):
+            summary = owners.get(owner_key)
+            if summary is None:
+                summary = owners[owner_key] = {
+                    "count": 0,
+                    "time": 0.0,
+                    "allocations": 0,
+                    "kinds": {},
+                }
+            summary["count"] += count
+            summary["time"] += elapsed
+            summary["allocations"] += allocations
+            summary["kinds"][kind] = {
+                "count": count,
+                "time": elapsed,
+                "allocations": allocations,
+            }
+        result = sorted(
+            (
+                (self._owners[owner_key], summary)
+                for owner_key, summary in owners.iteritems()
+            ),
+            key=lambda item: item[1]["time"],
+            reverse=True,
+        )
+        if top is not None:
+            result = result[:top]
+        return result
+
+
+class LeakDetector(object):
+    """
+    Reports states that are still alive after the blocks that created
+    them have ended, once enabled with :py:meth:`Root.enable_leak_detection`.
+
+    Every state created under the root is tracked through a weak
+    reference. Whenever a :py:meth:`State.fork` or
+    :py:meth:`State.transaction` block directly under the root ends, any
+    tracked state that is still alive although it, or one of its
+    ancestors, has already been merged or rolled back is reported as a
+    leak, along with an estimate of the memory it retains. These are
+    typically states kept alive by lingering references, and can be
+    released with :py:meth:`State.discard`.
+
+    Forks that have been neither merged nor discarded may still be merged
+    later, so they are only reported when the root is finalized. States
+    that are discarded, in the current state's chain, waiting in a lazy
+    merge or the state of the block that just ended are never reported.
+    """
+
+    def __init__(self, root, callback=None):
+        self.root = root
+        #: Optional callable receiving each non-empty list of leaks.
+        self.callback = callback
+        #: Each non-empty list of leaks found, oldest first.
+        self.reports = []
+        self._states = weakref.WeakSet()
+
+    def track(self, state):
+        self._states.add(state)
+
+    def check(self, exclude=None, include_open=False):
+        """
+        Return a list of ``(state, size)`` pairs for each live state that
+        would be reported now, where `size` is an estimate in bytes of the
+        memory held by the state's own storage. If `include_open` is set,
+        forks that have been neither merged nor discarded are included.
+        """
+        states = list(self._states)
+        active = set()
+        current = self.root.current_state
+        while current is not None:
+            active.add(current)
+            current = current.parent
+        # Children waiting in a lazy merge are still needed.
+        waiting = set()
+        for state in active.union(states):
+            for merge in state._pending:
+                waiting.update(merge.states)
+        leaks = []
+        for state in states:
+            if (
+                state.discarded or state in active or state in waiting or
+                state is exclude
+            ):
+                continue
+            if not include_open:
+                current = state
+                while current is not None and not (
+                    current._finished or current.discarded
+                ):
+                    current = current.parent
+                if current is None:
+                    continue
+            leaks.append((state, self.retained_size(state)))
+        return leaks
+
+    def check_after(self, state, include_open=False):
+        leaks = self.check(exclude=state, include_open=include_open)
+        if leaks:
+            self.reports.append(leaks)
+            if self.callback is not None:
+                self.callback(leaks)
+
+    @staticmethod
+    def retained_size(state):
+        """
+        Estimate the bytes held by the state's own values and positions.
+        Values held in a spill file are not counted.
+        """
+        size = 0
+        for storage in (state.slot_values, state.slot_positions):
+            size += sys.getsizeof(storage)
+            if isinstance(storage, dict):
+                for value in storage.itervalues():
+                    size += sys.getsizeof(value)
+        return size
+
+
+class Subscription(object):
+    """
+    A registration made by :py:meth:`Root.subscribe`.
+    """
+
+    def __init__(self, dispatcher, callback, slots):
+        self.dispatcher = dispatcher
+        #: The callable that receives each list of changes.
+        self.callback = callback
+        #: The set of slots subscribed to, or ``None`` for all slots.
+        self.slots = slots
+
+    def cancel(self):
+        """
+        Stop delivering changes to this subscription's callback.
+        """
+        self.dispatcher.remove(self)
+
+
+class _ChangeDispatcher(object):
+    # Delivers changes from merges into a root to its subscriptions.
+
+    def __init__(self):
+        # Subscriptions to specific slots, indexed by slot so that the
+        # cost of a dispatch depends only on the slots that changed.
+        self.by_slot = {}
+        self.all_slots = []
+        # Nesting depth of coalesce_changes blocks, and the changes held
+        # back while inside them.
+        self.coalescing = 0
+        self.pending = collections.OrderedDict()
+
+    def add(self, subscription):
+        if subscription.slots is None:
+            self.all_slots.append(subscription)
+        else:
+            for slot in subscription.slots:
+                self.by_slot.setdefault(slot, []).append(subscription)
+
+    def remove(self, subscription):
+        if subscription.slots is None:
+            self.all_slots.remove(subscription)
+        else:
+            for slot in subscription.slots:
+                subscriptions = self.by_slot[slot]
+                subscriptions.remove(subscription)
+                if not subscriptions:
+                    del self.by_slot[slot]
+
+    def dispatch(self, changes):
+        if self.coalescing:
+            for change in changes:
+                earlier = self.pending.get(change.slot)
+                if earlier is not None:
+                    change = SlotChange(
+                        change.slot,
+                        earlier.old_value,
+                        change.new_value,
+                        earlier.old_positions,
+                        change.new_positions,
+                    )
+                self.pending[change.slot] = change
+            return
+
+        batches = collections.OrderedDict()
+        for change in changes:
+            for subscription in self.by_slot.get(change.slot, ()):
+                batches.setdefault(subscription, []).append(change)
+        for subscription in list(self.all_slots):
+            subscription.callback(changes)
+        for subscription, batch in batches.iteritems():
+            subscription.callback(batch)
+
+    def flush(self):
+        changes = [
+            change for change in self.pending.itervalues()
+            if not (
+                change.old_value is change.new_value or
+                change.old_value == change.new_value
+            )
+        ]
+        self.pending.clear()
+        if changes:
+            self.dispatch(changes)
+
+
+class _HistoryRing(object):
+    # Fixed-size circular buffer of the values committed to one slot,
+    # oldest overwritten first. Versions are kept in an array so that the
+    # memory used per slot doesn't grow.
+    __slots__ = ("values", "positions", "versions", "next", "count")
+
+    def __init__(self, size):
+        self.values = [None] * size
+        self.positions = [None] * size
+        self.versions = array.array("L", [0] * size)
+        self.next = 0
+        self.count = 0
+
+    def append(self, value, positions, version):
+        index = self.next
+        self.values[index] = value
+        self.positions[index] = positions
+        self.versions[index] = version
+        self.next = (index + 1) % len(self.values)
+        if self.count < len(self.values):
+            self.count += 1
+
+    def entries(self):
+        # Yields (value, positions, version), newest first.
+        size = len(self.values)
+        for i in range(1, self.count + 1):
+            index = (self.next - i) % size
+            yield (
+                self.values[index],
+                self.positions[index],
+                self.versions[index],
+            )
+
+    def find(self, version):
+        for entry in self.entries():
+            if entry[2] <= version:
+                return entry
+        return None
+
+
+class _History(object):
+    # Keeps a _HistoryRing for each tracked slot of a root.
+
+    def __init__(self, size, slots):
+        self.size = size
+        # the tracked slots, or None for all of them
+        self.slots = slots
+        self.rings = {}
+
+    def record(self, slot, value, positions, version):
+        if self.slots is not None and slot not in self.slots:
+            return
+        ring = self.rings.get(slot)
+        if ring is None:
+            ring = self.rings[slot] = _HistoryRing(self.size)
+        ring.append(value, positions, version)
+
+    def find(self, slot, version):
+        ring = self.rings.get(slot)
+        if ring is None:
+            return None
+        return ring.find(version)
+
+
+class HistoryView(object):
+    """
+    A read-only view of the values that slots with history had committed
+    in their root as of a particular version, as returned by
+    :py:meth:`Root.as_of`.
+
+    Indexing the view with a slot behaves like :py:meth:`Slot.value_at`.
+    """
+
+    def __init__(self, history, version):
+        self._history = history
+        #: The version this view shows.
+        self.version = version
+
+    def get_slot_value(self, slot):
+        """
+        Return the raw value of the slot as of this view's version, or
+        :py:attr:`Slot.NOT_KNOWN` if it is not in the retained history.
+        """
+        entry = self._history.find(slot, self.version)
+        return Slot.NOT_KNOWN if entry is None else entry[0]
+
+    def get_slot_positions(self, slot):
+        entry = self._history.find(slot, self.version)
+        return set() if entry is None else entry[1]
+
+    def __getitem__(self, slot):
+        return Slot.prepare_return_value(slot, self.get_slot_value(slot))
+
+    def __contains__(self, slot):
+        return self._history.find(slot, self.version) is not None
+
+    def __iter__(self):
+        for slot in list(self._history.rings):
+            if slot in self:
+                yield slot
+
+
+class _PendingMerge(object):
+    # A lazy merge recorded by State.merge_children: the states to merge
+    # and the slots that have yet to be merged from them.
+    __slots__ = ("states", "slots")
+
+    def __init__(self, states, slots):
+        self.states = states
+        self.slots = slots
+
+
+class _SlotDefaults(object):
+    # The defaults of slots created by Root.allocate_slots, held as ranges
+    # of slot ids so that each allocation adds a single entry.
+
+    def __init__(self):
+        self.starts = []
+        # (start, end, default, factory) for each allocation, in order.
+        self.ranges = []
+        # Values produced by factories, by slot.
+        self.made = {}
+
+    def add(self, start, end, default, factory):
+        self.starts.append(start)
+        self.ranges.append((start, end, default, factory))
+
+    def restore(self, ranges):
+        for start, end, default, factory in ranges:
+            self.add(start, end, default, factory)
+
+    def _range(self, slot):
+        slot_id = slot.slot_id
+        if slot_id is None:
+            return None
+        i = bisect.bisect_right(self.starts, slot_id) - 1
+        if i >= 0 and slot_id < self.ranges[i][1]:
+            return self.ranges[i]
+        return None
+
+    def __nonzero__(self):
+        return bool(self.ranges)
+
+    def __contains__(self, slot):
+        return self._range(slot) is not None
+
+    def get(self, slot):
+        start, end, default, factory = self._range(slot)
+        if factory is None:
+            return default
+        try:
+            return self.made[slot]
+        except KeyError:
+            # setdefault so that racing threads agree on one value.
+            return self.made.setdefault(slot, factory())
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Hooks(object):
+    # Optional instrumentation for a root. A single instance is shared by
+    # the root and all of its states, so that checking whether something
+    # is enabled costs one attribute lookup.
+    stats = None
+    stats_exporter = None
+    profiler = None
+    changes = None
+    history = None
+    leaks = None
+    wal = None
+    # The root's default MergePolicy, and those for particular slot owners.
+    # merge_policies is None until a policy is set.
+    merge_policy = None
+    merge_policies = None
+
+
+class _ChildContext(object):
+    # Returned by State.fork and State.transaction. This is a plain class
+    # rather than one made for each call, which would be in a reference
+    # cycle and keep the states it refers to alive until the next garbage
+    # collection.
+
+    def __init__(self, state, owner, auto_merge):
+        self.state = state
+        self.owner = owner
+        self.auto_merge = auto_merge
+        self.previous = state.root.current_state
+        self.new = state._create_child(owner)
+        self.profiler = state._hooks.profiler
+
+    def __enter__(self):
+        if self.profiler is not None:
+            self.start = timeit.default_timer()
+            self.span = self.profiler.span(
+                "transaction" if self.auto_merge else "fork", self.owner,
+            )
+            self.span.__enter__()
+        self.state.root.current_state = self.new
+        return self.new
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        state = self.state
+        new = self.new
+        try:
+            if self.auto_merge:
+                if exc_type is None:
+                    state.merge_children([new])
+                else:
+                    new._abandon()
+        finally:
+            # Even if the merge failed, the child is finished with.
+            state.root.current_state = self.previous
+            if self.profiler is not None:
+                self.span.__exit__(exc_type, exc_value, traceback)
+                self.profiler.record(
+                    "transaction" if self.auto_merge else "fork",
+                    self.owner,
+                    timeit.default_timer() - self.start,
+                    1,
+                )
+            self.previous = self.new = None
+        leaks = state._hooks.leaks
+        if leaks is not None and state.parent is None:
+            leaks.check_after(new)
+
+
+class _MultiTransactionContext(object):
+    # Returned by multi_transaction; see _ChildContext.
+
+    def __init__(self, roots, owner):
+        self.contexts = [
+            _ChildContext(state, owner, auto_merge=False) for state in roots
+        ]
+
+    def __enter__(self):
+        return [context.__enter__() for context in self.contexts]
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        contexts = self.contexts
+        try:
+            if exc_type is None:
+                self._commit([
+                    (context.state, context.new) for context in contexts
+                    if context.new.slot_values or context.new._pending
+                ])
+            else:
+                for context in contexts:
+                    context.new._abandon()
+        finally:
+            for context in reversed(contexts):
+                context.__exit__(exc_type, exc_value, traceback)
+            self.contexts = None
+
+    @staticmethod
+    def _commit(pairs):
+        # Take the commit locks in a fixed order, so that transactions
+        # over overlapping roots can't deadlock.
+        pairs.sort(key=lambda pair: id(pair[0].root))
+        locks = [state.root.commit_lock for state, child in pairs]
+        deferred = []
+        for lock in locks:
+            lock.acquire()
+        try:
+            plans = [
+                (state, state.plan_merge([child])) for state, child in pairs
+            ]
+            # Everything that can fail, including encoding each root's log
+            # record, is done before any root is written.
+            for state, plan in plans:
+                state._check_plan(plan)
+                wal = state._hooks.wal if state.parent is None else None
+                if wal is not None:
+                    plan._wal_record = wal.prepare(state, plan._results)
+            for state, plan in plans:
+                state._apply_plan(plan, deferred)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        for dispatcher, changed in deferred:
+            dispatcher.dispatch(changed)
+
+
+class _ThreadStateContext(object):
+    # Returned by Root.thread_state; see _ChildContext.
+
+    def __init__(self, local, state):
+        self.local = local
+        self.state = state
+
+    def __enter__(self):
+        self.previous = self.local.state
+        self.local.state = self.state
+        return self.state
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.local.state = self.previous
+        self.previous = None
+
+
+class _DiscardedStorage(object):
+    # Stands in for the storage of a discarded state.
+
+    def _fail(self, *args, **kwargs):
+        raise Exception("Can't use a discarded state")
+
+    __getitem__ = __setitem__ = __delitem__ = __contains__ = _fail
+    __iter__ = __len__ = _fail
+
+    def __getattr__(self, name):
+        return self._fail
+
+    def __repr__(self):
+        return "<discarded>"
+
+
+_DISCARDED = _DiscardedStorage()
+
+
+class _ThreadState(threading.local):
+    # the state activated for the current thread, or None to use the
+    # root's shared current state.
+    state = None
+
+
+class _SlotCreation(threading.local):
+    # The root whose Root._create_slot is calling its slot type in the
+    # current thread, if any, and the slot whose initial value it is
+    # writing.
+    root = None
+    initial = None
+
+
+_slot_creation = _SlotCreation()
+
+
 class MergeConflict(object):
     """
     Represents the case where :py:meth:`State.merge_children` discovers
@@ -436,6 +3600,11 @@ class MergeConflict(object):
         return "<MergeConflict %r>" % self.possibilities
 
 
+# Values MergeBatch.from_states can't take from a state's storage as they
+# are.
+_UNWRAPPED_TYPES = (MergeConflict, _CopyOnWriteProxy)
+
+
 class MergePossibility(object):
     """
     Represents a single possibility in a merge, or within a
@@ -474,6 +3643,39 @@ class MergePossibility(object):
         )
 
 
+class SlotChange(object):
+    """
+    Describes how the value of a single slot differs between two states.
+    """
+    #: The slot that changed.
+    slot = None
+    #: The value before the change.
+    old_value = None
+    #: The value after the change.
+    new_value = None
+    #: Set of positions associated with the old value.
+    old_positions = set()
+    #: Set of positions associated with the new value.
+    new_positions = set()
+
+    def __init__(self, slot, old_value, new_value, old_positions,
+                 new_positions):
+        self.slot = slot
+        self.old_value = old_value
+        self.new_value = new_value
+        self.old_positions = old_positions
+        self.new_positions = new_positions
+
+    def __repr__(self):
+        return "<SlotChange %r: %r at %r -> %r at %r>" % (
+            self.slot,
+            self.old_value,
+            self.old_positions,
+            self.new_value,
+            self.new_positions,
+        )
+
+
 class ValueNotKnownError(Exception):
     """
     Exception that is raised when a caller attempts to access the value of a
@@ -501,3 +3703,20 @@ class ValueAmbiguousError(ValueNotKnownError):
         Exception.__init__(self, 'Slot %r value is ambiguous' % slot)
         self.slot = slot
         self.conflict = conflict
+
+
+class TransactionConflictError(Exception):
+    """
+    Exception that is raised when an optimistic transaction is still unable
+    to commit after its permitted number of retries, or when a
+    :py:class:`datafork.server.StateServer` refuses a commit because a slot
+    read by the merged states has changed since.
+    """
+    #: The slot whose concurrent modification caused the final failure.
+    slot = None
+
+    def __init__(self, slot):
+        Exception.__init__(
+            self, 'Transaction conflicted on slot %r' % slot,
+        )
+        self.slot = slot
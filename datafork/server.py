@@ -0,0 +1,814 @@
+"""
+A state server, so that several processes on one host can share a root.
+
+A :py:class:`StateServer` owns an ordinary :py:class:`datafork.Root` and
+listens on a Unix domain socket. Each client process connects a
+:py:class:`RemoteRoot`, whose slots are the server's slots and whose root
+state is read from the server. Forks of a remote root are ordinary states
+that live entirely in the client, so the server only hears about the
+slots that are read from or merged into the root itself.
+
+Each message in either direction is pickled and prefixed with its length.
+A client sends a list of calls in each message and the server replies
+with a list of results in the same order, so several calls can share a
+round trip and a client need not wait for one reply before sending more.
+
+Since unpickling a message can run arbitrary code, the server and its
+clients must trust each other completely: the socket must only be
+reachable by trusted processes, which is up to the permissions of the
+socket file and the directory holding it.
+"""
+
+import collections
+import os
+import socket
+import struct
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import datafork
+from datafork.storage import (
+    KIND_BUFFER, KIND_NOT_KNOWN, KIND_PICKLE, VIEW_TYPES, _view,
+)
+
+
+# Each message is this header, giving the size of the pickled payload that
+# follows it.
+MESSAGE_HEADER = struct.Struct("<I")
+
+
+def _pack_message(payload):
+    data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+    return MESSAGE_HEADER.pack(len(data)) + data
+
+
+def _send_message(sock, payload):
+    sock.sendall(_pack_message(payload))
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_message(sock):
+    # Return the next message from sock, or None once it is closed.
+    header = _recv_exactly(sock, MESSAGE_HEADER.size)
+    if header is None:
+        return None
+    data = _recv_exactly(sock, MESSAGE_HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return pickle.loads(data)
+
+
+def _encode(value):
+    # Tag the values that can't be pickled as they are, as in a spill
+    # record.
+    if value is datafork.Slot.NOT_KNOWN:
+        return KIND_NOT_KNOWN, None
+    if isinstance(value, VIEW_TYPES):
+        return KIND_BUFFER, bytes(value)
+    return KIND_PICKLE, value
+
+
+def _decode(kind, data):
+    if kind == KIND_NOT_KNOWN:
+        return datafork.Slot.NOT_KNOWN
+    if kind == KIND_BUFFER:
+        return _view(data, 0, len(data))
+    return data
+
+
+def _sendable(ok, result):
+    # Returns a result that can be pickled into a reply, replacing one that
+    # can't with an error saying so.
+    try:
+        pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception as ex:
+        return False, Exception("Can't send %r: %s" % (result, ex))
+    return ok, result
+
+
+class StateServer(object):
+    """
+    Serves `root` (or a new :py:class:`datafork.Root`, if not given) to
+    :py:class:`RemoteRoot` clients connecting to the Unix domain socket at
+    `path`.
+
+    Clients send pickled values, which the server unpickles, so only
+    trusted processes may be able to connect to `path`.
+
+    Each client is handled by its own thread, and every call that reads
+    or changes the root holds the root's
+    :py:attr:`datafork.Root.commit_lock`. A commit from a client's merge
+    carries the version of every slot the merged states read from the
+    root, and is refused if any of them has changed since, so that
+    concurrent read-modify-write transactions can't lose updates. Merges
+    into the root made by the server's own process are seen by clients,
+    but clients holding cached values are only told to drop them when
+    another client commits.
+    """
+
+    def __init__(self, path, root=None):
+        self.path = path
+        #: The root shared by every client.
+        self.root = root if root is not None else datafork.Root()
+        self._connections = set()
+        self._closed = False
+        self._thread = None
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen(16)
+
+    def start(self):
+        """
+        Call :py:meth:`serve_forever` in a new daemon thread, returning
+        the server.
+        """
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """
+        Accept and serve clients until :py:meth:`close` is called.
+        """
+        while True:
+            try:
+                sock, address = self._listener.accept()
+            except socket.error:
+                if self._closed:
+                    return
+                raise
+            connection = _ServerConnection(self, sock)
+            self._connections.add(connection)
+            thread = threading.Thread(target=connection.run)
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        """
+        Stop accepting clients, disconnect those already connected and
+        remove the socket file.
+        """
+        self._closed = True
+        try:
+            # Wake up a thread blocked in accept.
+            self._listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._listener.close()
+        if self._thread is not None:
+            self._thread.join()
+        for connection in list(self._connections):
+            connection.close()
+        os.unlink(self.path)
+
+    def _invalidate(self, committer, versions):
+        # Tell every other client that has read any of the given slots to
+        # drop its cached copies, given the (slot id, version) of each
+        # slot committed.
+        for connection in list(self._connections):
+            if connection is committer:
+                continue
+            with connection.send_lock:
+                watched = connection.watched
+                dropped = [
+                    (slot_id, version) for slot_id, version in versions
+                    if slot_id in watched
+                ]
+                if not dropped:
+                    continue
+                for slot_id, version in dropped:
+                    watched.discard(slot_id)
+                try:
+                    _send_message(
+                        connection.socket, ("invalidate", dropped),
+                    )
+                except socket.error:
+                    pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _ServerConnection(object):
+    # The server end of a connection from one RemoteRoot. Each call in a
+    # message is dispatched to the call_<name> method.
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.root = server.root
+        self.socket = sock
+        self.send_lock = threading.Lock()
+        # Ids of slots whose values the client may have cached.
+        self.watched = set()
+
+    def run(self):
+        try:
+            while True:
+                calls = _recv_message(self.socket)
+                if calls is None:
+                    break
+                results = []
+                for name, args in calls:
+                    try:
+                        result = getattr(self, "call_" + name)(*args)
+                    except Exception as ex:
+                        results.append((False, ex))
+                    else:
+                        results.append((True, result))
+                try:
+                    data = _pack_message(("reply", results))
+                except Exception:
+                    # Send what can be sent, and errors for the rest, so
+                    # that the client's replies stay in step.
+                    data = _pack_message((
+                        "reply",
+                        [_sendable(ok, result) for ok, result in results],
+                    ))
+                with self.send_lock:
+                    self.socket.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            self.server._connections.discard(self)
+            self.socket.close()
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def call_hello(self):
+        return self.root.owner
+
+    def call_ping(self):
+        return None
+
+    def call_slot(self, owner):
+        with self.root.commit_lock:
+            root = self.root
+            return root._create_slot(root._new_slot_id(owner), owner).slot_id
+
+    def call_owner(self, slot_id):
+        with self.root.commit_lock:
+            return self.root.slot_by_id(slot_id).owner
+
+    def call_read(self, slot_ids):
+        root = self.root
+        entries = []
+        with self.root.commit_lock:
+            for slot_id in slot_ids:
+                slot = root.slot_by_id(slot_id)
+                # Complete any lazy merge of the slot first, so the value
+                # sent matches its version.
+                if root._pending:
+                    root._materialize(slot)
+                if slot in root.slot_values:
+                    entry = (
+                        _encode(root.slot_values[slot]),
+                        set(root.get_slot_positions(slot)),
+                        root.get_slot_version(slot),
+                    )
+                elif slot in root._defaults:
+                    entry = (_encode(root._defaults.get(slot)), set(), 0)
+                else:
+                    entry = None
+                entries.append((slot_id, entry))
+            with self.send_lock:
+                self.watched.update(slot_ids)
+        return entries
+
+    def call_keys(self):
+        with self.root.commit_lock:
+            self.root._materialize_all()
+            return [slot.slot_id for slot in self.root.slot_values]
+
+    def call_conflicts(self):
+        with self.root.commit_lock:
+            return [slot.slot_id for slot in self.root.conflicts()]
+
+    def call_commit(self, changes, reads):
+        # Returns (None, the new version of each slot) if the commit was
+        # made, or (the id of a slot whose read is stale, None) if not.
+        root = self.root
+        with root.commit_lock:
+            for slot_id, version in reads:
+                slot = root.slot_by_id(slot_id)
+                if root.get_slot_version(slot) != version:
+                    root.contention.record_conflict(slot)
+                    return slot_id, None
+            root.apply_changes({
+                slot_id: (_decode(kind, data), positions)
+                for slot_id, (kind, data), positions in changes
+            })
+            versions = [
+                root.get_slot_version(root.slot_by_id(slot_id))
+                for slot_id, value, positions in changes
+            ]
+            with self.send_lock:
+                self.watched.update(
+                    slot_id for slot_id, value, positions in changes
+                )
+        self.server._invalidate(
+            self,
+            [
+                (slot_id, version) for (slot_id, value, positions), version
+                in zip(changes, versions)
+            ],
+        )
+        return None, versions
+
+
+class _Reply(object):
+    # The eventual result of one call to the server. If given, callback
+    # is called with the result by the thread that reads replies, before
+    # any later message is handled, and its return value becomes the
+    # result.
+    __slots__ = ("event", "ok", "result", "callback")
+
+    def __init__(self, callback=None):
+        self.event = threading.Event()
+        self.ok = None
+        self.result = None
+        self.callback = callback
+
+    def set(self, ok, result):
+        if ok and self.callback is not None:
+            try:
+                result = self.callback(result)
+            except Exception as ex:
+                ok, result = False, ex
+        self.ok = ok
+        self.result = result
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if not self.ok:
+            raise self.result
+        return self.result
+
+
+class _Connection(object):
+    # The client end of a connection to a StateServer, holding the cache
+    # of root values and the thread that reads the server's messages.
+
+    def __init__(self, path, cache_size):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.closed = False
+        # Calls not yet sent, and the replies they will fill in.
+        self.outbox = []
+        self.batching = 0
+        # Replies for calls sent but not yet answered, in order.
+        self.waiting = collections.deque()
+        # Replies to calls made without waiting, whose errors are raised
+        # by the next call that does wait.
+        self.unchecked = []
+        # Held while changing any of the above.
+        self.send_lock = threading.Lock()
+        # slot id -> (value, positions, version), or None if the root has
+        # no value, oldest first.
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        # The newest version of each slot the server has told us of. An
+        # invalidation can overtake the answer to a read made before the
+        # commit it reports, so older values than these aren't cached.
+        self.newest = {}
+        self.cache_lock = threading.Lock()
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read(self):
+        try:
+            while True:
+                message = _recv_message(self.socket)
+                if message is None:
+                    break
+                kind, body = message
+                if kind == "invalidate":
+                    with self.cache_lock:
+                        for slot_id, version in body:
+                            self.cache.pop(slot_id, None)
+                            if version > self.newest.get(slot_id, 0):
+                                self.newest[slot_id] = version
+                else:
+                    for ok, result in body:
+                        self.waiting.popleft().set(ok, result)
+        except socket.error:
+            pass
+        finally:
+            with self.send_lock:
+                self.closed = True
+                while self.waiting:
+                    self.waiting.popleft().set(
+                        False, Exception("Lost connection to the server"),
+                    )
+
+    def call_async(self, name, args, callback=None):
+        reply = _Reply(callback)
+        with self.send_lock:
+            self.outbox.append((name, args, reply))
+            batching = self.batching
+        if not batching:
+            self.flush()
+        return reply
+
+    def call(self, name, *args, **kwargs):
+        reply = self.call_async(name, args, kwargs.get("callback"))
+        self.flush()
+        result = reply.wait()
+        self.check()
+        return result
+
+    def flush(self):
+        with self.send_lock:
+            if not self.outbox:
+                return
+            if self.closed:
+                raise Exception("Can't call the server: connection closed")
+            outbox = self.outbox
+            self.outbox = []
+            try:
+                data = _pack_message(
+                    [(name, args) for name, args, reply in outbox],
+                )
+            except Exception as ex:
+                # Nothing was sent, so the server won't answer these.
+                for name, args, reply in outbox:
+                    reply.set(False, ex)
+                raise
+            # The replies must be waiting before the server can answer.
+            self.waiting.extend(reply for name, args, reply in outbox)
+            self.socket.sendall(data)
+
+    def check(self):
+        # Raise the first error from calls made without waiting, all of
+        # which have been answered once a later call has been.
+        with self.send_lock:
+            unchecked = self.unchecked
+            self.unchecked = []
+        for reply in unchecked:
+            reply.wait()
+
+    def entry(self, slot_id):
+        with self.cache_lock:
+            try:
+                return self.cache[slot_id]
+            except KeyError:
+                pass
+        return self.fetch([slot_id])[slot_id]
+
+    def fetch(self, slot_ids):
+        return self.call("read", list(slot_ids), callback=self._store_read)
+
+    def _store_read(self, entries):
+        result = {}
+        with self.cache_lock:
+            for slot_id, entry in entries:
+                if entry is not None:
+                    (kind, data), positions, version = entry
+                    entry = (_decode(kind, data), positions, version)
+                result[slot_id] = self._store(slot_id, entry)
+        return result
+
+    def _store(self, slot_id, entry):
+        # Cache an entry unless it is older than an invalidation already
+        # received, returning it either way.
+        cache = self.cache
+        cache.pop(slot_id, None)
+        version = entry[2] if entry is not None else 0
+        if version < self.newest.get(slot_id, 0):
+            return entry
+        cache[slot_id] = entry
+        if self.cache_size is not None and len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return entry
+
+    def commit(self, items, reads=None):
+        # Commit (slot, value, positions) items. If reads are given, as a
+        # mapping from slots to the versions read, the server only makes
+        # the commit if they are all current, and this waits for it to
+        # answer, returning the id of a stale slot if it refused, or None.
+        # Otherwise any error is raised by the next call that waits.
+        changes = [
+            (slot.slot_id, _encode(value), set(positions))
+            for slot, value, positions in items
+        ]
+        # Until the server answers, reads of these slots must ask it.
+        with self.cache_lock:
+            for slot, value, positions in items:
+                self.cache.pop(slot.slot_id, None)
+
+        def store(result):
+            stale, versions = result
+            with self.cache_lock:
+                if stale is not None:
+                    # Read it again on the next attempt.
+                    self.cache.pop(stale, None)
+                    return stale
+                for (slot, value, positions), version in zip(
+                    items, versions,
+                ):
+                    self._store(
+                        slot.slot_id, (value, set(positions), version),
+                    )
+            return None
+
+        if reads is not None:
+            return self.call(
+                "commit",
+                changes,
+                [(slot.slot_id, version) for slot, version in reads.items()],
+                callback=store,
+            )
+        reply = self.call_async("commit", (changes, []), callback=store)
+        with self.send_lock:
+            # Forget commits that have already succeeded.
+            self.unchecked = [
+                other for other in self.unchecked
+                if not (other.event.is_set() and other.ok)
+            ]
+            self.unchecked.append(reply)
+
+    def close(self):
+        self.flush()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.reader.join()
+        self.socket.close()
+
+
+class _RemoteLayer(collections.MutableMapping):
+    # One view of a remote root's own state (values, positions or
+    # versions, by index into a cache entry), usable as its slot_values,
+    # slot_positions or slot_versions.
+
+    def __init__(self, root, field):
+        self.root = root
+        self.field = field
+
+    def __getitem__(self, slot):
+        entry = self.root._connection.entry(slot.slot_id)
+        if entry is None:
+            raise KeyError(slot)
+        return entry[self.field]
+
+    def __contains__(self, slot):
+        return self.root._connection.entry(slot.slot_id) is not None
+
+    def __setitem__(self, slot, value):
+        raise Exception(
+            "Can't write %r: a remote root is only changed by commits"
+            % slot
+        )
+
+    def __delitem__(self, slot):
+        raise Exception(
+            "Can't delete %r: a remote root is only changed by commits"
+            % slot
+        )
+
+    def __iter__(self):
+        root = self.root
+        for slot_id in root._connection.call("keys"):
+            yield root.slot_by_id(slot_id)
+
+    def __len__(self):
+        return len(self.root._connection.call("keys"))
+
+    def copy(self):
+        return dict(self.iteritems())
+
+
+class _RemoteConflicts(object):
+    # Stands in for a remote root's index of conflicted slots.
+
+    def __init__(self, root):
+        self.root = root
+
+    def __iter__(self):
+        root = self.root
+        for slot_id in root._connection.call("conflicts"):
+            yield root.slot_by_id(slot_id)
+
+
+class RemoteRoot(datafork.Root):
+    """
+    A root whose slots and root state belong to the :py:class:`StateServer`
+    listening at `path`.
+
+    Forks, transactions and merges between them work as they do in any
+    root, entirely within this process. Merging into the remote root
+    itself, or writing a slot while the root is the current state, sends
+    just the merged slots to the server, which commits them to its root.
+
+    Children of a remote root record the version of each slot they read
+    from it, as :py:class:`datafork.OptimisticState` does. A merge into
+    the root waits for the server, which refuses it if any of those slots
+    has been changed by another client since, in which case
+    :py:class:`datafork.TransactionConflictError` is raised and nothing is
+    committed. :py:meth:`atomically` retries such transactions, and is the
+    way to make read-modify-write changes that other clients may race.
+    Writing a slot directly in the root reads nothing, so it is sent
+    without waiting for the server's answer, and any error is raised by
+    the next call that does wait, such as :py:meth:`sync`.
+
+    Values read from the root state are cached, up to `cache_size` slots
+    at a time, with the oldest dropped first. The server tells the client
+    to drop cached slots committed by other clients, and :py:meth:`sync`
+    waits until every such message sent so far has been handled. Slots are
+    created on the server with the default `merge` and `fork` behavior,
+    but each client's own slot objects use whatever is passed to
+    :py:meth:`slot`, and the server's root always receives already-merged
+    values. Remote roots can't allocate slots in bulk, and merges into
+    them are never lazy. Since their commits are made by the server, they
+    can't take part in :py:func:`datafork.multi_transaction`, and they
+    have no change subscribers, history or write-ahead log of their own.
+    """
+
+    _remote = True
+
+    def __init__(
+        self,
+        path,
+        slot_type=datafork.Slot,
+        intern_values=False,
+        cache_size=10000,
+    ):
+        connection = _Connection(path, cache_size)
+        datafork.Root.__init__(
+            self, connection.call("hello"), slot_type, intern_values,
+        )
+        self._connection = connection
+        self.slot_values = _RemoteLayer(self, 0)
+        self.slot_positions = _RemoteLayer(self, 1)
+        self.slot_versions = _RemoteLayer(self, 2)
+        self.conflicted_slots = _RemoteConflicts(self)
+
+    def _new_slot_id(self, owner):
+        return self._connection.call("slot", owner)
+
+    def slot_by_id(self, slot_id):
+        try:
+            return self._slots_by_id[slot_id]
+        except KeyError:
+            pass
+        return self._create_slot(
+            slot_id, self._connection.call("owner", slot_id),
+        )
+
+    def allocate_slots(self, count, owner=None, **kwargs):
+        raise Exception("Can't allocate slots in bulk in a remote root")
+
+    def subscribe(self, callback, slots=None):
+        raise Exception("Can't subscribe to changes in a remote root")
+
+    def enable_history(self, size, slots=None):
+        raise Exception("Can't keep history in a remote root")
+
+    def enable_wal(self, path, sync_every=1):
+        raise Exception("Can't log a remote root; log the server's root")
+
+    def _create_child(self, owner=None):
+        return datafork.OptimisticState(self, self, owner)
+
+    def merge_children(self, children, or_none=False, lazy=False):
+        if len(children) == 0:
+            return
+        self.plan_merge(children, or_none).apply()
+
+    def plan_merge(self, children, or_none=False, fail_fast=False):
+        plan = datafork.Root.plan_merge(self, children, or_none, fail_fast)
+        # The server checks that the slots the plan was based on, and
+        # everything the children read from the root, are still current
+        # when the plan is committed, so other clients' commits in the
+        # meantime become conflicts instead of errors.
+        plan._read_versions = dict(
+            (slot, version) for (slot, merged, positions), version
+            in zip(plan._results, plan._base_versions)
+        )
+        plan._base_versions = None
+        for child in children:
+            if (
+                isinstance(child, datafork.OptimisticState) and
+                child.base is self
+            ):
+                plan._read_versions.update(child.read_versions)
+        return plan
+
+    def _commit_optimistic(self, txn):
+        try:
+            self.merge_children([txn])
+        except datafork.TransactionConflictError as ex:
+            return ex.slot
+        return None
+
+    def set_slot(self, slot, value, position=None):
+        self._connection.commit([
+            (slot, value, set([position] if position is not None else [])),
+        ])
+
+    def _apply_plan(self, plan, deferred=None):
+        self._check_plan(plan)
+        # Plans not made by plan_merge, such as those of a MergeStream,
+        # don't know what was read.
+        stale = self._connection.commit(
+            plan._results, getattr(plan, "_read_versions", {}),
+        )
+        if stale is not None:
+            raise datafork.TransactionConflictError(self.slot_by_id(stale))
+        plan.applied = True
+
+    def prefetch(self, slots):
+        """
+        Read each of the given slots' root values from the server in a
+        single call, unless they are already cached.
+        """
+        connection = self._connection
+        with connection.cache_lock:
+            missing = [
+                slot.slot_id for slot in slots
+                if slot.slot_id not in connection.cache
+            ]
+        if missing:
+            connection.fetch(missing)
+
+    def batch(self):
+        """
+        Returns a context manager within which calls to the server are held
+        back and then sent together in a single message at the end of the
+        block, or as soon as one of them needs an answer.
+        """
+        return _BatchContext(self._connection)
+
+    def sync(self):
+        """
+        Wait for the server to answer every call sent so far, raising the
+        first error from any commit. Once this returns, cached values
+        changed by other clients' commits made before it was called have
+        been dropped.
+        """
+        self._connection.call("ping")
+
+    def close(self):
+        """
+        Disconnect from the server.
+        """
+        self._connection.close()
+
+    def finalize_data(self):
+        self.prefetch(self.slots)
+        datafork.Root.finalize_data(self)
+        self.sync()
+        self.close()
+
+
+class _BatchContext(object):
+    # Returned by RemoteRoot.batch.
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        connection = self.connection
+        with connection.send_lock:
+            connection.batching += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection = self.connection
+        with connection.send_lock:
+            connection.batching -= 1
+            batching = connection.batching
+        if not batching:
+            connection.flush()
+
+
+def connect(path, **kwargs):
+    """
+    Connect to the :py:class:`StateServer` listening at `path`, returning
+    a new :py:class:`RemoteRoot`. Any keyword arguments are passed to its
+    constructor.
+    """
+    return RemoteRoot(path, **kwargs)
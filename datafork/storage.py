@@ -0,0 +1,1019 @@
+"""
+On-disk storage for state layers.
+
+A spill file is an append-only sequence of records, each holding one slot's
+value and positions. A layer whose values have been moved into such a file
+keeps only an index from stable slot ids to record offsets in memory, and
+reads values back lazily through a memory map.
+
+A write-ahead log is a separate append-only file recording each change
+committed to a root, so that the root can be rebuilt after a crash.
+"""
+
+import array
+import collections
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import datafork
+
+
+# Each record is a header followed by the encoded value and the pickled
+# positions. The header holds the value's kind and the two lengths.
+RECORD_HEADER = struct.Struct("<BQI")
+
+# Pickled arbitrary value.
+KIND_PICKLE = 0
+# A byte string, stored raw and copied on read.
+KIND_BYTES = 1
+# A read-only view such as a memoryview, stored raw and read back as a
+# zero-copy read-only view of the mapped file.
+KIND_BUFFER = 2
+# datafork.Slot.NOT_KNOWN, which can't be pickled.
+KIND_NOT_KNOWN = 3
+# A bytearray, stored raw and copied into a new bytearray on read.
+KIND_BYTEARRAY = 4
+# An array.array, stored as its typecode followed by its raw items and
+# copied into a new array on read.
+KIND_ARRAY = 5
+# A NumPy array of plain data, stored as a pickled (dtype, shape) header,
+# prefixed with its length, followed by its raw items in C order.
+KIND_NDARRAY = 6
+
+# The length prefix of a KIND_NDARRAY header.
+NDARRAY_HEADER = struct.Struct("<I")
+
+# Read-only views into other objects' memory, which is how they are
+# handed back from a mapped file.
+VIEW_TYPES = (memoryview,)
+try:
+    VIEW_TYPES += (buffer,)
+except NameError:
+    # Python 3 has no buffer type.
+    pass
+
+
+def _view(data, offset, size):
+    try:
+        return buffer(data, offset, size)
+    except NameError:
+        return memoryview(data)[offset:offset + size]
+
+
+def encode_value(value):
+    """
+    Return a ``(kind, data)`` pair for storing the given value.
+    """
+    if value is datafork.Slot.NOT_KNOWN:
+        return KIND_NOT_KNOWN, b""
+    if type(value) is bytes:
+        return KIND_BYTES, value
+    if type(value) is bytearray:
+        return KIND_BYTEARRAY, bytes(value)
+    if type(value) is array.array:
+        return KIND_ARRAY, value.typecode.encode("ascii") + value.tostring()
+    if (
+        numpy is not None and type(value) is numpy.ndarray and
+        not value.dtype.hasobject
+    ):
+        header = pickle.dumps(
+            (value.dtype, value.shape), pickle.HIGHEST_PROTOCOL,
+        )
+        return KIND_NDARRAY, (
+            NDARRAY_HEADER.pack(len(header)) + header +
+            numpy.ascontiguousarray(value).tobytes()
+        )
+    if isinstance(value, memoryview):
+        return KIND_BUFFER, value.tobytes()
+    if isinstance(value, VIEW_TYPES):
+        return KIND_BUFFER, bytes(value)
+    return KIND_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+class SpillFile(object):
+    """
+    An append-only file of slot records, read back through a memory map.
+
+    Appending never invalidates views handed out earlier: when the file
+    outgrows the current map a new map is made and the old one is left for
+    its views to keep alive.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a+b")
+        self._map = None
+        self._lock = threading.Lock()
+
+    def append(self, value, positions):
+        """
+        Append a record and return its index entry, a tuple of
+        ``(kind, value_offset, value_size, positions_offset,
+        positions_size)``.
+        """
+        kind, data = encode_value(value)
+        positions_data = pickle.dumps(
+            set(positions), pickle.HIGHEST_PROTOCOL,
+        )
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell() + RECORD_HEADER.size
+            self._file.write(
+                RECORD_HEADER.pack(kind, len(data), len(positions_data))
+            )
+            self._file.write(data)
+            self._file.write(positions_data)
+        return (
+            kind,
+            offset,
+            len(data),
+            offset + len(data),
+            len(positions_data),
+        )
+
+    def write(self, data):
+        """
+        Append raw data, returning the offset it was written at.
+        """
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            self._file.write(data)
+        return offset
+
+    def flush(self, sync=False):
+        with self._lock:
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def size(self):
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            return self._file.tell()
+
+    def _mapped(self, end):
+        current = self._map
+        if current is not None and len(current) >= end:
+            return current
+        with self._lock:
+            if self._map is None or len(self._map) < end:
+                self._file.flush()
+                self._map = mmap.mmap(
+                    self._file.fileno(), 0, access=mmap.ACCESS_READ,
+                )
+            return self._map
+
+    def view(self, offset, size):
+        """
+        Return a zero-copy read-only view of part of the file.
+        """
+        return _view(self._mapped(offset + size), offset, size)
+
+    def read(self, offset, size):
+        """
+        Return a copy of part of the file as a byte string.
+        """
+        return self._mapped(offset + size)[offset:offset + size]
+
+    def decode_value(self, entry, zero_copy=False):
+        """
+        Return the value of a record. If `zero_copy` is set, raw byte data
+        is returned as a read-only view of the file and NumPy arrays as
+        read-only arrays over it, rather than as copies of their original
+        types.
+        """
+        kind, offset, size = entry[:3]
+        if kind == KIND_PICKLE:
+            return pickle.loads(self.read(offset, size))
+        elif kind == KIND_BUFFER:
+            return self.view(offset, size)
+        elif kind in (KIND_BYTES, KIND_BYTEARRAY) and zero_copy:
+            return self.view(offset, size)
+        elif kind == KIND_BYTES:
+            return self.read(offset, size)
+        elif kind == KIND_BYTEARRAY:
+            return bytearray(self.view(offset, size))
+        elif kind == KIND_ARRAY:
+            if zero_copy:
+                return self.view(offset + 1, size - 1)
+            typecode = str(self.read(offset, 1).decode("ascii"))
+            return array.array(typecode, self.read(offset + 1, size - 1))
+        elif kind == KIND_NDARRAY:
+            return self._decode_ndarray(offset, size, zero_copy)
+        else:
+            return datafork.Slot.NOT_KNOWN
+
+    def _decode_ndarray(self, offset, size, zero_copy):
+        if numpy is None:
+            raise Exception(
+                "Can't read a NumPy array from %r: NumPy is not installed"
+                % self.path
+            )
+        header_size, = NDARRAY_HEADER.unpack(
+            self.read(offset, NDARRAY_HEADER.size),
+        )
+        offset += NDARRAY_HEADER.size
+        dtype, shape = pickle.loads(self.read(offset, header_size))
+        offset += header_size
+        size -= NDARRAY_HEADER.size + header_size
+        if size:
+            value = numpy.frombuffer(self.view(offset, size), dtype=dtype)
+        else:
+            value = numpy.empty(0, dtype=dtype)
+            value.flags.writeable = False
+        value = value.reshape(shape)
+        # The map is read-only, and so is an array over it.
+        return value if zero_copy else value.copy()
+
+    def decode_positions(self, entry):
+        return pickle.loads(self.read(entry[3], entry[4]))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._map = None
+
+
+class _SpilledMapping(collections.MutableMapping):
+    # Base for the two views of a spilled layer. Entries come from an
+    # index into a spill file, overridden by anything written since the
+    # layer was spilled. The index itself is never modified, so copies
+    # can share it.
+
+    def __init__(self, spill_file, index, slots):
+        self.spill_file = spill_file
+        # slot id -> record entry
+        self.index = index
+        # slot id -> slot, for the slots in the index
+        self.slots = slots
+        # slot -> value written since spilling
+        self.written = {}
+        # slot -> value decoded from the file
+        self.loaded = {}
+        # slots in the index that have since been deleted
+        self.deleted = set()
+        #: If set, the mapping refuses all writes.
+        self.read_only = False
+
+    def _decode(self, entry):
+        raise NotImplementedError()
+
+    def _entry(self, slot):
+        entry = self.index.get(getattr(slot, "slot_id", None))
+        if entry is None or slot in self.deleted:
+            return None
+        return entry
+
+    def __getitem__(self, slot):
+        try:
+            return self.written[slot]
+        except KeyError:
+            pass
+        try:
+            return self.loaded[slot]
+        except KeyError:
+            pass
+        entry = self._entry(slot)
+        if entry is None:
+            raise KeyError(slot)
+        value = self.loaded[slot] = self._decode(entry)
+        return value
+
+    def __contains__(self, slot):
+        return slot in self.written or self._entry(slot) is not None
+
+    def __setitem__(self, slot, value):
+        if self.read_only:
+            raise Exception("Can't write %r: layer is read-only" % slot)
+        self.written[slot] = value
+        self.loaded.pop(slot, None)
+
+    def __delitem__(self, slot):
+        if self.read_only:
+            raise Exception("Can't delete %r: layer is read-only" % slot)
+        if slot not in self:
+            raise KeyError(slot)
+        self.written.pop(slot, None)
+        self.loaded.pop(slot, None)
+        if self._entry(slot) is not None:
+            self.deleted.add(slot)
+
+    def __iter__(self):
+        for slot in self.written:
+            yield slot
+        for slot_id, slot in self.slots.iteritems():
+            if slot not in self.written and slot not in self.deleted:
+                yield slot
+
+    def __len__(self):
+        return sum(1 for slot in self)
+
+    def copy(self):
+        result = type(self)(self.spill_file, self.index, self.slots)
+        result.written = dict(self.written)
+        result.loaded = dict(self.loaded)
+        result.deleted = set(self.deleted)
+        return result
+
+    def unload(self):
+        """
+        Forget any values decoded from the file, so that their memory can
+        be reclaimed. They will be decoded again if read.
+        """
+        self.loaded.clear()
+
+
+class SpilledValues(_SpilledMapping):
+    """
+    A mapping from slots to values for a layer stored in a
+    :py:class:`SpillFile`, usable as :py:attr:`State.slot_values`.
+
+    Values are decoded when first read and then cached until
+    :py:meth:`unload` is called. Values that were themselves read-only
+    views, such as :py:class:`memoryview`, are returned as read-only views
+    of the mapped file without copying.
+    """
+
+    #: If set, raw byte data and NumPy arrays are also read without
+    #: copying; see :py:meth:`SpillFile.decode_value`.
+    zero_copy = False
+
+    def _decode(self, entry):
+        return self.spill_file.decode_value(entry, self.zero_copy)
+
+    def copy(self):
+        result = _SpilledMapping.copy(self)
+        result.zero_copy = self.zero_copy
+        return result
+
+
+class SpilledPositions(_SpilledMapping):
+    """
+    A mapping from slots to sets of positions for a layer stored in a
+    :py:class:`SpillFile`, usable as :py:attr:`State.slot_positions`.
+    """
+
+    def _decode(self, entry):
+        return self.spill_file.decode_positions(entry)
+
+
+def spill_state(state, spill_file):
+    """
+    Write the given state's own values and positions to `spill_file` and
+    replace its storage with spilled mappings reading from the file.
+
+    Values that were already spilled and not rewritten since are not
+    written again.
+    """
+    values = state.slot_values
+    index = {}
+    slots = {}
+    if isinstance(values, SpilledValues):
+        for slot_id, slot in values.slots.iteritems():
+            if slot not in values.written and slot not in values.deleted:
+                index[slot_id] = values.index[slot_id]
+                slots[slot_id] = slot
+        items = values.written.items()
+    else:
+        items = values.items()
+
+    for slot, value in items:
+        slot_id = getattr(slot, "slot_id", None)
+        if slot_id is None:
+            raise Exception(
+                "Can't spill slot %r: it has no stable id" % slot
+            )
+        index[slot_id] = spill_file.append(
+            value, state.slot_positions.get(slot, ()),
+        )
+        slots[slot_id] = slot
+    spill_file.flush()
+
+    state.slot_values = SpilledValues(spill_file, index, slots)
+    state.slot_positions = SpilledPositions(spill_file, index, slots)
+    # The old storage may still be pinned by a snapshot, but the new
+    # storage is ours alone.
+    state._pinned = False
+
+
+# A checkpoint file is a spill file whose records are followed by a pickled
+# footer describing them and then this trailer, giving the footer's offset
+# and size.
+# Incremental checkpoints append more records, a footer holding only what
+# changed and a pointer to the previous footer, and a new trailer.
+CHECKPOINT_TRAILER = struct.Struct("<QQ8s")
+CHECKPOINT_MAGIC = b"dfckpt01"
+
+
+class _RootSlots(object):
+    # Maps slot ids to the slots of a root, creating slots restored from a
+    # checkpoint only when they are first needed.
+
+    def __init__(self, root, ids):
+        self.root = root
+        self.ids = ids
+
+    def iteritems(self):
+        for slot_id in self.ids:
+            yield slot_id, self.root.slot_by_id(slot_id)
+
+    def __getitem__(self, slot_id):
+        if slot_id not in self.ids:
+            raise KeyError(slot_id)
+        return self.root.slot_by_id(slot_id)
+
+
+def _write_layer(spill_file, items):
+    # Append a record for each (slot, value, positions) item, returning
+    # the index of the records written.
+    index = {}
+    for slot, value, positions in items:
+        if slot.slot_id is None:
+            raise Exception(
+                "Can't store slot %r: it has no stable id" % slot
+            )
+        index[slot.slot_id] = spill_file.append(value, positions)
+    return index
+
+
+def _layer_items(state, slots):
+    for slot in slots:
+        yield (
+            slot,
+            state.slot_values[slot],
+            state.slot_positions.get(slot, ()),
+        )
+
+
+def _write_footer(spill_file, footer):
+    # Append the footer and the trailer pointing at it, returning the
+    # footer's location.
+    footer_data = pickle.dumps(footer, pickle.HIGHEST_PROTOCOL)
+    location = (spill_file.write(footer_data), len(footer_data))
+    spill_file.write(
+        CHECKPOINT_TRAILER.pack(location[0], location[1], CHECKPOINT_MAGIC)
+    )
+    spill_file.flush(sync=True)
+    return location
+
+
+def _encode_defaults(ranges):
+    # Slot default ranges, with NOT_KNOWN (which can't be pickled) tagged
+    # as in a spill record.
+    return [
+        (start, end, KIND_NOT_KNOWN, None, factory)
+        if default is datafork.Slot.NOT_KNOWN
+        else (start, end, KIND_PICKLE, default, factory)
+        for start, end, default, factory in ranges
+    ]
+
+
+def _decode_defaults(ranges):
+    return [
+        (
+            start,
+            end,
+            datafork.Slot.NOT_KNOWN if kind == KIND_NOT_KNOWN else default,
+            factory,
+        )
+        for start, end, kind, default, factory in ranges
+    ]
+
+
+def _conflict_ids(state):
+    return [slot.slot_id for slot in state.conflicted_slots]
+
+
+def write_checkpoint(root, path, incremental=False, include_states=False):
+    """
+    Implementation of :py:meth:`datafork.Root.checkpoint`.
+    """
+    previous = root._checkpoint
+    if incremental and (previous is None or previous["path"] != path):
+        raise Exception(
+            "Can't write incremental checkpoint of %r to %r: "
+            "no previous checkpoint there" % (root, path)
+        )
+
+    # Any write made after this point gets a greater version, and so is
+    # picked up by the next incremental checkpoint.
+    version = next(datafork._versions)
+    next_slot_id = root._next_slot_id
+
+    if incremental:
+        spill_file = previous["file"]
+        since = previous["version"]
+        first_slot_id = previous["next_slot_id"]
+        slots = [
+            slot for slot, slot_version in root.slot_versions.items()
+            if slot_version > since
+        ]
+    else:
+        temp_path = path + ".tmp"
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        spill_file = SpillFile(temp_path)
+        first_slot_id = 0
+        slots = list(root.slot_values)
+
+    # Defaults made by factories may have been modified in place, so they
+    # are saved as if they had been written to the root.
+    made = [
+        (slot, value, ())
+        for slot, value in root._defaults.made.items()
+        if slot not in root.slot_values
+    ]
+    index = _write_layer(spill_file, _layer_items(root, slots))
+    index.update(_write_layer(spill_file, made))
+    footer = {
+        "previous": previous["footer"] if incremental else None,
+        "owner": root.owner,
+        "index": index,
+        "slots": root._slot_owners(first_slot_id, next_slot_id),
+        "next_slot_id": next_slot_id,
+        "defaults": _encode_defaults(root._defaults.ranges),
+        # Every conflicted slot, not just those written since the previous
+        # checkpoint, since conflicts may have been resolved meanwhile.
+        "conflicts": _conflict_ids(root),
+        "states": None,
+    }
+    if include_states:
+        chain = []
+        state = root.current_state
+        while state is not root:
+            chain.append(state)
+            state = state.parent
+        footer["states"] = [
+            (
+                state.owner,
+                _write_layer(
+                    spill_file, _layer_items(state, list(state.slot_values)),
+                ),
+                _conflict_ids(state),
+            )
+            for state in reversed(chain)
+        ]
+
+    footer_location = _write_footer(spill_file, footer)
+    if not incremental:
+        os.rename(temp_path, path)
+        spill_file.path = path
+        # Anything still reading the file we replaced keeps its own handle.
+        root._spill_files[path] = spill_file
+
+    root._checkpoint = {
+        "path": path,
+        "file": spill_file,
+        "footer": footer_location,
+        "version": version,
+        "next_slot_id": next_slot_id,
+    }
+
+
+def _read_footers(spill_file):
+    # Return the (location, footer) pairs of every checkpoint in the file,
+    # oldest first.
+    size = spill_file.size()
+    if size < CHECKPOINT_TRAILER.size:
+        raise Exception("%r is not a checkpoint" % spill_file.path)
+    trailer = spill_file.read(
+        size - CHECKPOINT_TRAILER.size, CHECKPOINT_TRAILER.size,
+    )
+    offset, length, magic = CHECKPOINT_TRAILER.unpack(trailer)
+    if magic != CHECKPOINT_MAGIC:
+        raise Exception("%r is not a checkpoint" % spill_file.path)
+
+    footers = []
+    location = (offset, length)
+    while location is not None:
+        footer = pickle.loads(spill_file.read(*location))
+        footers.append((location, footer))
+        location = footer["previous"]
+    footers.reverse()
+    return footers
+
+
+def restore_checkpoint(root_type, path, **kwargs):
+    """
+    Implementation of :py:meth:`datafork.Root.restore`.
+    """
+    spill_file = SpillFile(path)
+    footers = _read_footers(spill_file)
+
+    index = {}
+    slot_owners = {}
+    for offset, footer in footers:
+        index.update(footer["index"])
+        slot_owners.update(footer["slots"])
+    latest_location, latest = footers[-1]
+
+    root = root_type(root_owner=latest["owner"], **kwargs)
+    root._restore_slots(slot_owners, latest["next_slot_id"])
+    root._defaults.restore(_decode_defaults(latest.get("defaults", ())))
+
+    def install(state, layer_index, conflicts):
+        slots = _RootSlots(root, layer_index)
+        state.slot_values = SpilledValues(spill_file, layer_index, slots)
+        state.slot_positions = SpilledPositions(
+            spill_file, layer_index, slots,
+        )
+        state.conflicted_slots = set(
+            root.slot_by_id(slot_id) for slot_id in conflicts
+        )
+
+    install(root, index, latest["conflicts"])
+    state = root
+    for owner, layer_index, conflicts in latest["states"] or ():
+        state = state._create_child(owner)
+        install(state, layer_index, conflicts)
+    root.current_state = state
+
+    root._spill_files[path] = spill_file
+    root._checkpoint = {
+        "path": path,
+        "file": spill_file,
+        "footer": latest_location,
+        "version": next(datafork._versions),
+        "next_slot_id": latest["next_slot_id"],
+    }
+    return root
+
+
+# Where published layers go by default: a RAM-backed filesystem if there is
+# one, so that attaching workers share the publisher's pages.
+SHARED_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class SharedLayer(object):
+    """
+    A handle on a layer published by :py:meth:`datafork.State.publish`.
+    """
+
+    def __init__(self, path):
+        #: Path of the published file, to be passed to :py:func:`attach`.
+        self.path = path
+
+    def unlink(self):
+        """
+        Remove the published file. Workers that are already attached keep
+        their mappings.
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.unlink()
+
+
+def publish_state(state, directory=None):
+    """
+    Implementation of :py:meth:`datafork.State.publish`.
+    """
+    import tempfile
+
+    root = state.root
+    # Read the layers in place rather than through state.snapshot(), which
+    # would pin them so that the next write to each copied its storage.
+    state._materialize_all()
+    layers = []
+    current = state
+    while current is not None:
+        layers.append((current.slot_values, current.slot_positions))
+        current = current.parent
+    visible = datafork.Snapshot(layers)
+    handle, path = tempfile.mkstemp(
+        prefix="datafork-", dir=directory or SHARED_DIRECTORY,
+    )
+    os.close(handle)
+    spill_file = SpillFile(path)
+    try:
+        index = _write_layer(
+            spill_file,
+            (
+                (slot, value, visible.get_slot_positions(slot))
+                for slot, value in visible.iteritems()
+            ),
+        )
+        # As in a checkpoint, defaults made by factories are published as
+        # if they had been written, and the rest travel in the footer.
+        index.update(_write_layer(
+            spill_file,
+            [
+                (slot, value, ())
+                for slot, value in root._defaults.made.items()
+                if slot not in visible
+            ],
+        ))
+        _write_footer(spill_file, {
+            "previous": None,
+            "owner": root.owner,
+            "index": index,
+            "slots": root._slot_owners(0, root._next_slot_id),
+            "next_slot_id": root._next_slot_id,
+            "defaults": _encode_defaults(root._defaults.ranges),
+            "conflicts": [slot.slot_id for slot in state.conflicts()],
+            "states": None,
+        })
+    finally:
+        spill_file.close()
+    return SharedLayer(path)
+
+
+def attach(path, owner=None):
+    """
+    Attach to a layer published by :py:meth:`datafork.State.publish`,
+    typically from another process, and return a new
+    :py:class:`datafork.Root` whose state is read-only and backed directly
+    by the published file.
+
+    The returned root's current state is a fresh child, owned by `owner`,
+    so that slot writes made in the worker stay local. Use
+    :py:meth:`datafork.State.export_changes` on that child to obtain the
+    writes for shipping back to the publisher. Slots are looked up with
+    :py:meth:`datafork.Root.slot_by_id`, using the publisher's slot ids.
+
+    Published byte strings, :py:class:`bytearray` and
+    :py:class:`array.array` values read back as read-only views of their
+    raw bytes in the shared pages, and NumPy arrays as read-only arrays
+    over them, so none of them is copied. Other values are unpickled when
+    first read.
+    """
+    root = restore_checkpoint(datafork.Root, path)
+    root.slot_values.zero_copy = True
+    root.slot_values.read_only = True
+    root.slot_positions.read_only = True
+    root.current_state = root._create_child(owner)
+    return root
+
+
+# Each write-ahead log record is this header, giving the size and CRC-32 of
+# the payload, followed by the pickled payload.
+WAL_HEADER = struct.Struct("<II")
+
+
+def _wal_change(slot, value, positions):
+    # Values the spill format treats specially are tagged the same way, so
+    # that NOT_KNOWN survives and buffer views can be pickled.
+    if slot.slot_id is None:
+        raise Exception("Can't log slot %r: it has no stable id" % slot)
+    if value is datafork.Slot.NOT_KNOWN:
+        return slot.slot_id, KIND_NOT_KNOWN, None, set(positions)
+    if isinstance(value, VIEW_TYPES):
+        return slot.slot_id, KIND_BUFFER, bytes(value), set(positions)
+    return slot.slot_id, KIND_PICKLE, value, set(positions)
+
+
+def _read_wal(path):
+    # Yield (end offset, payload) for each intact record in the log at
+    # path, stopping at the first one that is truncated or corrupt.
+    with open(path, "rb") as f:
+        offset = 0
+        while True:
+            header = f.read(WAL_HEADER.size)
+            if len(header) < WAL_HEADER.size:
+                return
+            size, crc = WAL_HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size or zlib.crc32(data) & 0xffffffff != crc:
+                return
+            offset += WAL_HEADER.size + size
+            yield offset, pickle.loads(data)
+
+
+class WriteAheadLog(object):
+    """
+    An append-only log of the changes committed to a root state, started
+    by :py:meth:`datafork.Root.enable_wal`.
+
+    Each merge into the root is written as a single record holding the
+    stable id, value and positions of every slot it changed, framed with
+    its length and a CRC-32 so that a record torn by a crash is detected
+    and ignored. Records are flushed to the operating system as they are
+    written and synced to disk after every `sync_every` records, or never
+    if `sync_every` is 0, trading durability on power loss for throughput.
+
+    The initial values of slots created in the root don't get records of
+    their own. They are held back and included in the next record, or
+    written when the log is synced or closed, so that creating many slots
+    costs one record rather than one each.
+    """
+
+    def __init__(self, path, sync_every=1):
+        self.path = path
+        self.sync_every = sync_every
+        end = 0
+        #: The number of intact records already in the log when opened.
+        self.records = 0
+        if os.path.exists(path) and os.path.getsize(path):
+            for end, payload in _read_wal(path):
+                self.records += 1
+            # Refuse to overwrite a file that isn't a log at all.
+            if not end:
+                raise Exception("%r is not a write-ahead log" % path)
+        self._file = open(path, "ab")
+        # Drop anything after the last intact record, so that new records
+        # follow on from it.
+        self._file.truncate(end)
+        self._unsynced = 0
+        # How much of the root's slot table and defaults the log covers.
+        self._next_slot_id = 0
+        self._defaults_count = 0
+        # Encoded initial values of slots created since the last record,
+        # which go at the start of the next one, and the root they belong
+        # to.
+        self._created = []
+        self._root = None
+
+    def _record(self, root, changes, **extra):
+        # Encode a record, including whatever part of the root's slot table
+        # and defaults the log doesn't cover yet, and any initial values
+        # held back.
+        created = self._created
+        if created:
+            changes = created + changes
+        payload = {
+            "slots": root._slot_owners(
+                self._next_slot_id, root._next_slot_id,
+            ),
+            "next_slot_id": root._next_slot_id,
+            "defaults": _encode_defaults(
+                root._defaults.ranges[self._defaults_count:],
+            ),
+            "changes": changes,
+        }
+        payload.update(extra)
+        data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+        return (
+            root._next_slot_id,
+            len(root._defaults.ranges),
+            len(created),
+            WAL_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data,
+        )
+
+    def _write(self, f, record):
+        self._next_slot_id, self._defaults_count, created, data = record
+        f.write(data)
+        f.flush()
+        del self._created[:created]
+
+    def log_initial(self, root, slot, value, positions):
+        """
+        Hold back the initial value of a slot just created in `root`, to be
+        written with the next record.
+        """
+        self._created.append(_wal_change(slot, value, positions))
+        self._root = root
+
+    def prepare(self, root, items):
+        """
+        Encode a record of the given ``(slot, value, positions)`` items to
+        be committed to `root`, without writing it, for
+        :py:meth:`write_prepared`. Raises if any value can't be logged, so
+        that a commit can be abandoned before anything is written.
+        """
+        return self._record(
+            root,
+            [
+                _wal_change(slot, value, positions)
+                for slot, value, positions in items
+            ],
+        )
+
+    def write_prepared(self, record):
+        """
+        Append a record returned by :py:meth:`prepare`.
+        """
+        self._write(self._file, record)
+        self._unsynced += 1
+        if self.sync_every and self._unsynced >= self.sync_every:
+            self.sync()
+
+    def log(self, root, items):
+        """
+        Append a record of the given ``(slot, value, positions)`` items
+        committed to `root`.
+        """
+        self.write_prepared(self.prepare(root, items))
+
+    def sync(self):
+        """
+        Force every record written so far, and any initial values held
+        back, to disk.
+        """
+        if self._created:
+            self._write(self._file, self._record(self._root, []))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def reset(self, root, checkpoint=None):
+        """
+        Replace the log with one that starts from the current state of
+        `root`: either a reference to the checkpoint at `checkpoint`, which
+        must hold everything committed to the root, or otherwise a copy of
+        every value in the root state.
+
+        The new log is written alongside and renamed over the old one, so
+        the log on disk is always complete.
+        """
+        self._next_slot_id = 0
+        self._defaults_count = 0
+        # The new log starts with everything in the root, initial values
+        # included.
+        del self._created[:]
+        if checkpoint is not None:
+            self._next_slot_id = root._next_slot_id
+            self._defaults_count = len(root._defaults.ranges)
+            record = self._record(
+                root,
+                [],
+                owner=root.owner,
+                checkpoint=os.path.abspath(checkpoint),
+            )
+        else:
+            record = self._record(
+                root,
+                [
+                    _wal_change(
+                        slot,
+                        root.slot_values[slot],
+                        root.slot_positions.get(slot, ()),
+                    )
+                    for slot in list(root.slot_values)
+                ],
+                owner=root.owner,
+            )
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as f:
+            self._write(f, record)
+            os.fsync(f.fileno())
+        os.rename(temp_path, self.path)
+        self._file.close()
+        self._file = open(self.path, "ab")
+        self._unsynced = 0
+
+    def close(self):
+        if self._unsynced or self._created:
+            self.sync()
+        self._file.close()
+
+
+def _replay_wal_record(root, payload):
+    for slot_id, owner in payload["slots"].iteritems():
+        if slot_id not in root._slots_by_id:
+            root._restored_owners[slot_id] = owner
+    root._next_slot_id = max(root._next_slot_id, payload["next_slot_id"])
+    root._defaults.restore(_decode_defaults(payload["defaults"]))
+    for slot_id, kind, value, positions in payload["changes"]:
+        if kind == KIND_NOT_KNOWN:
+            value = datafork.Slot.NOT_KNOWN
+        elif kind == KIND_BUFFER:
+            value = _view(value, 0, len(value))
+        slot = root.slot_by_id(slot_id)
+        root.slot_values[slot] = value
+        root.slot_positions[slot] = positions
+        root.slot_versions[slot] = next(datafork._versions)
+        if type(value) is datafork.MergeConflict:
+            root.conflicted_slots.add(slot)
+        else:
+            root.conflicted_slots.discard(slot)
+
+
+def recover_root(root_type, path, sync_every=1, **kwargs):
+    """
+    Implementation of :py:meth:`datafork.Root.recover`.
+    """
+    records = [payload for end, payload in _read_wal(path)]
+    if not records:
+        raise Exception("%r is not a write-ahead log" % path)
+    base = records[0]
+    if base.get("checkpoint") is not None:
+        root = restore_checkpoint(root_type, base["checkpoint"], **kwargs)
+    else:
+        root = root_type(root_owner=base.get("owner"), **kwargs)
+    for payload in records:
+        _replay_wal_record(root, payload)
+
+    wal = WriteAheadLog(path, sync_every)
+    wal._next_slot_id = root._next_slot_id
+    wal._defaults_count = len(root._defaults.ranges)
+    root._hooks.wal = wal
+    return root
@@ -13,6 +13,8 @@ class TestImport(unittest.TestCase):
                 'MergeConflict',
                 'ValueNotKnownError',
                 'ValueAmbiguousError',
+                'TransactionConflictError',
                 'root',
+                'multi_transaction',
             ],
         )
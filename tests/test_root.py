@@ -36,3 +36,995 @@ class TestRoot(unittest.TestCase):
             root.current_state,
             root,
         )
+
+    def test_slot_type(self):
+        initial_values = []
+
+        class RecordingSlot(datafork.Slot):
+            def __init__(self, root, owner=None, initial_value=None, **kw):
+                initial_values.append(initial_value)
+                datafork.Slot.__init__(self, root, owner, initial_value, **kw)
+
+        root = datafork.Root(slot_type=RecordingSlot)
+        slot_a = root.slot(initial_value=5)
+        slot_b = root.slot()
+        slot_c, = root.allocate_slots(1, default=3)
+        # the slot type only ever sees ordinary initial values
+        self.assertEqual(
+            initial_values,
+            [5, datafork.Slot.NOT_KNOWN, datafork.Slot.NOT_KNOWN],
+        )
+        self.assertEqual(
+            [type(slot) for slot in (slot_a, slot_b, slot_c)],
+            [RecordingSlot] * 3,
+        )
+        self.assertEqual(
+            (slot_a.value, slot_b.value_is_known, slot_c.value),
+            (5, False, 3),
+        )
+
+        # any callable can make the slots
+        def make_slot(root, owner=None, initial_value=None, **kw):
+            return RecordingSlot(root, owner, initial_value, **kw)
+
+        root = datafork.Root(slot_type=make_slot)
+        slot_d = root.slot(initial_value=6)
+        self.assertEqual(
+            (type(slot_d), slot_d.value, root.slot_by_id(slot_d.slot_id)),
+            (RecordingSlot, 6, slot_d),
+        )
+
+
+class TestAllocateSlots(unittest.TestCase):
+
+    def test_default(self):
+        root = datafork.Root()
+        with root.fork() as child_state:
+            slots = root.allocate_slots(3, 'owner', default=7)
+        # nothing was written to either state
+        self.assertEqual(child_state.slot_values, {})
+        self.assertEqual(root.slot_values, {})
+        self.assertEqual(
+            [slot.slot_id for slot in slots],
+            [0, 1, 2],
+        )
+        self.assertEqual(root.slots_by_owner('owner'), set(slots))
+        self.assertEqual(root.slot_by_id(1), slots[1])
+
+        other = root.slot(initial_value=1)
+        with root.fork():
+            self.assertEqual(slots[0].value, 7)
+            slots[0].value = 8
+            self.assertEqual(slots[0].value, 8)
+        self.assertEqual(slots[0].value, 7)
+        self.assertEqual(root.snapshot()[slots[2]], 7)
+        self.assertEqual(other.value, 1)
+
+    def test_not_known(self):
+        root = datafork.Root()
+        slot, = root.allocate_slots(1)
+        self.assertFalse(slot.value_is_known)
+
+    def test_factory(self):
+        root = datafork.Root()
+        made = []
+
+        def factory():
+            made.append(None)
+            return []
+
+        slots = root.allocate_slots(
+            1000, default_factory=factory, fork=list,
+        )
+        self.assertEqual(made, [])
+        slots[5].value.append(1)
+        self.assertEqual(slots[5].value, [1])
+        self.assertEqual(slots[6].value, [])
+        self.assertEqual(len(made), 2)
+
+        with root.fork():
+            slots[5].value.append(2)
+            self.assertEqual(slots[5].value, [1, 2])
+        self.assertEqual(slots[5].value, [1])
+
+        self.assertRaises(
+            Exception,
+            lambda: root.allocate_slots(1, default=1, default_factory=list),
+        )
+
+
+class TestSearch(unittest.TestCase):
+
+    def setUp(self):
+        self.root = datafork.Root()
+        self.total = self.root.slot(initial_value=0)
+        self.steps = self.root.slot(initial_value=())
+
+    def expand(self, state):
+        def add(amount):
+            def decision():
+                self.total.value = self.total.value + amount
+                self.steps.value = self.steps.value + (amount,)
+            return decision
+        return [add(amount) for amount in (1, 3, 5)]
+
+    def score(self, state):
+        # aim for exactly 11
+        return -abs(11 - self.total.value)
+
+    def test_search(self):
+        result_score, result_state = self.root.search(
+            self.expand,
+            self.score,
+            beam_width=3,
+            max_depth=4,
+        )
+
+        self.assertEqual(
+            result_score,
+            0,
+        )
+        self.assertEqual(
+            self.root.get_slot_value(self.total),
+            11,
+        )
+        self.assertEqual(
+            sum(self.root.get_slot_value(self.steps)),
+            11,
+        )
+        self.assertTrue(
+            self.root.current_state is self.root,
+        )
+
+    def test_search_prune(self):
+        # Always stepping by five overshoots on the third level, which
+        # the score function prunes, emptying the frontier.
+        def expand(state):
+            return self.expand(state)[-1:]
+
+        def score(state):
+            if self.total.value > 11:
+                return None
+            return self.score(state)
+
+        result_score, result_state = self.root.search(expand, score)
+
+        self.assertEqual(
+            self.root.get_slot_value(self.total),
+            10,
+        )
+        self.assertEqual(
+            result_score,
+            -1,
+        )
+
+    def test_search_min_score(self):
+        def expand(state):
+            return self.expand(state)[-1:]
+
+        result_score, result_state = self.root.search(
+            expand,
+            self.score,
+            min_score=-5,
+        )
+
+        self.assertTrue(
+            result_state is self.root,
+        )
+        self.assertEqual(
+            self.root.get_slot_value(self.total),
+            0,
+        )
+
+    def test_search_no_improvement(self):
+        self.total.value = 11
+        result_score, result_state = self.root.search(
+            self.expand,
+            self.score,
+            max_depth=2,
+        )
+
+        self.assertTrue(
+            result_state is self.root,
+        )
+        self.assertEqual(
+            self.root.get_slot_value(self.steps),
+            (),
+        )
+
+    def test_search_memory_budget(self):
+        seen_frontiers = []
+
+        def expand(state):
+            seen_frontiers.append(state)
+            return self.expand(state)
+
+        self.root.search(
+            expand,
+            self.score,
+            beam_width=3,
+            max_depth=3,
+            memory_budget=4,
+        )
+
+        # each child writes two slots, so only two children fit in the
+        # budget at the first level and one at each level after that.
+        self.assertEqual(
+            len(seen_frontiers),
+            1 + 2 + 1,
+        )
+
+    def test_search_pool(self):
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(3)
+        try:
+            result_score, result_state = self.root.search(
+                self.expand,
+                self.score,
+                beam_width=3,
+                max_depth=4,
+                pool=pool,
+            )
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(
+            self.root.get_slot_value(self.total),
+            11,
+        )
+
+
+class TestStats(unittest.TestCase):
+
+    def test_disabled(self):
+        root = datafork.Root()
+        self.assertEqual(
+            root.stats(),
+            None,
+        )
+
+    def test_stats(self):
+        exported = []
+        root = datafork.Root()
+        root.enable_stats(exporter=exported.append)
+        slot_a = root.slot(initial_value=[], fork=list)
+        slot_b = root.slot(initial_value=1)
+
+        with root.transaction() as child_state:
+            with child_state.transaction():
+                slot_a.value.append(1)
+        try:
+            with root.transaction():
+                raise KeyError('dummy')
+        except KeyError:
+            pass
+        with root.fork() as child_1:
+            slot_b.value = 2
+        with root.fork() as child_2:
+            slot_b.value = 3
+        root.merge_children([child_1, child_2])
+
+        stats = root.stats()
+        self.assertEqual(
+            stats["states_created"],
+            5,
+        )
+        self.assertEqual(
+            stats["states_discarded"],
+            1,
+        )
+        self.assertEqual(
+            stats["forks"],
+            1,
+        )
+        # the first read of slot_a happened two levels below the root
+        self.assertEqual(
+            stats["walk_lengths"],
+            {3: 1},
+        )
+        self.assertEqual(
+            stats["merges"],
+            3,
+        )
+        self.assertEqual(
+            stats["merged_slots"],
+            3,
+        )
+        self.assertEqual(
+            stats["merge_conflicts"],
+            1,
+        )
+
+        root.export_stats()
+        self.assertEqual(
+            exported,
+            [stats],
+        )
+
+        root.finalize_data()
+        self.assertTrue(
+            exported[-1]["finalize_time"] is not None,
+        )
+
+    def test_lazy_merge(self):
+        root = datafork.Root()
+        slot_a = root.slot(initial_value=1)
+        slot_b = root.slot(initial_value=1)
+        root.enable_stats()
+
+        with root.fork() as parent_state:
+            children = []
+            for value in (2, 3):
+                with parent_state.fork() as child_state:
+                    slot_a.value = value
+                    slot_b.value = 2
+                children.append(child_state)
+        parent_state.merge_children(children, lazy=True)
+
+        stats = root.stats()
+        self.assertEqual(
+            (stats["merges"], stats["merged_slots"]),
+            (1, 0),
+        )
+        with parent_state.fork():
+            self.assertEqual(slot_b.value, 2)
+        stats = root.stats()
+        # materializing a slot doesn't count as another merge
+        self.assertEqual(
+            (
+                stats["merges"],
+                stats["merged_slots"],
+                stats["materialized_slots"],
+                stats["merge_conflicts"],
+            ),
+            (1, 1, 1, 0),
+        )
+        parent_state.conflicts()
+        stats = root.stats()
+        self.assertEqual(
+            (
+                stats["merges"],
+                stats["merged_slots"],
+                stats["materialized_slots"],
+                stats["merge_conflicts"],
+            ),
+            (1, 2, 2, 1),
+        )
+
+    def test_discard_counted(self):
+        root = datafork.Root()
+        root.enable_stats()
+        slot = root.slot(initial_value=1)
+
+        with root.fork() as child_1:
+            slot.value = 2
+        with root.fork() as child_2:
+            slot.value = 3
+        child_1.discard()
+        root.merge_children([child_2])
+        # merged states don't count as discarded
+        child_2.discard()
+        self.assertEqual(
+            root.stats()["states_discarded"],
+            1,
+        )
+
+        # atomically transactions that conflict or raise do
+        calls = []
+
+        def increment():
+            value = slot.value
+            if not calls:
+                def interfere():
+                    slot.value = 10
+                root.atomically(interfere)
+            calls.append(value)
+            slot.value = value + 1
+
+        def fail():
+            slot.value = 5
+            raise KeyError('dummy')
+
+        root.atomically(increment)
+        self.assertRaises(KeyError, lambda: root.atomically(fail))
+        self.assertEqual(
+            root.stats()["states_discarded"],
+            3,
+        )
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_disabled(self):
+        root = datafork.Root()
+        self.assertEqual(
+            root.profile_report(),
+            None,
+        )
+
+    def test_profiling(self):
+        spans = []
+
+        class Span(object):
+            def __init__(self, name, owner):
+                self.name = name
+                self.owner = owner
+            def __enter__(self):
+                spans.append(("enter", self.name, self.owner))
+            def __exit__(self, exc_type, exc_value, traceback):
+                spans.append(("exit", self.name, self.owner))
+
+        root = datafork.Root('root_owner')
+        profiler = root.enable_profiling(span_hook=Span)
+        slot_a = root.slot('a', initial_value=[], fork=list)
+        slot_b = root.slot('b', initial_value=1)
+
+        with root.transaction('txn_owner'):
+            slot_a.value.append(1)
+            slot_b.value = 2
+            slot_b.value
+
+        costs = profiler.costs
+        self.assertEqual(
+            costs[("write", 'b')][0],
+            2,
+        )
+        self.assertEqual(
+            costs[("read", 'a')][0],
+            # once by the caller, once by the merge
+            2,
+        )
+        self.assertEqual(
+            costs[("slot_fork", 'a')][0],
+            1,
+        )
+        self.assertEqual(
+            costs[("slot_merge", 'a')][0],
+            1,
+        )
+        self.assertEqual(
+            costs[("transaction", 'txn_owner')][0],
+            1,
+        )
+        self.assertEqual(
+            costs[("merge", 'root_owner')][0],
+            1,
+        )
+        self.assertEqual(
+            costs[("merge", 'root_owner')][2],
+            2,
+        )
+
+        self.assertEqual(
+            spans,
+            [
+                ("enter", "transaction", 'txn_owner'),
+                ("enter", "merge_children", 'root_owner'),
+                ("exit", "merge_children", 'root_owner'),
+                ("exit", "transaction", 'txn_owner'),
+            ],
+        )
+
+        report = dict(root.profile_report())
+        self.assertEqual(
+            set(report),
+            {'a', 'b', 'txn_owner', 'root_owner'},
+        )
+        self.assertEqual(
+            report['b']["kinds"]["write"]["count"],
+            2,
+        )
+        self.assertEqual(
+            len(root.profile_report(top=1)),
+            1,
+        )
+
+    def test_profile_unhashable_owner(self):
+        owner = {'a': 1}
+        root = datafork.Root()
+        root.enable_profiling()
+        slot = root.slot(owner=owner, initial_value=0)
+        with root.transaction(owner=['txn']):
+            slot.value = slot.value + 1
+        report = root.profile_report()
+        self.assertTrue(
+            any(
+                reported is owner and summary["kinds"]["write"]["count"] == 2
+                for reported, summary in report
+            ),
+        )
+        self.assertTrue(
+            any(reported == ['txn'] for reported, summary in report),
+        )
+
+    def test_span_closed_on_error(self):
+        spans = []
+
+        class Span(object):
+            def __init__(self, name, owner):
+                self.name = name
+            def __enter__(self):
+                spans.append(("enter", self.name))
+            def __exit__(self, exc_type, exc_value, traceback):
+                spans.append(("exit", self.name, exc_type))
+
+        def bad_merge(cases):
+            raise ValueError()
+
+        root = datafork.Root()
+        root.enable_profiling(span_hook=Span)
+        slot = root.slot(initial_value=1, merge=bad_merge)
+        with root.fork() as child_state:
+            slot.value = 2
+        self.assertRaises(
+            ValueError,
+            lambda: root.merge_children([child_state]),
+        )
+        self.assertEqual(
+            spans[-2:],
+            [
+                ("enter", "merge_children"),
+                ("exit", "merge_children", ValueError),
+            ],
+        )
+
+
+class TestSubscribe(unittest.TestCase):
+
+    def setUp(self):
+        self.root = datafork.Root()
+        self.slot_a = self.root.slot(initial_value=1)
+        self.slot_b = self.root.slot(initial_value=2)
+        self.slot_c = self.root.slot(initial_value=3)
+
+    def summarize(self, changes):
+        return {
+            change.slot: (change.old_value, change.new_value)
+            for change in changes
+        }
+
+    def test_subscribe(self):
+        everything = []
+        only_a = []
+        only_c = []
+        self.root.subscribe(everything.append)
+        self.slot_a.subscribe(only_a.append)
+        self.root.subscribe(only_c.append, [self.slot_c])
+
+        with self.root.transaction() as child_state:
+            self.slot_a.set_value(10, position="child_a")
+            with child_state.transaction():
+                self.slot_b.value = 20
+            # unchanged values are not reported
+            self.slot_c.value = 3
+
+        self.assertEqual(
+            len(everything),
+            1,
+        )
+        self.assertEqual(
+            self.summarize(everything[0]),
+            {
+                self.slot_a: (1, 10),
+                self.slot_b: (2, 20),
+            },
+        )
+        self.assertEqual(
+            self.summarize(only_a[0]),
+            {
+                self.slot_a: (1, 10),
+            },
+        )
+        self.assertEqual(
+            only_a[0][0].new_positions,
+            {"child_a"},
+        )
+        self.assertEqual(
+            only_c,
+            [],
+        )
+
+    def test_cancel(self):
+        received = []
+        subscription = self.slot_a.subscribe(received.append)
+        subscription.cancel()
+
+        with self.root.transaction():
+            self.slot_a.value = 10
+
+        self.assertEqual(
+            received,
+            [],
+        )
+
+    def test_coalesce(self):
+        received = []
+        self.root.subscribe(received.append)
+
+        with self.root.coalesce_changes():
+            with self.root.transaction():
+                self.slot_a.value = 10
+                self.slot_b.value = 20
+            with self.root.transaction():
+                self.slot_a.value = 11
+                self.slot_b.value = 2
+            self.assertEqual(
+                received,
+                [],
+            )
+
+        self.assertEqual(
+            len(received),
+            1,
+        )
+        self.assertEqual(
+            self.summarize(received[0]),
+            {
+                self.slot_a: (1, 11),
+            },
+        )
+
+
+class TestIntern(unittest.TestCase):
+
+    def test_intern_value(self):
+        root = datafork.Root()
+        first = ("a", 1)
+        self.assertTrue(
+            root.intern_value(first) is first,
+        )
+        self.assertTrue(
+            root.intern_value(("a", 1)) is first,
+        )
+        # equal values of other types are kept separate
+        self.assertTrue(
+            type(root.intern_value(1.0)) is float,
+        )
+        self.assertTrue(
+            type(root.intern_value(1)) is int,
+        )
+        self.assertTrue(
+            type(root.intern_value((1, 2))[0]) is int,
+        )
+        self.assertTrue(
+            type(root.intern_value((1.0, 2))[0]) is float,
+        )
+        self.assertEqual(
+            str(root.intern_value(0.0)),
+            "0.0",
+        )
+        self.assertEqual(
+            str(root.intern_value(-0.0)),
+            "-0.0",
+        )
+        unhashable = [1]
+        self.assertTrue(
+            root.intern_value(unhashable) is unhashable,
+        )
+        other = frozenset([1])
+        self.assertTrue(
+            root.intern_value(other) is other,
+        )
+
+    def test_interned_slots(self):
+        root = datafork.Root(intern_values=True)
+        slot = root.slot()
+        plain_slot = root.slot(intern=False)
+
+        values = []
+        plain_values = []
+        for i in range(3):
+            with root.fork():
+                slot.value = tuple(range(5))
+                plain_slot.value = tuple(range(5))
+                values.append(slot.value)
+                plain_values.append(plain_slot.value)
+
+        self.assertTrue(
+            values[0] is values[1] is values[2],
+        )
+        self.assertFalse(
+            plain_values[0] is plain_values[1],
+        )
+
+
+class TestHistory(unittest.TestCase):
+
+    def test_history(self):
+        root = datafork.Root()
+        slot_a = root.slot(initial_value=1)
+        slot_b = root.slot(initial_value='x')
+        root.enable_history(2)
+
+        first = root.current_version()
+        with root.transaction():
+            slot_a.set_value(2, position="second")
+        second = root.current_version()
+        with root.transaction():
+            # changes in uncommitted child states aren't recorded
+            with root.fork():
+                slot_a.value = 100
+            slot_a.value = 3
+        third = root.current_version()
+
+        self.assertEqual(
+            slot_a.value_at(third),
+            3,
+        )
+        self.assertEqual(
+            slot_a.value_at(second),
+            2,
+        )
+        self.assertEqual(
+            root.as_of(second).get_slot_positions(slot_a),
+            {"second"},
+        )
+        # only two entries are kept, so the first value is gone
+        self.assertRaises(
+            datafork.ValueNotKnownError,
+            lambda: slot_a.value_at(first),
+        )
+        self.assertEqual(
+            slot_b.value_at(first),
+            'x',
+        )
+
+        view = root.as_of(second)
+        self.assertEqual(
+            view[slot_a],
+            2,
+        )
+        self.assertEqual(
+            set(view),
+            {slot_a, slot_b},
+        )
+
+    def test_selected_slots(self):
+        root = datafork.Root()
+        slot_a = root.slot(initial_value=1)
+        slot_b = root.slot(initial_value=2)
+        root.enable_history(5, slots=[slot_a])
+        root.set_slot(slot_b, 3)
+        version = root.current_version()
+
+        self.assertEqual(
+            slot_a.value_at(version),
+            1,
+        )
+        self.assertRaises(
+            datafork.ValueNotKnownError,
+            lambda: slot_b.value_at(version),
+        )
+
+    def test_disabled(self):
+        root = datafork.Root()
+        slot = root.slot(initial_value=1)
+        self.assertRaises(
+            Exception,
+            lambda: slot.value_at(root.current_version()),
+        )
+
+
+class TestLeakDetection(unittest.TestCase):
+
+    def test_leaks(self):
+        root = datafork.Root()
+        slot = root.slot(initial_value=0)
+        found = []
+        detector = root.enable_leak_detection(found.append)
+
+        # the state of the block just ended isn't reported
+        with root.transaction():
+            slot.value = 1
+        self.assertEqual(detector.reports, [])
+
+        # a merged state kept alive is reported
+        with root.fork() as merged_state:
+            slot.value = [1, 2, 3]
+        root.merge_children([merged_state])
+        with root.transaction():
+            pass
+        self.assertEqual(len(detector.reports), 1)
+        self.assertEqual(found, detector.reports)
+        (state, size), = detector.reports[0]
+        self.assertTrue(state is merged_state)
+        self.assertTrue(size > 0)
+
+        merged_state.discard()
+        self.assertEqual(detector.check(), [])
+
+        # states in the active chain aren't leaks
+        with root.fork() as child_state:
+            self.assertEqual(detector.check(), [])
+        child_state.discard()
+
+        # a fork that hasn't been merged yet may still be
+        with root.fork() as kept_state:
+            slot.value = 2
+        with root.transaction():
+            pass
+        self.assertEqual(len(detector.reports), 1)
+        self.assertEqual(
+            [state for state, size in detector.check(include_open=True)],
+            [kept_state],
+        )
+
+        # nor are children waiting in a lazy merge
+        root.merge_children([kept_state], lazy=True)
+        with root.transaction():
+            pass
+        self.assertEqual(len(detector.reports), 1)
+
+        # finalizing completes the merge, and reports what is left
+        root.finalize_data()
+        self.assertEqual(len(detector.reports), 2)
+        (state, size), = detector.reports[1]
+        self.assertTrue(state is kept_state)
+
+        root.disable_leak_detection()
+        root.finalize_data()
+        self.assertEqual(len(detector.reports), 2)
+
+    def test_freed_without_gc(self):
+        import gc
+        root = datafork.Root()
+        detector = root.enable_leak_detection()
+        gc.disable()
+        try:
+            with root.transaction():
+                pass
+            with root.fork():
+                pass
+            self.assertEqual(detector.check(), [])
+        finally:
+            gc.enable()
+
+
+class TestMultiTransaction(unittest.TestCase):
+
+    def setUp(self):
+        self.root_a = datafork.Root()
+        self.root_b = datafork.Root()
+        self.slot_a = self.root_a.slot(initial_value=1)
+        self.slot_b = self.root_b.slot(initial_value=2)
+
+    def test_commit(self):
+        with datafork.multi_transaction(
+            self.root_a, self.root_b, owner='txn',
+        ) as children:
+            self.assertEqual(
+                [child.parent for child in children],
+                [self.root_a, self.root_b],
+            )
+            self.assertEqual(
+                [child.owner for child in children],
+                ['txn', 'txn'],
+            )
+            self.slot_a.value = 10
+            self.slot_b.value = 20
+            # nothing is visible in the roots until the block succeeds
+            self.assertEqual(
+                self.root_a.get_slot_value(self.slot_a),
+                1,
+            )
+
+        self.assertEqual(
+            (self.slot_a.value, self.slot_b.value),
+            (10, 20),
+        )
+        self.assertEqual(
+            (self.root_a.current_state, self.root_b.current_state),
+            (self.root_a, self.root_b),
+        )
+
+    def test_exception(self):
+        try:
+            with datafork.multi_transaction(self.root_a, self.root_b):
+                self.slot_a.value = 10
+                self.slot_b.value = 20
+                raise KeyError()
+        except KeyError:
+            pass
+
+        self.assertEqual(
+            (self.slot_a.value, self.slot_b.value),
+            (1, 2),
+        )
+        self.assertEqual(
+            (self.root_a.current_state, self.root_b.current_state),
+            (self.root_a, self.root_b),
+        )
+
+    def test_failed_merge(self):
+        def bad_merge(cases):
+            raise ValueError()
+        slot_c = self.root_b.slot(initial_value=3, merge=bad_merge)
+
+        self.assertRaises(
+            ValueError,
+            lambda: self._write_all([self.slot_a, self.slot_b, slot_c]),
+        )
+        # neither root is changed
+        self.assertEqual(
+            (self.slot_a.value, self.slot_b.value, slot_c.value),
+            (1, 2, 3),
+        )
+
+    def test_failed_log(self):
+        import os
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            # Whichever order the roots are committed in, a value that can't
+            # be logged for one root leaves the other unchanged too.
+            for logged, other in (
+                (self.slot_b, self.slot_a), (self.slot_a, self.slot_b),
+            ):
+                path = os.path.join(directory, str(id(logged)))
+                logged.root.enable_wal(path)
+                size = os.path.getsize(path)
+
+                def write():
+                    with datafork.multi_transaction(self.root_a, self.root_b):
+                        other.value = 0
+                        logged.value = lambda: 0
+                self.assertRaises(Exception, write)
+
+                self.assertEqual(
+                    (self.slot_a.value, self.slot_b.value),
+                    (1, 2),
+                )
+                self.assertEqual(
+                    os.path.getsize(path),
+                    size,
+                )
+                logged.root.disable_wal()
+        finally:
+            shutil.rmtree(directory)
+
+    def _write_all(self, slots):
+        with datafork.multi_transaction(self.root_a, self.root_b):
+            for slot in slots:
+                slot.value = 0
+
+    def test_untouched_root(self):
+        self.root_b.enable_stats()
+        version = self.root_b.get_slot_version(self.slot_b)
+        with datafork.multi_transaction(self.root_a, self.root_b):
+            self.slot_a.value = 10
+        self.assertEqual(
+            self.slot_a.value,
+            10,
+        )
+        self.assertEqual(
+            self.root_b.stats()["merges"],
+            0,
+        )
+        self.assertEqual(
+            self.root_b.get_slot_version(self.slot_b),
+            version,
+        )
+
+    def test_subscribers_see_every_root(self):
+        seen = []
+        def callback(changes):
+            seen.append((self.slot_a.value, self.slot_b.value))
+        self.root_a.subscribe(callback)
+        self.root_b.subscribe(callback)
+
+        with datafork.multi_transaction(self.root_a, self.root_b):
+            self.slot_a.value = 10
+            self.slot_b.value = 20
+        self.assertEqual(
+            seen,
+            [(10, 20), (10, 20)],
+        )
+
+    def test_same_root_twice(self):
+        self.assertRaises(
+            Exception,
+            lambda: datafork.multi_transaction(self.root_a, self.root_a),
+        )
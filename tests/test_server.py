@@ -0,0 +1,360 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+import datafork
+from datafork import server
+
+
+def _server_worker(path, slot_id, count):
+    # Runs in a child process: add one to a slot in the shared root count
+    # times, racing the other workers.
+    root = server.connect(path)
+    slot = root.slot_by_id(slot_id)
+
+    def increment():
+        slot.value = slot.value + 1
+
+    for i in range(count):
+        root.atomically(increment)
+    root.finalize_data()
+
+
+class TestStateServer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "socket")
+        self.root = datafork.Root('server_owner')
+        self.server = server.StateServer(self.path, self.root).start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def connect(self, **kwargs):
+        client = server.connect(self.path, **kwargs)
+        self.clients.append(client)
+        return client
+
+    def test_slots(self):
+        client = self.connect()
+        self.assertEqual(
+            client.owner,
+            'server_owner',
+        )
+        slot = client.slot('a', initial_value=[1, 2])
+        client.sync()
+        server_slot = self.root.slot_by_id(slot.slot_id)
+        self.assertEqual(
+            server_slot.owner,
+            'a',
+        )
+        self.assertEqual(
+            server_slot.value,
+            [1, 2],
+        )
+
+        # another client sees the same slot
+        other = self.connect()
+        other_slot = other.slot_by_id(slot.slot_id)
+        self.assertEqual(
+            other_slot.owner,
+            'a',
+        )
+        self.assertEqual(
+            other_slot.value,
+            [1, 2],
+        )
+        self.assertRaises(
+            KeyError,
+            lambda: other.slot_by_id(100),
+        )
+
+    def test_transaction(self):
+        client = self.connect()
+        slot_a = client.slot(initial_value=1)
+        slot_b = client.slot(initial_value=bytearray(b"abc"))
+        unset = client.slot()
+
+        with client.transaction() as child_state:
+            slot_a.set_value(2, position="child_a")
+            slot_b.value = bytearray(b"xyz")
+            # nothing is sent until the transaction is merged
+            self.assertEqual(
+                self.root.slot_by_id(slot_a.slot_id).value,
+                1,
+            )
+
+        client.sync()
+        self.assertEqual(
+            self.root.slot_by_id(slot_a.slot_id).value,
+            2,
+        )
+        self.assertEqual(
+            self.root.slot_by_id(slot_a.slot_id).positions,
+            {"child_a"},
+        )
+        self.assertEqual(
+            bytes(self.root.slot_by_id(slot_b.slot_id).value),
+            b"xyz",
+        )
+        self.assertFalse(
+            self.root.slot_by_id(unset.slot_id).value_is_known,
+        )
+        self.assertEqual(
+            (slot_a.value, bytes(slot_b.value)),
+            (2, b"xyz"),
+        )
+
+        try:
+            with client.transaction():
+                slot_a.value = 3
+                raise KeyError()
+        except KeyError:
+            pass
+        client.sync()
+        self.assertEqual(
+            self.root.slot_by_id(slot_a.slot_id).value,
+            2,
+        )
+
+    def test_fork_and_merge(self):
+        client = self.connect()
+        slot = client.slot(initial_value=0)
+        children = []
+        for value in (1, 2):
+            with client.fork() as child_state:
+                slot.value = value
+            children.append(child_state)
+        client.merge_children(children)
+        client.sync()
+        # the merge happens in the client, and the server receives the
+        # conflict that resulted
+        self.assertEqual(
+            self.root.conflicts().keys(),
+            [self.root.slot_by_id(slot.slot_id)],
+        )
+        self.assertEqual(
+            client.conflicts().keys(),
+            [slot],
+        )
+
+    def test_invalidation(self):
+        client = self.connect()
+        other = self.connect()
+        slot = client.slot(initial_value=1)
+        client.sync()
+        other_slot = other.slot_by_id(slot.slot_id)
+        self.assertEqual(
+            other_slot.value,
+            1,
+        )
+        self.assertTrue(
+            slot.slot_id in other._connection.cache,
+        )
+
+        with client.transaction():
+            slot.value = 2
+        client.sync()
+        other.sync()
+        # the server told the other client to drop its cached value
+        self.assertFalse(
+            slot.slot_id in other._connection.cache,
+        )
+        self.assertEqual(
+            other_slot.value,
+            2,
+        )
+
+    def test_lazy_merge(self):
+        server_slot = self.root.slot(initial_value=1)
+        with self.root.fork() as child:
+            server_slot.value = 2
+        self.root.merge_children([child], lazy=True)
+        client = self.connect()
+        slot = client.slot_by_id(server_slot.slot_id)
+        self.assertEqual(
+            (slot.value, client.get_slot_version(slot)),
+            (2, self.root.get_slot_version(server_slot)),
+        )
+
+        def increment():
+            slot.value = slot.value + 1
+
+        client.atomically(increment)
+        self.assertEqual(
+            server_slot.value,
+            3,
+        )
+
+    def test_stale_read(self):
+        client = self.connect()
+        other = self.connect()
+        slot = client.slot(initial_value=1)
+        client.sync()
+        other_slot = other.slot_by_id(slot.slot_id)
+
+        def increment():
+            other_slot.value = other_slot.value + 1
+
+        try:
+            with client.transaction():
+                value = slot.value
+                # another client commits after our read
+                other.atomically(increment)
+                slot.value = value + 1
+        except datafork.TransactionConflictError as ex:
+            self.assertTrue(ex.slot is slot)
+        else:
+            self.fail('TransactionConflictError not raised')
+        self.assertEqual(
+            self.root.slot_by_id(slot.slot_id).value,
+            2,
+        )
+
+        # atomically retries until it wins
+        calls = []
+
+        def interfere():
+            value = slot.value
+            if not calls:
+                other.atomically(increment)
+            calls.append(value)
+            slot.value = value + 1
+
+        client.atomically(interfere)
+        self.assertEqual(
+            calls,
+            [2, 3],
+        )
+        self.assertEqual(
+            self.root.slot_by_id(slot.slot_id).value,
+            4,
+        )
+        self.assertEqual(
+            client.contention.conflicts,
+            1,
+        )
+
+    def test_cache_size(self):
+        client = self.connect(cache_size=2)
+        slots = [client.slot(initial_value=i) for i in range(5)]
+        client.prefetch(slots)
+        self.assertEqual(
+            len(client._connection.cache),
+            2,
+        )
+        self.assertEqual(
+            [slot.value for slot in slots],
+            range(5),
+        )
+
+    def test_batch(self):
+        client = self.connect()
+        slots = [client.slot(initial_value=0) for i in range(3)]
+        with client.batch():
+            for slot in slots:
+                slot.value = 1
+            self.assertEqual(
+                len(client._connection.outbox),
+                3,
+            )
+        self.assertEqual(
+            client._connection.outbox,
+            [],
+        )
+        client.sync()
+        self.assertEqual(
+            [self.root.slot_by_id(slot.slot_id).value for slot in slots],
+            [1, 1, 1],
+        )
+
+    def test_no_direct_writes(self):
+        client = self.connect()
+        slot = client.slot(initial_value=1)
+        self.assertRaises(
+            Exception,
+            lambda: client.slot_values.__setitem__(slot, 2),
+        )
+        self.assertRaises(
+            Exception,
+            lambda: client.allocate_slots(3),
+        )
+
+    def test_unpicklable(self):
+        client = self.connect()
+        other = client.slot(initial_value=2)
+        client.sync()
+        slot = client.slot_by_id(
+            self.root.slot(initial_value=lambda: None).slot_id,
+        )
+        self.assertRaises(
+            Exception,
+            lambda: slot.value,
+        )
+
+        def write():
+            other.value = lambda: None
+
+        self.assertRaises(
+            Exception,
+            write,
+        )
+        # the connection is still usable
+        client.sync()
+        self.assertEqual(
+            other.value,
+            2,
+        )
+
+    def test_multi_transaction(self):
+        client = self.connect()
+        slot = client.slot(initial_value=1)
+        local = datafork.Root()
+        local_slot = local.slot(initial_value=1)
+        self.assertRaises(
+            Exception,
+            lambda: datafork.multi_transaction(client, local),
+        )
+        client.sync()
+        self.assertEqual(
+            (self.root.slot_by_id(slot.slot_id).value, local_slot.value),
+            (1, 1),
+        )
+        self.assertRaises(
+            Exception,
+            lambda: client.subscribe(lambda changes: None),
+        )
+        self.assertRaises(
+            Exception,
+            lambda: client.enable_history(10),
+        )
+
+    def test_worker_processes(self):
+        import multiprocessing
+
+        client = self.connect()
+        slot = client.slot(initial_value=0)
+        client.sync()
+        processes = [
+            multiprocessing.Process(
+                target=_server_worker,
+                args=(self.path, slot.slot_id, 50),
+            )
+            for i in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        client.sync()
+        # no increment is lost, however the workers interleave
+        self.assertEqual(
+            slot.value,
+            200,
+        )
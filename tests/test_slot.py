@@ -148,3 +148,21 @@ class TestSlot(unittest.TestCase):
                 datafork.MergeConflict([]),
             ),
         )
+
+    def test_intern(self):
+        mock_root = MagicMock()
+        mock_root.intern_value.return_value = "canonical"
+
+        slot = datafork.Slot(mock_root, initial_value="hi")
+        self.assertEqual(
+            mock_root.intern_value.call_count,
+            0,
+        )
+
+        slot = datafork.Slot(mock_root, initial_value="hi", intern=True)
+        mock_root.intern_value.assert_called_with("hi")
+        mock_root.current_state.set_slot.assert_called_with(
+            slot,
+            "canonical",
+            position=None,
+        )
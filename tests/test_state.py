@@ -100,6 +100,31 @@ class TestState(unittest.TestCase):
             root_state.current_state is root_state,
         )
 
+    def test_failed_merge(self):
+        def bad_merge(cases):
+            raise ValueError()
+
+        root_state = datafork.Root()
+        slot = root_state.slot(initial_value=1, merge=bad_merge)
+        try:
+            with root_state.transaction():
+                slot.value = 2
+        except ValueError:
+            pass
+        else:
+            self.fail('ValueError not raised')
+        # the root is unchanged and current again, so that later writes
+        # reach it
+        self.assertTrue(
+            root_state.current_state is root_state,
+        )
+        other_slot = root_state.slot(initial_value=3)
+        self.assertEqual(
+            (root_state.get_slot_value(slot),
+             root_state.get_slot_value(other_slot)),
+            (1, 3),
+        )
+
     def test_nested_states(self):
         root_state = datafork.Root()
 
@@ -486,3 +511,1104 @@ class TestStateMerge(unittest.TestCase):
             self.slot_a.merge.call_count,
             2
         )
+
+
+class TestOptimistic(unittest.TestCase):
+
+    def test_versions(self):
+        root_state = datafork.Root()
+        slot = root_state.slot()
+        initial = root_state.get_slot_version(slot)
+
+        with root_state.fork() as child_state:
+            # reading through to the parent sees the parent's version
+            self.assertEqual(
+                child_state.get_slot_version(slot),
+                initial,
+            )
+            slot.value = 2
+            self.assertNotEqual(
+                child_state.get_slot_version(slot),
+                initial,
+            )
+
+        self.assertEqual(
+            root_state.get_slot_version(slot),
+            initial,
+        )
+        root_state.merge_children([child_state])
+        self.assertNotEqual(
+            root_state.get_slot_version(slot),
+            initial,
+        )
+
+    def test_atomically_commit(self):
+        root_state = datafork.Root()
+        slot = root_state.slot(initial_value=1)
+
+        def increment():
+            self.assertEqual(
+                type(root_state.current_state),
+                datafork.OptimisticState,
+            )
+            slot.value = slot.value + 1
+            return 'done'
+
+        self.assertEqual(
+            root_state.atomically(increment),
+            'done',
+        )
+        self.assertEqual(
+            root_state.get_slot_value(slot),
+            2,
+        )
+        self.assertTrue(
+            root_state.current_state is root_state,
+        )
+        self.assertEqual(
+            root_state.contention.commits,
+            1,
+        )
+
+    def test_atomically_exception(self):
+        root_state = datafork.Root()
+        slot = root_state.slot(initial_value=1)
+
+        def fail():
+            slot.value = 5
+            raise KeyError('dummy')
+
+        self.assertRaises(
+            KeyError,
+            lambda: root_state.atomically(fail),
+        )
+        self.assertEqual(
+            root_state.get_slot_value(slot),
+            1,
+        )
+        self.assertTrue(
+            root_state.current_state is root_state,
+        )
+
+    def test_atomically_retry(self):
+        root_state = datafork.Root()
+        slot = root_state.slot(initial_value=1)
+        calls = []
+
+        def increment():
+            value = slot.value
+            if not calls:
+                # simulate another thread committing after our read
+                def interfere():
+                    slot.value = 10
+                root_state.atomically(interfere)
+            calls.append(value)
+            slot.value = value + 1
+
+        root_state.atomically(increment)
+
+        self.assertEqual(
+            calls,
+            [1, 10],
+        )
+        self.assertEqual(
+            root_state.get_slot_value(slot),
+            11,
+        )
+        self.assertEqual(
+            root_state.contention.conflicts,
+            1,
+        )
+        self.assertEqual(
+            root_state.contention.conflicts_by_slot[slot],
+            1,
+        )
+        self.assertEqual(
+            root_state.contention.max_retries,
+            1,
+        )
+
+    def test_atomically_retries_exhausted(self):
+        root_state = datafork.Root()
+        slot = root_state.slot(initial_value=1)
+
+        def always_conflict():
+            slot.value
+            root_state.atomically(lambda: slot.set_value(slot.value + 1))
+
+        try:
+            root_state.atomically(always_conflict, retries=2)
+        except datafork.TransactionConflictError, ex:
+            self.assertTrue(ex.slot is slot)
+        else:
+            self.fail('TransactionConflictError not raised')
+
+        self.assertEqual(
+            root_state.contention.conflicts,
+            3,
+        )
+
+    def test_atomically_threads(self):
+        import threading
+
+        root_state = datafork.Root()
+        shared = root_state.slot(initial_value=0)
+        own = [root_state.slot(initial_value=0) for i in range(4)]
+
+        def work(index):
+            for i in range(50):
+                def increment():
+                    shared.value = shared.value + 1
+                    own[index].value = own[index].value + 1
+                root_state.atomically(increment)
+
+        threads = [
+            threading.Thread(target=work, args=(i,))
+            for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(
+            root_state.get_slot_value(shared),
+            200,
+        )
+        for slot in own:
+            self.assertEqual(
+                root_state.get_slot_value(slot),
+                50,
+            )
+        self.assertEqual(
+            root_state.contention.commits,
+            200,
+        )
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_snapshot(self):
+        root_state = datafork.Root()
+        slot_a = root_state.slot(initial_value=1)
+        slot_b = root_state.slot(initial_value=2)
+        slot_c = root_state.slot()
+
+        with root_state.fork() as child_state:
+            slot_a.set_value(3, position="child_a")
+            snapshot = child_state.snapshot()
+
+            # writes after the snapshot is taken do not affect it
+            slot_a.value = 4
+            slot_b.value = 5
+            root_state.set_slot(slot_b, 6)
+
+        self.assertEqual(
+            snapshot[slot_a],
+            3,
+        )
+        self.assertEqual(
+            snapshot[slot_b],
+            2,
+        )
+        self.assertEqual(
+            snapshot.get_slot_positions(slot_a),
+            {"child_a"},
+        )
+        self.assertRaises(
+            datafork.ValueNotKnownError,
+            lambda: snapshot[slot_c],
+        )
+        self.assertEqual(
+            set(snapshot),
+            {slot_a, slot_b, slot_c},
+        )
+        self.assertEqual(
+            len(snapshot),
+            3,
+        )
+        self.assertEqual(
+            dict(snapshot.iteritems()),
+            {
+                slot_a: 3,
+                slot_b: 2,
+                slot_c: datafork.Slot.NOT_KNOWN,
+            },
+        )
+
+        # and the writes themselves were not lost
+        self.assertEqual(
+            child_state.get_slot_value(slot_a),
+            4,
+        )
+        self.assertEqual(
+            root_state.get_slot_value(slot_b),
+            6,
+        )
+
+    def test_snapshot_survives_merge(self):
+        root_state = datafork.Root()
+        slot = root_state.slot(initial_value=1)
+        snapshot = root_state.snapshot()
+
+        with root_state.transaction():
+            slot.value = 2
+
+        self.assertEqual(
+            root_state.get_slot_value(slot),
+            2,
+        )
+        self.assertEqual(
+            snapshot[slot],
+            1,
+        )
+
+
+class TestDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.root_state = datafork.Root()
+        self.slot_a = self.root_state.slot(initial_value=1)
+        self.slot_b = self.root_state.slot(initial_value=2)
+        self.slot_c = self.root_state.slot(initial_value=3)
+
+    def changes_dict(self, changes):
+        return {
+            change.slot: (change.old_value, change.new_value)
+            for change in changes
+        }
+
+    def test_siblings(self):
+        with self.root_state.fork() as child_1:
+            self.slot_a.set_value(10, position="child_1_a")
+            self.slot_b.value = 2
+        with self.root_state.fork() as child_2:
+            self.slot_a.set_value(20, position="child_2_a")
+            self.slot_c.value = 30
+
+        changes = child_1.diff(child_2)
+        self.assertEqual(
+            self.changes_dict(changes),
+            {
+                self.slot_a: (10, 20),
+                self.slot_c: (3, 30),
+            },
+        )
+        change_a = [x for x in changes if x.slot is self.slot_a][0]
+        self.assertEqual(
+            change_a.old_positions,
+            {"child_1_a"},
+        )
+        self.assertEqual(
+            change_a.new_positions,
+            {"child_2_a"},
+        )
+
+    def test_ancestor(self):
+        with self.root_state.fork() as child_state:
+            self.slot_a.value = 10
+            with child_state.fork() as grandchild_state:
+                self.slot_b.value = 20
+
+        self.assertEqual(
+            self.changes_dict(self.root_state.diff(grandchild_state)),
+            {
+                self.slot_a: (1, 10),
+                self.slot_b: (2, 20),
+            },
+        )
+        self.assertEqual(
+            self.changes_dict(grandchild_state.diff(child_state)),
+            {
+                self.slot_b: (20, 2),
+            },
+        )
+        self.assertEqual(
+            child_state.diff(child_state),
+            [],
+        )
+
+    def test_different_roots(self):
+        other_root = datafork.Root()
+        self.assertRaises(
+            Exception,
+            lambda: self.root_state.diff(other_root),
+        )
+
+
+class TestConflicts(unittest.TestCase):
+
+    def setUp(self):
+        self.root_state = datafork.Root()
+        self.slot_a = self.root_state.slot('x', initial_value=1)
+        self.slot_b = self.root_state.slot('y', initial_value=2)
+        self.slot_c = self.root_state.slot('x', initial_value=3)
+
+        children = []
+        for i in range(2):
+            with self.root_state.fork() as child_state:
+                self.slot_a.set_value(i, position="a%i" % i)
+                self.slot_b.set_value(i, position="b%i" % i)
+                self.slot_c.value = 3
+            children.append(child_state)
+        self.root_state.merge_children(children)
+
+    def test_conflicts(self):
+        conflicts = self.root_state.conflicts()
+        self.assertEqual(
+            set(conflicts),
+            {self.slot_a, self.slot_b},
+        )
+        self.assertEqual(
+            type(conflicts[self.slot_a]),
+            datafork.MergeConflict,
+        )
+        self.assertEqual(
+            set(self.root_state.conflicts(owner='x')),
+            {self.slot_a},
+        )
+
+        # visible from a child unless the child has its own value
+        with self.root_state.fork() as child_state:
+            self.slot_b.value = 5
+            self.assertEqual(
+                set(child_state.conflicts()),
+                {self.slot_a},
+            )
+
+        self.root_state.set_slot(self.slot_a, 7)
+        self.assertEqual(
+            set(self.root_state.conflicts()),
+            {self.slot_b},
+        )
+
+    def test_resolve_conflicts(self):
+        def resolver(slot, conflict):
+            if slot is self.slot_b:
+                return conflict
+            return max(possible.value for possible in conflict.possibilities)
+
+        self.assertEqual(
+            self.root_state.resolve_conflicts(resolver),
+            {self.slot_a: 1},
+        )
+        self.assertEqual(
+            self.root_state.get_slot_value(self.slot_a),
+            1,
+        )
+        self.assertEqual(
+            self.root_state.get_slot_positions(self.slot_a),
+            {"a0", "a1"},
+        )
+        self.assertEqual(
+            set(self.root_state.conflicts()),
+            {self.slot_b},
+        )
+
+    def test_slots_by_owner(self):
+        self.assertEqual(
+            self.root_state.slots_by_owner('x'),
+            {self.slot_a, self.slot_c},
+        )
+        self.assertEqual(
+            self.root_state.slots_by_owner('z'),
+            set(),
+        )
+
+    def test_unhashable_owner(self):
+        owner = {'name': 'x'}
+        slot = self.root_state.slot(initial_value=1, owner=owner)
+        slots = self.root_state.allocate_slots(2, owner=owner)
+        self.assertEqual(
+            self.root_state.slots_by_owner(owner),
+            set([slot] + slots),
+        )
+        # unhashable owners are matched by identity
+        self.assertEqual(
+            self.root_state.slots_by_owner({'name': 'x'}),
+            set(),
+        )
+
+
+class TestLazyMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.root_state = datafork.Root()
+        self.merged = []
+
+        def merge(cases):
+            self.merged.append(cases)
+            return datafork.equality_merge(cases)
+
+        self.slot_a = self.root_state.slot(initial_value=1, merge=merge)
+        self.slot_b = self.root_state.slot(initial_value=2, merge=merge)
+
+        with self.root_state.fork() as parent_state:
+            self.children = []
+            for i in range(2):
+                with parent_state.fork() as child_state:
+                    self.slot_a.value = 5
+                    self.slot_b.set_value(i, position=i)
+                self.children.append(child_state)
+        self.parent_state = parent_state
+
+    def test_merge_on_read(self):
+        self.parent_state.merge_children(self.children, lazy=True)
+        self.assertEqual(self.merged, [])
+
+        self.assertEqual(
+            self.parent_state.get_slot_value(self.slot_a),
+            5,
+        )
+        self.assertEqual(len(self.merged), 1)
+
+        # reads from descendants also complete the merge
+        with self.parent_state.fork() as child_state:
+            self.assertEqual(
+                type(child_state.get_slot_value(self.slot_b)),
+                datafork.MergeConflict,
+            )
+        self.assertEqual(len(self.merged), 2)
+        self.assertEqual(
+            self.parent_state.get_slot_positions(self.slot_b),
+            {0, 1},
+        )
+        self.assertEqual(self.parent_state._pending, [])
+
+    def test_write(self):
+        self.parent_state.merge_children(self.children, lazy=True)
+        self.parent_state.set_slot(self.slot_a, 9)
+        self.assertEqual(len(self.merged), 1)
+        self.assertEqual(
+            self.parent_state.get_slot_value(self.slot_a),
+            9,
+        )
+
+    def test_or_none_order(self):
+        # a later merge considering the parent's value must see the
+        # result of the earlier one
+        self.parent_state.merge_children(self.children[:1], lazy=True)
+        with self.parent_state.fork() as child_state:
+            self.slot_a.value = 5
+        self.parent_state.merge_children(
+            [child_state], or_none=True, lazy=True,
+        )
+        self.assertEqual(
+            self.parent_state.get_slot_value(self.slot_a),
+            5,
+        )
+        self.assertEqual(
+            [len(cases) for cases in self.merged],
+            [1, 2],
+        )
+
+    def test_bulk(self):
+        self.parent_state.merge_children(self.children, lazy=True)
+        self.assertEqual(
+            set(self.parent_state.conflicts()),
+            {self.slot_b},
+        )
+        self.assertEqual(len(self.merged), 2)
+
+    def test_root_subscribers(self):
+        changes = []
+        self.root_state.subscribe(changes.append)
+        with self.root_state.fork() as child_state:
+            self.slot_a.value = 3
+        self.root_state.merge_children([child_state], lazy=True)
+        self.assertEqual(len(changes), 1)
+
+
+class TestMergeStream(unittest.TestCase):
+
+    def setUp(self):
+        self.root_state = datafork.Root()
+        self.slot_a = self.root_state.slot(initial_value=1)
+        self.slot_b = self.root_state.slot(initial_value=2)
+        self.slot_c = self.root_state.slot(
+            initial_value=0,
+            merge=lambda cases: sum(case.value for case in cases),
+        )
+
+    def make_children(self, parent, count):
+        for i in range(count):
+            with parent.fork() as child_state:
+                self.slot_a.set_value(5, position=i)
+                if i == 1:
+                    self.slot_b.value = 3
+                self.slot_c.value = 1
+            yield child_state
+
+    def test_matches_merge_children(self):
+        stream = self.root_state.merge_stream()
+        for child_state in self.make_children(self.root_state, 3):
+            stream.add(child_state)
+        self.assertEqual(stream.count, 3)
+        stream.commit()
+
+        with self.root_state.fork() as expected:
+            expected.merge_children(list(self.make_children(expected, 3)))
+
+        self.assertEqual(
+            self.root_state.get_slot_value(self.slot_a),
+            5,
+        )
+        self.assertEqual(
+            self.root_state.get_slot_positions(self.slot_a),
+            {0, 1, 2},
+        )
+        self.assertEqual(
+            self.root_state.get_slot_value(self.slot_c),
+            3,
+        )
+        # children that didn't write slot_b contribute the parent's
+        # value, and equal values are folded together
+        conflict = self.root_state.get_slot_value(self.slot_b)
+        self.assertEqual(
+            sorted(possible.value for possible in conflict.possibilities),
+            [2, 3],
+        )
+        self.assertEqual(
+            set(
+                possible.value
+                for possible in expected.get_slot_value(
+                    self.slot_b,
+                ).possibilities
+            ),
+            {2, 3},
+        )
+
+    def test_or_none(self):
+        stream = self.root_state.merge_stream(or_none=True)
+        for child_state in self.make_children(self.root_state, 2):
+            stream.add(child_state)
+        stream.commit()
+        self.assertEqual(
+            self.root_state.get_slot_value(self.slot_c),
+            2,
+        )
+        self.assertEqual(
+            type(self.root_state.get_slot_value(self.slot_a)),
+            datafork.MergeConflict,
+        )
+
+    def test_errors(self):
+        stream = self.root_state.merge_stream()
+        with self.root_state.fork() as child_state:
+            with child_state.fork() as grandchild_state:
+                pass
+        self.assertRaises(Exception, lambda: stream.add(grandchild_state))
+        stream.commit()
+        self.assertRaises(Exception, lambda: stream.add(child_state))
+        self.assertRaises(Exception, stream.commit)
+
+
+class TestBatchMerge(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+        def merge(batch):
+            self.batches.append(batch)
+            results = []
+            for i in range(len(batch)):
+                start, end = batch.offsets[i], batch.offsets[i + 1]
+                values = batch.values[start:end]
+                if None in values:
+                    results.append(datafork.MergeBatch.CONFLICT)
+                else:
+                    results.append(sum(values))
+            return results
+
+        self.root_state = datafork.Root()
+        batch_merge = datafork.BatchMerge(merge)
+        self.slots = [
+            self.root_state.slot(initial_value=0, merge=batch_merge)
+            for i in range(3)
+        ]
+        self.plain_slot = self.root_state.slot(initial_value=0)
+
+    def test_merge_children(self):
+        children = []
+        for i in range(2):
+            with self.root_state.fork() as child_state:
+                self.slots[0].set_value(i + 1, position=i)
+                self.slots[1].value = 5
+                self.slots[2].value = None if i else 1
+                self.plain_slot.value = 1
+            children.append(child_state)
+        self.root_state.merge_children(children)
+
+        self.assertEqual(len(self.batches), 1)
+        batch = self.batches[0]
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(list(batch.states), [0, 1] * 3)
+        self.assertEqual(
+            self.root_state.get_slot_value(self.slots[0]),
+            3,
+        )
+        self.assertEqual(
+            self.root_state.get_slot_positions(self.slots[0]),
+            {0, 1},
+        )
+        self.assertEqual(
+            self.root_state.get_slot_value(self.slots[1]),
+            10,
+        )
+        conflict = self.root_state.get_slot_value(self.slots[2])
+        self.assertEqual(type(conflict), datafork.MergeConflict)
+        self.assertEqual(
+            [possible.value for possible in conflict.possibilities],
+            [1, None],
+        )
+        self.assertEqual(
+            self.root_state.conflicts(),
+            {self.slots[2]: conflict},
+        )
+        self.assertEqual(
+            self.root_state.get_slot_value(self.plain_slot),
+            1,
+        )
+
+    def test_mixed_sources(self):
+        # Values a child didn't write itself come from its parent, and
+        # conflicts a child holds are flattened, alongside values taken
+        # straight from the children's own storage.
+        with self.root_state.fork() as parent_state:
+            conflicted = []
+            for value in (1, 2):
+                with parent_state.fork() as child_state:
+                    self.slots[0].set_value(None, position=value)
+                conflicted.append(child_state)
+            parent_state.merge_children(conflicted)
+            children = []
+            for i in range(2):
+                with parent_state.fork() as child_state:
+                    if i:
+                        self.slots[0].set_value(3, position="b")
+                    self.slots[1].set_value(i + 1, position=i)
+                children.append(child_state)
+            del self.batches[:]
+            parent_state.merge_children(children)
+
+        batch = self.batches[0]
+        columns = []
+        for slot in self.slots[:2]:
+            i = batch.slots.index(slot)
+            start, end = batch.offsets[i], batch.offsets[i + 1]
+            columns.append((
+                batch.values[start:end],
+                list(batch.states[start:end]),
+                batch.positions[start:end],
+            ))
+        self.assertEqual(
+            columns,
+            [
+                ([None, None, 3], [0, 0, 1], [{1}, {2}, {"b"}]),
+                ([1, 2], [0, 1], [{0}, {1}]),
+            ],
+        )
+
+    def test_single(self):
+        with self.root_state.fork() as child_state:
+            self.slots[0].value = 2
+        self.root_state.merge_children([child_state], lazy=True)
+        self.assertEqual(
+            self.root_state.get_slot_value(self.slots[0]),
+            2,
+        )
+        self.assertEqual(self.batches[0].slots, [self.slots[0]])
+
+        # usable as a plain merge function too
+        self.assertEqual(
+            self.slots[0].merge([
+                datafork.MergePossibility(1, set()),
+                datafork.MergePossibility(2, set()),
+            ]),
+            3,
+        )
+
+    def test_wrong_length(self):
+        slot = self.root_state.slot(
+            initial_value=0,
+            merge=datafork.BatchMerge(lambda batch: []),
+        )
+        with self.root_state.fork() as child_state:
+            slot.value = 2
+        self.assertRaises(
+            Exception,
+            lambda: self.root_state.merge_children([child_state]),
+        )
+
+
+class TestCopyOnWrite(unittest.TestCase):
+
+    def setUp(self):
+        self.root_state = datafork.Root()
+        self.forks = []
+
+        def fork(value):
+            self.forks.append(value)
+            return type(value)(value)
+
+        self.fork = datafork.CopyOnWrite(fork)
+
+    def test_list(self):
+        slot = self.root_state.slot(initial_value=[1, 2], fork=self.fork)
+        with self.root_state.fork() as child_state:
+            value = slot.value
+            self.assertEqual(value, [1, 2])
+            self.assertEqual(len(value), 2)
+            self.assertEqual(list(value), [1, 2])
+            self.assertEqual(value[1], 2)
+            self.assertTrue(2 in value)
+            self.assertEqual(value.index(2), 1)
+            self.assertEqual(self.forks, [])
+            self.assertEqual(child_state.slot_values, {})
+
+            other = slot.value
+            value.append(3)
+            self.assertEqual(len(self.forks), 1)
+            # every proxy for the slot in this state sees the copy
+            self.assertEqual(other, [1, 2, 3])
+            other.append(4)
+            self.assertEqual(len(self.forks), 1)
+            self.assertEqual(slot.value, [1, 2, 3, 4])
+            self.assertEqual(type(slot.value), list)
+        self.assertEqual(slot.value, [1, 2])
+
+        # a child that only read leaves nothing to merge
+        with self.root_state.transaction() as child_state:
+            slot.value[0]
+        self.assertEqual(child_state.slot_values, {})
+
+    def test_merge_reader_with_writer(self):
+        slot = self.root_state.slot(initial_value=[1, 2], fork=self.fork)
+        original = self.root_state.slot_values[slot]
+        with self.root_state.fork() as parent_state:
+            with parent_state.fork() as reader_state:
+                self.assertEqual(slot.value, [1, 2])
+            with parent_state.fork() as writer_state:
+                slot.value = [1, 2]
+            parent_state.merge_children([reader_state, writer_state])
+
+            # the merged value is a plain list owned by the parent, not a
+            # proxy or the root's own list
+            merged = parent_state.slot_values[slot]
+            self.assertEqual(type(merged), list)
+            self.assertFalse(merged is original)
+            slot.value.append(3)
+        self.assertEqual(slot.value, [1, 2])
+
+        # conflicts hold plain values too
+        with self.root_state.fork() as reader_state:
+            slot.value[0]
+        with self.root_state.fork() as writer_state:
+            slot.value = [3]
+        self.root_state.merge_children([reader_state, writer_state])
+        conflict = self.root_state.conflicts()[slot]
+        self.assertEqual(
+            [type(possible.value) for possible in conflict.possibilities],
+            [list, list],
+        )
+        # the root's own list is used as is
+        self.assertTrue(conflict.possibilities[0].value is original)
+
+    def test_dict_and_set(self):
+        dict_slot = self.root_state.slot(
+            initial_value={"a": 1}, fork=self.fork,
+        )
+        set_slot = self.root_state.slot(
+            initial_value={1}, fork=self.fork,
+        )
+        with self.root_state.transaction():
+            self.assertEqual(dict_slot.value.get("a"), 1)
+            self.assertEqual(sorted(dict_slot.value.keys()), ["a"])
+            self.assertEqual(set_slot.value | {2}, {1, 2})
+            self.assertEqual(self.forks, [])
+            dict_slot.value["b"] = 2
+            set_slot.value.add(2)
+        self.assertEqual(dict_slot.value, {"a": 1, "b": 2})
+        self.assertEqual(set_slot.value, {1, 2})
+        self.assertEqual(len(self.forks), 2)
+
+    def test_unregistered(self):
+        slot = self.root_state.slot(
+            initial_value=bytearray(b"ab"), fork=self.fork,
+        )
+        with self.root_state.fork():
+            self.assertEqual(type(slot.value), bytearray)
+        self.assertEqual(len(self.forks), 1)
+
+    def test_register(self):
+        class Counter(object):
+            def __init__(self, count=0):
+                self.count = count
+            def increment(self):
+                self.count += 1
+
+        datafork.CopyOnWrite.register(Counter, mutators=["increment"])
+        try:
+            slot = self.root_state.slot(
+                initial_value=Counter(),
+                fork=datafork.CopyOnWrite(lambda c: Counter(c.count)),
+            )
+            with self.root_state.transaction() as child_state:
+                self.assertEqual(slot.value.count, 0)
+                self.assertEqual(child_state.slot_values, {})
+                slot.value.increment()
+                self.assertEqual(slot.value.count, 1)
+            self.assertEqual(slot.value.count, 1)
+        finally:
+            del datafork.CopyOnWrite._proxy_types[Counter]
+
+
+class TestMergePolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.root_state = datafork.Root()
+        self.slot_a = self.root_state.slot('a', initial_value=0)
+        self.slot_b = self.root_state.slot('b', initial_value=0)
+        self.custom_slot = self.root_state.slot(
+            'a',
+            initial_value=0,
+            merge=lambda cases: max(case.value for case in cases),
+        )
+
+    def merge(self, *owners_values):
+        children = []
+        for owner, value in owners_values:
+            with self.root_state.fork(owner) as child_state:
+                self.slot_a.set_value(value, position=owner)
+                self.slot_b.value = value
+                self.custom_slot.value = value
+            children.append(child_state)
+        self.root_state.merge_children(children)
+
+    def test_last_writer_wins(self):
+        self.root_state.set_merge_policy(datafork.LastWriterWins())
+        self.merge(('x', 1), ('y', 2))
+        self.assertEqual(self.root_state.get_slot_value(self.slot_a), 2)
+        self.assertEqual(
+            self.root_state.get_slot_positions(self.slot_a),
+            {'x', 'y'},
+        )
+        self.assertEqual(self.root_state.conflicts(), {})
+        # custom merges are left alone
+        self.assertEqual(
+            self.root_state.get_slot_value(self.custom_slot),
+            2,
+        )
+
+    def test_prefer_parent(self):
+        self.root_state.set_merge_policy(
+            datafork.PreferParent(), owners=['a'],
+        )
+        self.merge(('x', 1), ('y', 2))
+        self.assertEqual(self.root_state.get_slot_value(self.slot_a), 0)
+        self.assertEqual(
+            set(self.root_state.conflicts()),
+            {self.slot_b},
+        )
+
+        # agreement still wins over the parent
+        self.merge(('x', 3), ('y', 3))
+        self.assertEqual(self.root_state.get_slot_value(self.slot_a), 3)
+
+        self.root_state.set_merge_policy(None, owners=['a'])
+        self.merge(('x', 1), ('y', 2))
+        self.assertEqual(
+            set(self.root_state.conflicts()),
+            {self.slot_a, self.slot_b},
+        )
+
+    def test_owner_priority(self):
+        self.root_state.set_merge_policy(
+            datafork.OwnerPriority(['admin', 'user']),
+        )
+        self.merge(('user', 1), ('admin', 2), ('other', 3))
+        self.assertEqual(self.root_state.get_slot_value(self.slot_a), 2)
+
+        self.merge(('user', 1), ('user', 2), ('other', 3))
+        self.assertEqual(
+            set(self.root_state.conflicts()),
+            {self.slot_a, self.slot_b},
+        )
+
+    def test_unhashable_owner(self):
+        owner = ['subsystem']
+        slot = self.root_state.slot(owner=owner, initial_value=0)
+        self.root_state.set_merge_policy(datafork.LastWriterWins())
+        self.root_state.set_merge_policy(
+            datafork.PreferParent(), owners=[owner],
+        )
+        children = []
+        for value in (1, 2):
+            with self.root_state.fork(owner=[value]) as child_state:
+                slot.value = value
+            children.append(child_state)
+        self.root_state.merge_children(children)
+        self.assertEqual(self.root_state.get_slot_value(slot), 0)
+
+        self.root_state.set_merge_policy(
+            datafork.OwnerPriority([children[1].owner]), owners=[owner],
+        )
+        self.root_state.merge_children(children)
+        self.assertEqual(self.root_state.get_slot_value(slot), 2)
+
+    def test_lazy(self):
+        self.root_state.set_merge_policy(datafork.LastWriterWins())
+        with self.root_state.fork() as parent_state:
+            children = []
+            for value in range(2):
+                with parent_state.fork() as child_state:
+                    self.slot_a.value = value
+                children.append(child_state)
+        parent_state.merge_children(children, lazy=True)
+        self.assertEqual(parent_state.get_slot_value(self.slot_a), 1)
+
+
+class TestMergePlan(unittest.TestCase):
+
+    def setUp(self):
+        self.root_state = datafork.Root()
+        self.slot_a = self.root_state.slot(initial_value=1)
+        self.slot_b = self.root_state.slot(initial_value=2)
+
+    def fork_children(self, *values):
+        children = []
+        for value_a, value_b in values:
+            with self.root_state.fork() as child_state:
+                self.slot_a.set_value(value_a, position="a")
+                self.slot_b.value = value_b
+            children.append(child_state)
+        return children
+
+    def test_plan_and_apply(self):
+        children = self.fork_children((1, 3), (1, 4))
+        plan = self.root_state.plan_merge(children)
+
+        self.assertTrue(plan.complete)
+        self.assertEqual(plan.conflict_count, 1)
+        self.assertEqual(set(plan.conflicts), {self.slot_b})
+        self.assertEqual(plan.values[self.slot_a], 1)
+        self.assertEqual(plan.positions(self.slot_a), {"a"})
+        self.assertEqual(plan.changed(), {self.slot_b})
+        # nothing has been written yet
+        self.assertEqual(self.root_state.get_slot_value(self.slot_b), 2)
+        self.assertEqual(
+            self.root_state.get_slot_positions(self.slot_a),
+            set(),
+        )
+
+        plan.apply()
+        self.assertTrue(plan.applied)
+        self.assertEqual(
+            type(self.root_state.get_slot_value(self.slot_b)),
+            datafork.MergeConflict,
+        )
+        self.assertEqual(
+            self.root_state.get_slot_positions(self.slot_a),
+            {"a"},
+        )
+        self.assertEqual(
+            self.root_state.get_slot_version(self.slot_a),
+            self.root_state.get_slot_version(self.slot_b),
+        )
+        self.assertRaises(Exception, plan.apply)
+
+    def test_fail_fast(self):
+        children = self.fork_children((5, 3), (6, 4))
+        plan = self.root_state.plan_merge(children, fail_fast=True)
+        self.assertFalse(plan.complete)
+        self.assertEqual(plan.conflict_count, 1)
+        self.assertEqual(len(plan.values), 1)
+        self.assertRaises(Exception, plan.apply)
+
+    def test_stale(self):
+        children = self.fork_children((5, 3))
+        plan = self.root_state.plan_merge(children)
+        self.root_state.set_slot(self.slot_b, 7)
+        self.assertRaises(Exception, plan.apply)
+        self.assertEqual(self.root_state.get_slot_value(self.slot_a), 1)
+
+    def test_atomic(self):
+        def merge(cases):
+            raise ValueError()
+
+        slot_c = self.root_state.slot(initial_value=0, merge=merge)
+        with self.root_state.fork() as child_state:
+            self.slot_a.value = 5
+            self.slot_b.value = 5
+            slot_c.value = 5
+        self.assertRaises(
+            ValueError,
+            lambda: self.root_state.merge_children([child_state]),
+        )
+        self.assertEqual(self.root_state.get_slot_value(self.slot_a), 1)
+        self.assertEqual(self.root_state.get_slot_value(self.slot_b), 2)
+
+
+class TestDiscard(unittest.TestCase):
+
+    def test_discard(self):
+        root_state = datafork.Root()
+        slot = root_state.slot(initial_value=1)
+        with root_state.fork() as child_state:
+            slot.value = 2
+            # active states can't be discarded
+            self.assertRaises(Exception, child_state.discard)
+            self.assertRaises(Exception, root_state.discard)
+            with child_state.fork() as grandchild_state:
+                pass
+        values = child_state.slot_values
+
+        child_state.discard()
+        self.assertTrue(child_state.discarded)
+        self.assertEqual(values, {})
+        self.assertRaises(
+            Exception,
+            lambda: child_state.get_slot_value(slot),
+        )
+        self.assertRaises(
+            Exception,
+            lambda: child_state.set_slot(slot, 3),
+        )
+        self.assertRaises(
+            Exception,
+            lambda: grandchild_state.get_slot_value(slot),
+        )
+        self.assertRaises(
+            Exception,
+            lambda: root_state.merge_children([child_state]),
+        )
+        self.assertEqual(root_state.get_slot_value(slot), 1)
+
+    def test_discard_lazy(self):
+        root_state = datafork.Root()
+        slot = root_state.slot(initial_value=1)
+        other_slot = root_state.slot(initial_value=1)
+        with root_state.fork() as child_state:
+            slot.value = 2
+            other_slot.value = 3
+        root_state.merge_children([child_state], lazy=True)
+        # the parent still needs the child's values, so the merge is
+        # completed before they are released
+        child_state.discard()
+        self.assertEqual(
+            (slot.value, other_slot.value),
+            (2, 3),
+        )
+        self.assertEqual(
+            root_state._pending,
+            [],
+        )
+
+    def test_snapshot(self):
+        root_state = datafork.Root()
+        slot = root_state.slot(initial_value=1)
+        with root_state.fork() as child_state:
+            slot.value = 2
+            snapshot = child_state.snapshot()
+        child_state.discard()
+        self.assertEqual(snapshot[slot], 2)
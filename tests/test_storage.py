@@ -0,0 +1,837 @@
+
+import array
+import os
+import shutil
+import tempfile
+import unittest
+import datafork
+from datafork import storage
+
+
+class TestSpill(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "spill")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_encode_value(self):
+        self.assertEqual(
+            storage.encode_value(b"abc"),
+            (storage.KIND_BYTES, b"abc"),
+        )
+        self.assertEqual(
+            storage.encode_value(bytearray(b"abc")),
+            (storage.KIND_BYTEARRAY, b"abc"),
+        )
+        self.assertEqual(
+            storage.encode_value(array.array('b', [1, 2])),
+            (storage.KIND_ARRAY, b"b\x01\x02"),
+        )
+        self.assertEqual(
+            storage.encode_value(memoryview(b"abc")),
+            (storage.KIND_BUFFER, b"abc"),
+        )
+        self.assertEqual(
+            storage.encode_value(datafork.Slot.NOT_KNOWN)[0],
+            storage.KIND_NOT_KNOWN,
+        )
+        self.assertEqual(
+            storage.encode_value([1, 2])[0],
+            storage.KIND_PICKLE,
+        )
+
+    def test_spill(self):
+        root = datafork.Root()
+        slot_a = root.slot(initial_value=[1, 2, 3])
+        slot_b = root.slot(initial_value=array.array('i', [1, 2, 3]))
+        slot_c = root.slot(initial_value=b"hello")
+        slot_d = root.slot()
+        slot_e = root.slot(initial_value=bytearray(b"abc"))
+        slot_a.set_value([1, 2, 3], position="a")
+
+        root.spill(self.path)
+
+        self.assertEqual(
+            type(root.slot_values),
+            storage.SpilledValues,
+        )
+        self.assertEqual(
+            root.slot_values.loaded,
+            {},
+        )
+        self.assertEqual(
+            slot_a.value,
+            [1, 2, 3],
+        )
+        self.assertEqual(
+            slot_a.positions,
+            {"a"},
+        )
+        # buffer-typed values come back with their original type
+        self.assertEqual(
+            type(slot_b.value),
+            array.array,
+        )
+        self.assertEqual(
+            slot_b.value,
+            array.array('i', [1, 2, 3]),
+        )
+        self.assertEqual(
+            slot_b.value.typecode,
+            'i',
+        )
+        self.assertEqual(
+            type(slot_e.value),
+            bytearray,
+        )
+        self.assertEqual(
+            slot_e.value,
+            bytearray(b"abc"),
+        )
+        self.assertEqual(
+            slot_c.value,
+            b"hello",
+        )
+        self.assertFalse(
+            slot_d.value_is_known,
+        )
+        self.assertEqual(
+            set(root.slot_values),
+            {slot_a, slot_b, slot_c, slot_d, slot_e},
+        )
+
+        # merging into a spilled layer works as normal
+        with root.transaction():
+            slot_a.value = [4]
+            slot_c.set_value(b"goodbye", position="c")
+        self.assertEqual(
+            slot_a.value,
+            [4],
+        )
+        self.assertEqual(
+            slot_c.positions,
+            {"c"},
+        )
+
+        # spilling again only appends what changed
+        size = os.path.getsize(self.path)
+        root.spill(self.path)
+        self.assertEqual(
+            root.slot_values.written,
+            {},
+        )
+        self.assertTrue(
+            os.path.getsize(self.path) > size,
+        )
+        self.assertEqual(
+            slot_c.value,
+            b"goodbye",
+        )
+        self.assertEqual(
+            slot_a.value,
+            [4],
+        )
+
+        root.finalize_data()
+        self.assertEqual(
+            slot_c.value,
+            b"goodbye",
+        )
+
+    def test_spill_cold_layers(self):
+        root = datafork.Root()
+        slot = root.slot(initial_value=1)
+
+        with root.fork() as child_state:
+            slot.value = 2
+            with child_state.fork() as grandchild_state:
+                slot.value = 3
+                root.spill_cold_layers(self.path)
+                self.assertEqual(
+                    type(grandchild_state.slot_values),
+                    dict,
+                )
+                self.assertEqual(
+                    type(child_state.slot_values),
+                    storage.SpilledValues,
+                )
+                self.assertEqual(
+                    type(root.slot_values),
+                    storage.SpilledValues,
+                )
+                self.assertEqual(
+                    slot.value,
+                    3,
+                )
+            self.assertEqual(
+                slot.value,
+                2,
+            )
+            root.merge_children([child_state])
+        self.assertEqual(
+            slot.value,
+            2,
+        )
+
+    def test_snapshot_of_spilled(self):
+        root = datafork.Root()
+        slot = root.slot(initial_value=1)
+        root.spill(self.path)
+        snapshot = root.snapshot()
+        slot.value = 2
+        self.assertEqual(
+            snapshot[slot],
+            1,
+        )
+        self.assertEqual(
+            slot.value,
+            2,
+        )
+
+    def test_unidentified_slot(self):
+        root = datafork.Root()
+        slot = datafork.Slot(root, initial_value=1)
+        self.assertRaises(
+            Exception,
+            lambda: root.spill(self.path),
+        )
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "checkpoint")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_checkpoint(self):
+        root = datafork.Root('root_owner')
+        slot_a = root.slot('a', initial_value=[1, 2])
+        slot_b = root.slot('b', initial_value=bytearray(b"xyz"))
+        slot_c = root.slot('a')
+        slot_a.set_value([1, 2], position="pos_a")
+        root.checkpoint(self.path)
+
+        restored = datafork.Root.restore(self.path)
+        self.assertEqual(
+            restored.owner,
+            'root_owner',
+        )
+        # slots are only created when asked for
+        self.assertEqual(
+            len(restored.slots),
+            0,
+        )
+        restored_a = restored.slot_by_id(slot_a.slot_id)
+        self.assertEqual(
+            restored_a.owner,
+            'a',
+        )
+        self.assertEqual(
+            restored_a.value,
+            [1, 2],
+        )
+        self.assertEqual(
+            restored_a.positions,
+            {"pos_a"},
+        )
+        self.assertEqual(
+            bytes(restored.slot_by_id(slot_b.slot_id).value),
+            b"xyz",
+        )
+        self.assertFalse(
+            restored.slot_by_id(slot_c.slot_id).value_is_known,
+        )
+        self.assertEqual(
+            restored.slots_by_owner('a'),
+            {restored_a, restored.slot_by_id(slot_c.slot_id)},
+        )
+
+        # new slots continue the sequence of ids
+        self.assertEqual(
+            restored.slot().slot_id,
+            3,
+        )
+
+    def test_incremental(self):
+        root = datafork.Root()
+        slot_a = root.slot(initial_value=1)
+        slot_b = root.slot(initial_value=2)
+        root.checkpoint(self.path)
+        size = os.path.getsize(self.path)
+
+        self.assertRaises(
+            Exception,
+            lambda: root.checkpoint(self.path + "2", incremental=True),
+        )
+
+        with root.transaction():
+            slot_a.value = 10
+        slot_c = root.slot(initial_value=30)
+        root.checkpoint(self.path, incremental=True)
+        self.assertTrue(
+            os.path.getsize(self.path) > size,
+        )
+
+        restored = datafork.Root.restore(self.path)
+        self.assertEqual(
+            restored.slot_by_id(slot_a.slot_id).value,
+            10,
+        )
+        self.assertEqual(
+            restored.slot_by_id(slot_b.slot_id).value,
+            2,
+        )
+        self.assertEqual(
+            restored.slot_by_id(slot_c.slot_id).value,
+            30,
+        )
+
+        # and a restored root can carry on checkpointing incrementally
+        restored.slot_by_id(slot_b.slot_id).value = 20
+        restored.checkpoint(self.path, incremental=True)
+        again = datafork.Root.restore(self.path)
+        self.assertEqual(
+            again.slot_by_id(slot_a.slot_id).value,
+            10,
+        )
+        self.assertEqual(
+            again.slot_by_id(slot_b.slot_id).value,
+            20,
+        )
+
+    def test_include_states(self):
+        root = datafork.Root()
+        slot = root.slot(initial_value=1)
+        with root.fork('child_owner') as child_state:
+            slot.value = 2
+            root.checkpoint(self.path, include_states=True)
+
+        restored = datafork.Root.restore(self.path)
+        restored_slot = restored.slot_by_id(slot.slot_id)
+        self.assertEqual(
+            restored.current_state.owner,
+            'child_owner',
+        )
+        self.assertEqual(
+            restored_slot.value,
+            2,
+        )
+        self.assertEqual(
+            restored.get_slot_value(restored_slot),
+            1,
+        )
+        restored.merge_children([restored.current_state])
+        self.assertEqual(
+            restored.get_slot_value(restored_slot),
+            2,
+        )
+
+    def test_conflicts(self):
+        root = datafork.Root()
+        slot = root.slot(initial_value=0)
+        other_slot = root.slot(initial_value=0)
+        children = []
+        for value in (1, 2):
+            with root.fork() as child_state:
+                slot.value = value
+                other_slot.value = value
+            children.append(child_state)
+        root.merge_children(children)
+        root.checkpoint(self.path)
+
+        restored = datafork.Root.restore(self.path)
+        restored_slot = restored.slot_by_id(slot.slot_id)
+        restored_other = restored.slot_by_id(other_slot.slot_id)
+        self.assertEqual(
+            set(restored.conflicts()),
+            {restored_slot, restored_other},
+        )
+
+        # a conflict resolved since the previous checkpoint is gone
+        root.set_slot(other_slot, 3)
+        root.checkpoint(self.path, incremental=True)
+        restored = datafork.Root.restore(self.path)
+        restored_slot = restored.slot_by_id(slot.slot_id)
+        self.assertEqual(
+            restored.resolve_conflicts(lambda slot, conflict: 4),
+            {restored_slot: 4},
+        )
+
+        # conflicts in the states being checkpointed are kept too
+        children = []
+        with root.fork() as parent_state:
+            for value in (5, 6):
+                with parent_state.fork() as child_state:
+                    other_slot.value = value
+                children.append(child_state)
+            parent_state.merge_children(children)
+            root.checkpoint(self.path, include_states=True)
+        restored = datafork.Root.restore(self.path)
+        self.assertEqual(
+            set(restored.current_state.conflicts()),
+            {
+                restored.slot_by_id(slot.slot_id),
+                restored.slot_by_id(other_slot.slot_id),
+            },
+        )
+
+    def test_not_a_checkpoint(self):
+        with open(self.path, "wb") as f:
+            f.write(b"nonsense" * 10)
+        self.assertRaises(
+            Exception,
+            lambda: datafork.Root.restore(self.path),
+        )
+
+    def test_allocated_slots(self):
+        root = datafork.Root()
+        slots = root.allocate_slots(3, default=1)
+        lists = root.allocate_slots(2, default_factory=list)
+        slots[1].value = 2
+        lists[0].value.append(3)
+        root.checkpoint(self.path)
+
+        restored = datafork.Root.restore(self.path)
+        self.assertEqual(
+            [restored.slot_by_id(slot.slot_id).value for slot in slots],
+            [1, 2, 1],
+        )
+        self.assertEqual(
+            [restored.slot_by_id(slot.slot_id).value for slot in lists],
+            [[3], []],
+        )
+
+
+def _shared_worker(path, slot_id, queue):
+    # Runs in a child process: read the published value, write a new one
+    # locally and send the change back.
+    root = storage.attach(path)
+    slot = root.slot_by_id(slot_id)
+    value = slot.value
+    slot.value = bytes(value).upper()
+    queue.put(root.current_state.export_changes())
+
+
+class TestShared(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_publish_attach(self):
+        root = datafork.Root()
+        slot_a = root.slot(initial_value=bytearray(b"abc"))
+        slot_b = root.slot(initial_value=1)
+
+        with root.fork() as child_state:
+            slot_b.set_value(2, position="child_b")
+            layer = child_state.publish(self.directory)
+
+        self.assertEqual(
+            os.path.dirname(layer.path),
+            self.directory,
+        )
+
+        attached = storage.attach(layer.path, owner='worker')
+        attached_a = attached.slot_by_id(slot_a.slot_id)
+        attached_b = attached.slot_by_id(slot_b.slot_id)
+        # raw byte data is read in place
+        self.assertTrue(
+            isinstance(attached_a.value, storage.VIEW_TYPES),
+        )
+        self.assertEqual(
+            bytes(attached_a.value),
+            b"abc",
+        )
+        self.assertEqual(
+            attached_b.value,
+            2,
+        )
+        self.assertEqual(
+            attached_b.positions,
+            {"child_b"},
+        )
+        self.assertEqual(
+            attached.current_state.owner,
+            'worker',
+        )
+
+        # the published layer itself can't be written
+        self.assertRaises(
+            Exception,
+            lambda: attached.set_slot(attached_b, 3),
+        )
+
+        attached_b.set_value(3, position="worker_b")
+        changes = attached.current_state.export_changes()
+        self.assertEqual(
+            changes,
+            {
+                slot_b.slot_id: (3, {"worker_b"}),
+            },
+        )
+
+        root.apply_changes(changes)
+        self.assertEqual(
+            slot_b.value,
+            3,
+        )
+        self.assertEqual(
+            slot_b.positions,
+            {"worker_b"},
+        )
+
+        layer.unlink()
+        self.assertFalse(
+            os.path.exists(layer.path),
+        )
+
+    def test_publish_zero_copy(self):
+        root = datafork.Root()
+        bytes_slot = root.slot(initial_value=b"abc")
+        array_slot = root.slot(initial_value=array.array('i', [1, 2]))
+        other_slot = root.slot(initial_value=[1])
+        values = root.slot_values
+
+        with root.publish(self.directory) as layer:
+            # publishing doesn't pin the state, so writing it doesn't copy
+            # its storage
+            other_slot.value = [2]
+            self.assertTrue(
+                root.slot_values is values,
+            )
+
+            attached = storage.attach(layer.path)
+            attached_bytes = attached.slot_by_id(bytes_slot.slot_id).value
+            attached_array = attached.slot_by_id(array_slot.slot_id).value
+            self.assertTrue(
+                isinstance(attached_bytes, storage.VIEW_TYPES),
+            )
+            self.assertEqual(
+                bytes(attached_bytes),
+                b"abc",
+            )
+            self.assertTrue(
+                isinstance(attached_array, storage.VIEW_TYPES),
+            )
+            self.assertEqual(
+                array.array('i', bytes(attached_array)),
+                array.array('i', [1, 2]),
+            )
+            self.assertEqual(
+                attached.slot_by_id(other_slot.slot_id).value,
+                [1],
+            )
+
+    @unittest.skipIf(storage.numpy is None, "NumPy is not installed")
+    def test_publish_ndarray(self):
+        import numpy
+        root = datafork.Root()
+        slot = root.slot(
+            initial_value=numpy.arange(6, dtype="<f8").reshape(2, 3),
+        )
+        empty_slot = root.slot(initial_value=numpy.zeros((0, 2)))
+
+        with root.publish(self.directory) as layer:
+            attached = storage.attach(layer.path)
+            value = attached.slot_by_id(slot.slot_id).value
+            self.assertEqual(
+                (value.shape, value.dtype, value.tolist()),
+                ((2, 3), numpy.dtype("<f8"), [[0, 1, 2], [3, 4, 5]]),
+            )
+            # the array is read in place, so it can't be written
+            self.assertFalse(
+                value.flags.writeable,
+            )
+            self.assertEqual(
+                attached.slot_by_id(empty_slot.slot_id).value.shape,
+                (0, 2),
+            )
+
+        # spilled arrays are copied, and so can be written
+        root.spill(os.path.join(self.directory, "spill"))
+        root.slot_values.unload()
+        value = slot.value
+        value[0, 0] = 10
+        self.assertEqual(
+            value.tolist(),
+            [[10, 1, 2], [3, 4, 5]],
+        )
+
+    def test_publish_defaults(self):
+        root = datafork.Root()
+        plain = root.allocate_slots(2, default=5)
+        made = root.allocate_slots(2, default_factory=list)
+        made[0].value.append(1)
+        view_slot = root.slot(initial_value=memoryview(b"abc"))
+
+        with root.publish(self.directory) as layer:
+            attached = storage.attach(layer.path)
+            self.assertEqual(
+                [attached.slot_by_id(slot.slot_id).value for slot in plain],
+                [5, 5],
+            )
+            self.assertEqual(
+                [attached.slot_by_id(slot.slot_id).value for slot in made],
+                [[1], []],
+            )
+            # read-only views are handed back without copying
+            attached_view = attached.slot_by_id(view_slot.slot_id)
+            self.assertTrue(
+                isinstance(attached_view.value, storage.VIEW_TYPES),
+            )
+            self.assertEqual(
+                bytes(attached_view.value),
+                b"abc",
+            )
+
+    def test_worker_process(self):
+        import multiprocessing
+
+        root = datafork.Root()
+        slot = root.slot(initial_value=bytearray(b"abc"))
+
+        with root.publish(self.directory) as layer:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=_shared_worker,
+                args=(layer.path, slot.slot_id, queue),
+            )
+            process.start()
+            changes = queue.get(timeout=10)
+            process.join()
+
+        root.apply_changes(changes)
+        self.assertEqual(
+            slot.value,
+            b"ABC",
+        )
+
+
+class TestWriteAheadLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "wal")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_recover(self):
+        root = datafork.Root('root_owner')
+        slot_a = root.slot('a', initial_value=1)
+        root.enable_wal(self.path)
+        slot_b = root.slot('b', initial_value=[1])
+        slots = root.allocate_slots(2, default=0)
+        with root.fork() as child_state:
+            slot_a.set_value(2, position="child_a")
+            slots[1].value = 5
+        root.merge_children([child_state])
+        children = []
+        for value in (3, 4):
+            with root.fork() as child_state:
+                slot_a.value = value
+            children.append(child_state)
+        root.merge_children(children)
+        root.resolve_conflicts(lambda slot, conflict: 7)
+        with root.transaction():
+            slot_b.value = bytearray(b"abc")
+        # the root is never finalized, as if the process had crashed
+
+        recovered = datafork.Root.recover(self.path)
+        self.assertEqual(
+            recovered.owner,
+            'root_owner',
+        )
+        recovered_a = recovered.slot_by_id(slot_a.slot_id)
+        self.assertEqual(
+            recovered_a.owner,
+            'a',
+        )
+        self.assertEqual(
+            recovered_a.value,
+            7,
+        )
+        self.assertEqual(
+            bytes(recovered.slot_by_id(slot_b.slot_id).value),
+            b"abc",
+        )
+        self.assertEqual(
+            [recovered.slot_by_id(slot.slot_id).value for slot in slots],
+            [0, 5],
+        )
+        self.assertEqual(
+            recovered.slot().slot_id,
+            root.slot().slot_id,
+        )
+
+    def test_conflict_recovered(self):
+        root = datafork.Root()
+        slot = root.slot(initial_value=1)
+        root.enable_wal(self.path)
+        children = []
+        for value in (2, 3):
+            with root.fork() as child_state:
+                slot.value = value
+            children.append(child_state)
+        root.merge_children(children)
+
+        recovered = datafork.Root.recover(self.path)
+        self.assertEqual(
+            recovered.conflicts().keys(),
+            [recovered.slot_by_id(slot.slot_id)],
+        )
+
+    def test_torn_record(self):
+        root = datafork.Root()
+        slot = root.slot(initial_value=1)
+        root.enable_wal(self.path)
+        slot.value = 2
+        size = os.path.getsize(self.path)
+        slot.value = 3
+        root.disable_wal()
+
+        # lose part of the last record
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        recovered = datafork.Root.recover(self.path)
+        recovered_slot = recovered.slot_by_id(slot.slot_id)
+        self.assertEqual(
+            recovered_slot.value,
+            2,
+        )
+        # the torn record is dropped so that new ones can follow it
+        self.assertEqual(
+            os.path.getsize(self.path),
+            size,
+        )
+        recovered_slot.value = 4
+        self.assertEqual(
+            datafork.Root.recover(self.path).slot_by_id(slot.slot_id).value,
+            4,
+        )
+
+    def test_checkpoint_truncates(self):
+        checkpoint_path = os.path.join(self.directory, "checkpoint")
+        root = datafork.Root()
+        slots = [root.slot(initial_value=i) for i in range(100)]
+        root.enable_wal(self.path)
+        for slot in slots:
+            slot.value = slot.value + 1
+        size = os.path.getsize(self.path)
+        root.checkpoint(checkpoint_path)
+        self.assertTrue(
+            os.path.getsize(self.path) < size,
+        )
+        slots[0].value = 100
+
+        recovered = datafork.Root.recover(self.path)
+        self.assertEqual(
+            [recovered.slot_by_id(slot.slot_id).value for slot in slots],
+            [100] + range(2, 101),
+        )
+
+    def test_sync_every(self):
+        root = datafork.Root()
+        slot = root.slot(initial_value=0)
+        wal = root.enable_wal(self.path, sync_every=3)
+        syncs = []
+        real_sync = wal.sync
+        def sync():
+            syncs.append(wal._unsynced)
+            real_sync()
+        wal.sync = sync
+        for i in range(7):
+            slot.value = i
+        self.assertEqual(
+            syncs,
+            [3, 3],
+        )
+        # whatever is left is synced when the log is closed
+        root.finalize_data()
+        self.assertEqual(
+            syncs,
+            [3, 3, 1],
+        )
+        self.assertEqual(
+            datafork.Root.recover(self.path).slot_by_id(slot.slot_id).value,
+            6,
+        )
+
+    def test_existing_log(self):
+        root = datafork.Root()
+        root.enable_wal(self.path)
+        slot = root.slot(initial_value=0)
+        slot.value = 42
+        # the log is never closed, as if the process had crashed
+        other = datafork.Root()
+        self.assertRaises(
+            Exception,
+            lambda: other.enable_wal(self.path),
+        )
+        self.assertEqual(
+            datafork.Root.recover(self.path).slot_by_id(slot.slot_id).value,
+            42,
+        )
+        other.enable_wal(self.path, overwrite=True)
+        self.assertEqual(
+            datafork.Root.recover(self.path).slot_values,
+            {},
+        )
+
+    def test_new_slots(self):
+        from datafork.storage import _read_wal
+        root = datafork.Root()
+        wal = root.enable_wal(self.path)
+        slots = [root.slot(initial_value=i) for i in range(100)]
+        # the initial values wait for the next record
+        self.assertEqual(
+            len(list(_read_wal(self.path))),
+            1,
+        )
+        with root.transaction():
+            slots[0].value = 100
+        self.assertEqual(
+            len(list(_read_wal(self.path))),
+            2,
+        )
+        recovered = datafork.Root.recover(self.path)
+        self.assertEqual(
+            [recovered.slot_by_id(slot.slot_id).value for slot in slots],
+            [100] + range(1, 100),
+        )
+
+        # or are written when the log is synced
+        slot = root.slot(initial_value='new')
+        wal.sync()
+        self.assertEqual(
+            datafork.Root.recover(self.path).slot_by_id(slot.slot_id).value,
+            'new',
+        )
+
+    def test_not_a_log(self):
+        with open(self.path, "wb") as f:
+            f.write(b"nonsense" * 10)
+        self.assertRaises(
+            Exception,
+            lambda: datafork.Root.recover(self.path),
+        )
+        # and it is left alone rather than replaced by a new log
+        root = datafork.Root()
+        self.assertRaises(
+            Exception,
+            lambda: root.enable_wal(self.path),
+        )
+        with open(self.path, "rb") as f:
+            self.assertEqual(
+                f.read(),
+                b"nonsense" * 10,
+            )